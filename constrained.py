@@ -0,0 +1,623 @@
+"""
+Constrained decoding with regular grammars and JSON schemas.
+
+A regular expression is compiled ahead of time into a DFA over bytes and
+then into a token-level automaton over the tokenizer's vocabulary: for every
+DFA state, the tokens whose bytes keep the match alive and the state they
+lead to. :class:`GrammarConstraint` keeps every row's automaton state on
+device and masks the logits of each step with one gather from the
+``(states, vocab)`` transition table, see :mod:`logits_processors`.
+
+JSON schemas are translated to a regular expression by
+:func:`json_schema_regex`. Only the regular part of JSON Schema is supported:
+objects with fixed ``properties``, arrays, strings, numbers, integers,
+booleans, null, ``enum``, ``const``, ``pattern``, ``anyOf`` / ``oneOf`` and
+non-recursive ``$ref``.
+
+The supported regular expression syntax is literals, ``.``, character
+classes (``[a-z]``, ``[^"]``, ``\\d``, ``\\w``, ``\\s``), groups, ``|`` and
+the quantifiers ``*``, ``+``, ``?``, ``{n}``, ``{n,}`` and ``{n,m}``. The
+whole output must match. ``.``, negated classes and ``\\D``, ``\\W``, ``\\S``
+match any character outside them as one well-formed UTF-8 sequence, so
+output matching them always decodes; only ``\\xNN`` escapes match raw bytes.
+"""
+
+import json
+import re
+from collections import deque
+from functools import lru_cache
+from typing import Any, Dict, FrozenSet, List, Optional, Sequence, Tuple, Union
+
+import mlx.core as mx
+
+ASCII = frozenset(range(128))
+_DIGITS = frozenset(b"0123456789")
+_WORD = frozenset(b"abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789_")
+_SPACE = frozenset(b" \t\n\r\f\v")
+# (ASCII bytes, whether every non-ASCII character is included too)
+_CLASS_ESCAPES = {
+    "d": (_DIGITS, False),
+    "D": (ASCII - _DIGITS, True),
+    "w": (_WORD, False),
+    "W": (ASCII - _WORD, True),
+    "s": (_SPACE, False),
+    "S": (ASCII - _SPACE, True),
+}
+_CHAR_ESCAPES = {"n": "\n", "t": "\t", "r": "\r", "f": "\f", "v": "\v", "0": "\0"}
+
+
+# Regular expression -> AST: ("set", bytes), ("cat", nodes), ("alt", nodes)
+# and ("rep", node, min, max or None)
+
+
+def _bytes(*sets) -> Tuple:
+    return ("cat", [("set", frozenset(s)) for s in sets])
+
+
+_CONT = range(0x80, 0xC0)
+# every well-formed UTF-8 encoding of a non-ASCII code point (RFC 3629): no
+# overlong forms, surrogates or code points above U+10FFFF
+_NON_ASCII = ("alt", [
+    _bytes(range(0xC2, 0xE0), _CONT),
+    _bytes([0xE0], range(0xA0, 0xC0), _CONT),
+    _bytes([*range(0xE1, 0xED), 0xEE, 0xEF], _CONT, _CONT),
+    _bytes([0xED], range(0x80, 0xA0), _CONT),
+    _bytes([0xF0], range(0x90, 0xC0), _CONT, _CONT),
+    _bytes(range(0xF1, 0xF4), _CONT, _CONT, _CONT),
+    _bytes([0xF4], range(0x80, 0x90), _CONT, _CONT),
+])
+
+
+def _chars(ascii: FrozenSet[int], non_ascii: bool):
+    """Node matching one of the bytes ``ascii``, or any non-ASCII character"""
+    if not non_ascii:
+        return ("set", ascii)
+    return ("alt", [("set", ascii), _NON_ASCII]) if ascii else _NON_ASCII
+
+
+class _Parser:
+    def __init__(self, pattern: str):
+        self.pattern = pattern
+        self.pos = 0
+
+    def error(self, message: str):
+        return ValueError(f"{message} at position {self.pos} of regex {self.pattern!r}")
+
+    def peek(self) -> Optional[str]:
+        return self.pattern[self.pos] if self.pos < len(self.pattern) else None
+
+    def next(self) -> str:
+        c = self.peek()
+        if c is None:
+            raise self.error("Unexpected end")
+        self.pos += 1
+        return c
+
+    def parse(self):
+        if self.peek() == "^":
+            self.pos += 1
+        node = self.alternation()
+        if self.peek() == "$":
+            self.pos += 1
+        if self.peek() is not None:
+            raise self.error(f"Unexpected {self.peek()!r}")
+        return node
+
+    def alternation(self):
+        branches = [self.sequence()]
+        while self.peek() == "|":
+            self.pos += 1
+            branches.append(self.sequence())
+        return branches[0] if len(branches) == 1 else ("alt", branches)
+
+    def sequence(self):
+        items = []
+        while self.peek() not in (None, "|", ")") and not (
+            self.peek() == "$" and self.pos == len(self.pattern) - 1
+        ):
+            items.append(self.repeat())
+        return ("cat", items)
+
+    def repeat(self):
+        node = self.atom()
+        while True:
+            c = self.peek()
+            if c == "*":
+                lo, hi = 0, None
+            elif c == "+":
+                lo, hi = 1, None
+            elif c == "?":
+                lo, hi = 0, 1
+            elif c == "{" and re.match(r"\{\d+(,\d*)?\}", self.pattern[self.pos :]):
+                m = re.match(r"\{(\d+)(,(\d*))?\}", self.pattern[self.pos :])
+                lo = int(m.group(1))
+                hi = lo if m.group(2) is None else (int(m.group(3)) if m.group(3) else None)
+                self.pos += m.end() - 1
+            else:
+                return node
+            self.pos += 1
+            node = ("rep", node, lo, hi)
+
+    def atom(self):
+        c = self.next()
+        if c == "(":
+            if self.pattern.startswith("?:", self.pos):
+                self.pos += 2
+            node = self.alternation()
+            if self.next() != ")":
+                raise self.error("Missing )")
+            return node
+        if c == "[":
+            return _chars(*self.char_class())
+        if c == ".":
+            return _chars(ASCII - {ord("\n")}, True)
+        if c == "\\":
+            return self.escape()
+        if c in "*+?)":
+            raise self.error(f"Unexpected {c!r}")
+        return _literal(c)
+
+    def escape(self):
+        c = self.next()
+        if c in _CLASS_ESCAPES:
+            return _chars(*_CLASS_ESCAPES[c])
+        if c == "x":
+            return ("set", frozenset([int(self._hex(2), 16)]))
+        if c == "u":
+            return _literal(chr(int(self._hex(4), 16)))
+        return _literal(_CHAR_ESCAPES.get(c, c))
+
+    def _hex(self, n: int) -> str:
+        digits = self.pattern[self.pos : self.pos + n]
+        if not re.fullmatch(f"[0-9a-fA-F]{{{n}}}", digits):
+            raise self.error("Invalid hex escape")
+        self.pos += n
+        return digits
+
+    def class_char(self) -> Union[int, Tuple[FrozenSet[int], bool]]:
+        c = self.next()
+        if c == "\\":
+            c = self.next()
+            if c in _CLASS_ESCAPES:
+                return _CLASS_ESCAPES[c]
+            if c == "x":
+                return int(self._hex(2), 16)
+            c = _CHAR_ESCAPES.get(c, c)
+        if ord(c) > 127:
+            raise self.error("Only ASCII characters are supported in character classes")
+        return ord(c)
+
+    def char_class(self) -> Tuple[FrozenSet[int], bool]:
+        negate = self.peek() == "^"
+        if negate:
+            self.pos += 1
+        chars = set()
+        non_ascii = False
+        first = True
+        while first or self.peek() != "]":
+            first = False
+            lo = self.class_char()
+            if self.peek() == "-" and self.pattern[self.pos + 1 : self.pos + 2] not in ("]", ""):
+                self.pos += 1
+                hi = self.class_char()
+                if isinstance(lo, tuple) or isinstance(hi, tuple):
+                    raise self.error("Invalid range")
+                chars.update(range(lo, hi + 1))
+            elif isinstance(lo, tuple):
+                chars.update(lo[0])
+                non_ascii = non_ascii or lo[1]
+            else:
+                chars.add(lo)
+        self.pos += 1
+        if negate:
+            # raw \xNN bytes above ASCII cannot be negated per character
+            return ASCII - chars, not non_ascii
+        return frozenset(chars), non_ascii
+
+
+def _literal(char: str):
+    return ("cat", [("set", frozenset([b])) for b in char.encode("utf-8")])
+
+
+# AST -> NFA with epsilon moves -> DFA over bytes
+
+
+class _NFA:
+    def __init__(self):
+        self.eps: List[List[int]] = []
+        self.edges: List[List[Tuple[FrozenSet[int], int]]] = []
+
+    def state(self) -> int:
+        self.eps.append([])
+        self.edges.append([])
+        return len(self.eps) - 1
+
+    def build(self, node) -> Tuple[int, int]:
+        kind = node[0]
+        if kind == "set":
+            start, end = self.state(), self.state()
+            self.edges[start].append((node[1], end))
+            return start, end
+        if kind == "cat":
+            start = end = self.state()
+            for child in node[1]:
+                s, e = self.build(child)
+                self.eps[end].append(s)
+                end = e
+            return start, end
+        if kind == "alt":
+            start, end = self.state(), self.state()
+            for child in node[1]:
+                s, e = self.build(child)
+                self.eps[start].append(s)
+                self.eps[e].append(end)
+            return start, end
+        _, child, lo, hi = node
+        start = end = self.state()
+        for _ in range(lo):
+            s, e = self.build(child)
+            self.eps[end].append(s)
+            end = e
+        if hi is None:
+            s, e = self.build(child)
+            self.eps[end].append(s)
+            self.eps[e].append(s)
+            self.eps[s].append(e)
+            self.eps[end].append(e)
+            end = e
+        else:
+            tail = self.state()
+            for _ in range(hi - lo):
+                s, e = self.build(child)
+                self.eps[end].append(s)
+                self.eps[end].append(tail)
+                end = e
+            self.eps[end].append(tail)
+            end = tail
+        return start, end
+
+    def closure(self, states) -> FrozenSet[int]:
+        seen = set(states)
+        stack = list(states)
+        while stack:
+            for t in self.eps[stack.pop()]:
+                if t not in seen:
+                    seen.add(t)
+                    stack.append(t)
+        return frozenset(seen)
+
+
+def compile_regex(pattern: str) -> Tuple[List[List[int]], List[bool]]:
+    """
+    Compile a regular expression to a DFA over UTF-8 bytes.
+
+    Returns:
+        The transition table ``delta[state][byte]`` (``-1`` for no
+        transition) and which states accept. State ``0`` is the initial
+        state. States from which no accepting state is reachable are removed.
+    """
+    nfa = _NFA()
+    start, end = nfa.build(_Parser(pattern).parse())
+
+    initial = nfa.closure([start])
+    index = {initial: 0}
+    sets = [initial]
+    delta: List[List[int]] = []
+    queue = deque([initial])
+    while queue:
+        current = queue.popleft()
+        targets: Dict[int, set] = {}
+        for s in current:
+            for chars, t in nfa.edges[s]:
+                for b in chars:
+                    targets.setdefault(b, set()).add(t)
+        row = [-1] * 256
+        for b, ts in targets.items():
+            nxt = nfa.closure(ts)
+            if nxt not in index:
+                index[nxt] = len(sets)
+                sets.append(nxt)
+                queue.append(nxt)
+            row[b] = index[nxt]
+        delta.append(row)
+    accepting = [end in s for s in sets]
+
+    # drop the states that can never reach an accepting one
+    reverse: List[set] = [set() for _ in sets]
+    for s, row in enumerate(delta):
+        for t in row:
+            if t >= 0:
+                reverse[t].add(s)
+    live = {s for s, a in enumerate(accepting) if a}
+    stack = list(live)
+    while stack:
+        for s in reverse[stack.pop()]:
+            if s not in live:
+                live.add(s)
+                stack.append(s)
+    if 0 not in live:
+        raise ValueError(f"Regex {pattern!r} cannot match anything")
+    delta = [[t if t in live else -1 for t in row] for row in delta]
+    return delta, accepting
+
+
+# JSON schema -> regular expression
+
+_WS = "[ ]?"
+_STRING_CHAR = r'([^"\\\x00-\x1f]|\\["\\/bfnrt]|\\u[0-9a-fA-F]{4})'
+_INTEGER = r"-?(0|[1-9][0-9]*)"
+_NUMBER = _INTEGER + r"(\.[0-9]+)?([eE][+-]?[0-9]+)?"
+
+
+def _quantifier(lo: int, hi: Optional[int]) -> str:
+    if hi is None:
+        return "*" if lo == 0 else ("+" if lo == 1 else f"{{{lo},}}")
+    return f"{{{lo}}}" if lo == hi else f"{{{lo},{hi}}}"
+
+
+def _const(value: Any) -> str:
+    return re.escape(json.dumps(value, ensure_ascii=False))
+
+
+def json_schema_regex(schema: Union[Dict[str, Any], str]) -> str:
+    """
+    Translate a JSON schema to a regular expression matching the JSON
+    documents it accepts, written compactly with at most one space between
+    tokens.
+
+    Object properties are written in the order they are declared. Properties
+    missing from ``required`` may be left out; if there is no ``required``
+    list every property is written. Other properties are not allowed.
+
+    Bounds (``minLength``, ``maxItems``, ...) unroll into one automaton state
+    per repetition, and every state costs a row of the ``(states, vocab)``
+    table of :class:`GrammarConstraint`, so keep them small.
+    """
+    if isinstance(schema, str):
+        schema = json.loads(schema)
+    defs = {**schema.get("definitions", {}), **schema.get("$defs", {})}
+    return _WS + _schema_regex(schema, defs, ()) + _WS
+
+
+def _schema_regex(schema: Dict[str, Any], defs: Dict[str, Any], refs: Tuple[str, ...]) -> str:
+    if schema is True or schema == {}:
+        raise ValueError("Unconstrained JSON values are not regular, give a type")
+    if "$ref" in schema:
+        ref = schema["$ref"]
+        name = ref.split("/")[-1]
+        if not re.match(r"#/(\$defs|definitions)/", ref) or name not in defs:
+            raise ValueError(f"Unsupported $ref {ref!r}")
+        if ref in refs:
+            raise ValueError(f"Recursive $ref {ref!r} is not regular")
+        return _schema_regex(defs[name], defs, refs + (ref,))
+    if "const" in schema:
+        return _const(schema["const"])
+    if "enum" in schema:
+        return "(" + "|".join(_const(v) for v in schema["enum"]) + ")"
+    for key in ("anyOf", "oneOf"):
+        if key in schema:
+            return "(" + "|".join(_schema_regex(s, defs, refs) for s in schema[key]) + ")"
+
+    kind = schema.get("type")
+    if isinstance(kind, list):
+        return "(" + "|".join(_schema_regex({**schema, "type": k}, defs, refs) for k in kind) + ")"
+    if kind == "string":
+        if "pattern" in schema:
+            return '"' + schema["pattern"].lstrip("^").rstrip("$") + '"'
+        lo, hi = schema.get("minLength", 0), schema.get("maxLength")
+        return '"' + _STRING_CHAR + _quantifier(lo, hi) + '"'
+    if kind == "integer":
+        return _INTEGER
+    if kind == "number":
+        return _NUMBER
+    if kind == "boolean":
+        return "(true|false)"
+    if kind == "null":
+        return "null"
+    if kind == "array":
+        if "items" not in schema:
+            raise ValueError("Arrays need an items schema")
+        item = _schema_regex(schema["items"], defs, refs)
+        lo, hi = schema.get("minItems", 0), schema.get("maxItems")
+        if hi == 0:
+            return r"\[" + _WS + r"\]"
+        more = f"({_WS},{_WS}{item})" + _quantifier(max(lo - 1, 0), None if hi is None else hi - 1)
+        items = item + more
+        return r"\[" + _WS + (items if lo > 0 else f"({items})?") + _WS + r"\]"
+    if kind == "object":
+        properties = schema.get("properties", {})
+        if not properties:
+            return r"\{" + _WS + r"\}"
+        required = set(schema.get("required", properties))
+        fields = [
+            (name in required, _const(name) + _WS + ":" + _WS + _schema_regex(s, defs, refs))
+            for name, s in properties.items()
+        ]
+        sep = f"{_WS},{_WS}"
+        if not any(r for r, _ in fields):
+            raise ValueError("Objects need at least one required property")
+        # optional fields before the first required one carry a trailing
+        # comma, the ones after it a leading comma
+        first = next(i for i, (r, _) in enumerate(fields) if r)
+        body = "".join(f"({f}{sep})?" for _, f in fields[:first]) + fields[first][1]
+        for r, f in fields[first + 1 :]:
+            body += sep + f if r else f"({sep}{f})?"
+        return r"\{" + _WS + body + _WS + r"\}"
+    raise ValueError(f"Unsupported JSON schema: {json.dumps(schema)}")
+
+
+# DFA over bytes -> automaton over tokens
+
+
+def _bytes_to_unicode() -> Dict[int, str]:
+    """The byte-to-character map of byte-level BPE vocabularies (GPT-2)"""
+    bs = (
+        list(range(ord("!"), ord("~") + 1))
+        + list(range(ord("¡"), ord("¬") + 1))
+        + list(range(ord("®"), ord("ÿ") + 1))
+    )
+    cs = bs[:]
+    n = 0
+    for b in range(256):
+        if b not in bs:
+            bs.append(b)
+            cs.append(256 + n)
+            n += 1
+    return dict(zip(bs, map(chr, cs)))
+
+
+@lru_cache(maxsize=8)
+def _token_trie(tokenizer) -> Dict:
+    """
+    Trie of the bytes of every token of ``tokenizer``. Each node maps a byte
+    to a child node, and the key ``None`` to the ids of tokens ending there.
+    Special tokens are left out.
+    """
+    vocab = tokenizer.get_vocab()
+    special = set(getattr(tokenizer, "all_special_ids", []))
+    byte_decoder = {c: b for b, c in _bytes_to_unicode().items()}
+    byte_level = "Ġ" in "".join(vocab)
+
+    trie: Dict = {}
+    for token, i in vocab.items():
+        if i in special:
+            continue
+        if byte_level:
+            if not all(c in byte_decoder for c in token):
+                continue
+            data = bytes(byte_decoder[c] for c in token)
+        elif re.fullmatch(r"<0x[0-9A-Fa-f]{2}>", token):
+            data = bytes([int(token[3:5], 16)])
+        else:
+            data = token.replace("▁", " ").encode("utf-8")
+        if not data:
+            continue
+        node = trie
+        for b in data:
+            node = node.setdefault(b, {})
+        node.setdefault(None, []).append(i)
+    return trie
+
+
+class TokenAutomaton:
+    """
+    Token-level automaton of a regular expression for one tokenizer.
+
+    ``transitions[s]`` holds the ``(tokens, targets)`` allowed in state ``s``
+    and the states they lead to. ``eos_token_id`` is allowed in accepting
+    states and keeps the state. Build it with :meth:`from_regex`, which
+    caches the automata it compiled.
+    """
+
+    def __init__(self, transitions: List[Tuple[List[int], List[int]]]):
+        self.transitions = transitions
+
+    @property
+    def num_states(self) -> int:
+        return len(self.transitions)
+
+    @staticmethod
+    @lru_cache(maxsize=32)
+    def from_regex(pattern: str, tokenizer, eos_token_id: int) -> "TokenAutomaton":
+        delta, accepting = compile_regex(pattern)
+        trie = _token_trie(tokenizer)
+        transitions = []
+        for state, accept in enumerate(accepting):
+            tokens, targets = [], []
+            # walk the trie along the bytes the DFA accepts from ``state``
+            stack = [(trie, state)]
+            while stack:
+                node, s = stack.pop()
+                row = delta[s]
+                for b, child in node.items():
+                    if b is None:
+                        continue
+                    t = row[b]
+                    if t < 0:
+                        continue
+                    ids = child.get(None)
+                    if ids:
+                        tokens.extend(ids)
+                        targets.extend([t] * len(ids))
+                    stack.append((child, t))
+            if accept:
+                tokens.append(eos_token_id)
+                targets.append(state)
+            transitions.append((tokens, targets))
+        return TokenAutomaton(transitions)
+
+    @classmethod
+    def from_json_schema(
+        cls, schema: Union[Dict[str, Any], str], tokenizer, eos_token_id: int
+    ) -> "TokenAutomaton":
+        if not isinstance(schema, str):
+            # property order is part of the grammar, so keys are not sorted
+            schema = json.dumps(schema)
+        return cls.from_regex(json_schema_regex(schema), tokenizer, eos_token_id)
+
+
+class GrammarConstraint:
+    """
+    Logits processor that restricts every row to its token automaton.
+
+    The automata of all rows are stacked into one ``(states + 1, vocab)``
+    table of next states (``-1`` where a token is not allowed). Each step
+    gathers the rows' table rows as the mask and each update gathers their
+    next states, so neither goes back to Python. The last state allows every
+    token; unconstrained rows start there and rows that leave their automaton
+    (e.g. padding fed after they finished) end up there.
+
+    Rows that reach ``max_tokens`` before their automaton accepts are cut
+    off and not valid.
+
+    It is a ``final`` processor, which :class:`logits_processors.LogitsPipeline`
+    applies after every other one.
+
+    Args:
+        automata (List[TokenAutomaton]): The automaton of every row, or
+          ``None`` for unconstrained rows.
+    """
+
+    final = True
+
+    def __init__(self, automata: Sequence[Optional[TokenAutomaton]]):
+        self.automata = list(automata)
+
+    def setup(self, vocab_size: int):
+        offsets: Dict[int, int] = {}
+        unique: List[TokenAutomaton] = []
+        for a in self.automata:
+            if a is not None and id(a) not in offsets:
+                offsets[id(a)] = sum(u.num_states for u in unique)
+                unique.append(a)
+        free = sum(u.num_states for u in unique)
+
+        rows, cols, values = [], [], []
+        for a in unique:
+            offset = offsets[id(a)]
+            for s, (tokens, targets) in enumerate(a.transitions):
+                rows.extend([offset + s] * len(tokens))
+                cols.extend(tokens)
+                values.extend(t + offset for t in targets)
+        dtype = mx.int16 if free < 2**15 else mx.int32
+        table = mx.full((free + 1, vocab_size), -1, dtype=dtype)
+        if rows:
+            table[mx.array(rows), mx.array(cols)] = mx.array(values, dtype=dtype)
+        table[free] = free
+        self.table = table
+        self._free = free
+        self.states = mx.array(
+            [free if a is None else offsets[id(a)] for a in self.automata], dtype=mx.int32
+        )
+
+    @property
+    def state(self) -> List[mx.array]:
+        return [self.states]
+
+    def apply(self, logits: mx.array, states: mx.array) -> mx.array:
+        allowed = self.table[states] >= 0
+        return mx.where(allowed, logits, -float("inf")).astype(logits.dtype)
+
+    def update(self, tokens: mx.array):
+        nxt = self.table[self.states, tokens.reshape(-1)].astype(mx.int32)
+        self.states = mx.where(nxt < 0, self._free, nxt)
@@ -0,0 +1,329 @@
+#!/usr/bin/env python3
+"""
+Generation jobs for MLX MCP Server
+Runs long generations on a single inference worker thread, so tool calls
+return a job id at once instead of blocking the server's event loop. Jobs
+report their progress (tokens generated, rows finished) while they run and
+can be cancelled between decode steps. Compatible jobs submitted within a
+short window of each other are coalesced and decoded as one batch
+"""
+
+import logging
+import os
+import threading
+import time
+import uuid
+from collections import OrderedDict, deque
+from concurrent.futures import Future
+from dataclasses import dataclass, field
+from typing import Any, Callable, Deque, Dict, Hashable, List, Optional
+
+logger = logging.getLogger(__name__)
+
+# Number of finished jobs kept for status queries, oldest dropped first
+MAX_FINISHED_JOBS = int(os.environ.get("MLX_MAX_FINISHED_JOBS", "100"))
+# How long a coalescable job waits for compatible jobs to batch with, and the
+# most prompts decoded in one coalesced batch
+COALESCE_WINDOW_MS = float(os.environ.get("MLX_COALESCE_WINDOW_MS", "20"))
+MAX_COALESCED_PROMPTS = int(os.environ.get("MLX_MAX_COALESCED_PROMPTS", "256"))
+
+QUEUED = "queued"
+RUNNING = "running"
+COMPLETED = "completed"
+FAILED = "failed"
+CANCELLED = "cancelled"
+
+# Per-row progress callback of the generation functions, see
+# ``utils.batch_generate``: (tokens generated, finished) of every row
+Progress = Callable[[List[int], List[bool]], None]
+
+
+class JobCancelled(Exception):
+    """Raised from a batch's progress report once all of its jobs were cancelled"""
+
+
+def _format_time(ts: Optional[float]) -> Optional[str]:
+    return time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(ts)) if ts else None
+
+
+@dataclass
+class Job:
+    """
+    A queued generation request.
+
+    ``run(jobs, progress)`` generates the rows of all ``jobs`` in one batch,
+    in job order, passing ``progress`` to the generation function, and
+    returns one result per job (``None`` for jobs cancelled meanwhile). Jobs
+    with the same ``coalesce_key`` must be runnable by each other's ``run``;
+    ``None`` never coalesces. ``run`` may set a job's ``stored`` to the
+    future of the background write of its results; the job then stays
+    running until the write finished, and fails if it failed.
+    """
+
+    id: str
+    kind: str
+    model_name: str
+    request: Dict[str, Any]
+    total_rows: int
+    run: Callable[[List["Job"], Progress], List[Optional[Dict[str, Any]]]]
+    coalesce_key: Optional[Hashable] = None
+    status: str = QUEUED
+    tokens_generated: int = 0
+    rows_finished: int = 0
+    coalesced_jobs: int = 1
+    result: Optional[Dict[str, Any]] = None
+    error: Optional[str] = None
+    created_at: float = field(default_factory=time.time)
+    started_at: Optional[float] = None
+    finished_at: Optional[float] = None
+    cancel_requested: threading.Event = field(default_factory=threading.Event)
+    stored: Optional[Future] = None
+
+    @property
+    def done(self) -> bool:
+        return self.status in (COMPLETED, FAILED, CANCELLED)
+
+    @property
+    def cancelled(self) -> bool:
+        return self.cancel_requested.is_set()
+
+    def report(self, lengths: List[int], finished: List[bool]):
+        """Record the progress of the job's own rows"""
+        self.tokens_generated = sum(lengths)
+        self.rows_finished = sum(finished)
+
+    def to_dict(self) -> Dict[str, Any]:
+        end = self.finished_at or time.time()
+        elapsed = end - self.started_at if self.started_at else 0.0
+        return {
+            "job_id": self.id,
+            "kind": self.kind,
+            "model": self.model_name,
+            "status": self.status,
+            "progress": {
+                "tokens_generated": self.tokens_generated,
+                "rows_finished": self.rows_finished,
+                "total_rows": self.total_rows,
+                "tokens_per_sec": self.tokens_generated / elapsed if elapsed else 0.0,
+            },
+            "coalesced_jobs": self.coalesced_jobs,
+            "created_at": _format_time(self.created_at),
+            "started_at": _format_time(self.started_at),
+            "finished_at": _format_time(self.finished_at),
+            "result": self.result,
+            "error": self.error,
+        }
+
+
+def _batch_progress(jobs: List[Job]) -> Progress:
+    """
+    Split the per-row progress of a coalesced batch over its jobs, and abort
+    the batch once every job in it was cancelled.
+    """
+    spans, start = [], 0
+    for job in jobs:
+        spans.append((job, start, start + job.total_rows))
+        start += job.total_rows
+
+    def progress(lengths: List[int], finished: List[bool]):
+        if all(job.cancelled for job in jobs):
+            raise JobCancelled(", ".join(job.id for job in jobs))
+        for job, a, b in spans:
+            job.report(lengths[a:b], finished[a:b])
+
+    return progress
+
+
+class JobManager:
+    """
+    Queue of generation jobs served by one inference worker thread.
+
+    MLX models and their KV caches are not safe to use from several threads
+    at once, so batches run one after another in submission order. The worker
+    is started on the first submit and runs as a daemon thread.
+
+    Before running a job with a ``coalesce_key``, the worker waits until it
+    is ``coalesce_window`` seconds old and takes every queued job with the
+    same key along, up to ``max_coalesced_rows`` rows, so concurrent small
+    requests share one batch. Jobs that queued up while the worker was busy
+    are coalesced without waiting. Finished jobs stay queryable until more
+    than ``max_finished`` newer ones finished.
+    """
+
+    def __init__(
+        self,
+        max_finished: int = MAX_FINISHED_JOBS,
+        coalesce_window: float = COALESCE_WINDOW_MS / 1000,
+        max_coalesced_rows: int = MAX_COALESCED_PROMPTS,
+    ):
+        self.max_finished = max_finished
+        self.coalesce_window = coalesce_window
+        self.max_coalesced_rows = max_coalesced_rows
+        self._jobs: "OrderedDict[str, Job]" = OrderedDict()
+        self._pending: Deque[Job] = deque()
+        self._lock = threading.Lock()
+        self._has_pending = threading.Condition(self._lock)
+        self._worker: Optional[threading.Thread] = None
+        self.batches = 0
+        self.coalesced = 0
+
+    def submit(
+        self,
+        kind: str,
+        model_name: str,
+        request: Dict[str, Any],
+        total_rows: int,
+        run: Callable[[List[Job], Progress], List[Optional[Dict[str, Any]]]],
+        coalesce_key: Optional[Hashable] = None,
+    ) -> Job:
+        """Queue a job, see :class:`Job`, and return it at once."""
+        job = Job(
+            id=f"job_{uuid.uuid4().hex[:12]}",
+            kind=kind,
+            model_name=model_name,
+            request=request,
+            total_rows=total_rows,
+            run=run,
+            coalesce_key=coalesce_key,
+        )
+        with self._lock:
+            self._jobs[job.id] = job
+            self._pending.append(job)
+            self._has_pending.notify()
+            if self._worker is None or not self._worker.is_alive():
+                self._worker = threading.Thread(
+                    target=self._work, name="mlx-inference", daemon=True
+                )
+                self._worker.start()
+        logger.info(f"Queued {kind} job {job.id} ({total_rows} rows)")
+        return job
+
+    def get(self, job_id: str) -> Optional[Job]:
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def list(self) -> List[Job]:
+        """All known jobs, most recently submitted first"""
+        with self._lock:
+            return list(reversed(self._jobs.values()))
+
+    def cancel(self, job_id: str) -> Optional[Job]:
+        """
+        Cancel a job. A queued job is cancelled right away and never runs. A
+        running one stores no results, and its batch stops at the next decode
+        step once all jobs coalesced into it were cancelled.
+        """
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is None or job.done:
+                return job
+            job.cancel_requested.set()
+            if job.status == QUEUED:
+                job.status = CANCELLED
+                job.finished_at = time.time()
+        return job
+
+    def _next_batch(self) -> List[Job]:
+        with self._lock:
+            while True:
+                while not self._pending:
+                    self._has_pending.wait()
+                job = self._pending.popleft()
+                if job.status == QUEUED:
+                    break
+        if job.coalesce_key is None:
+            return [job]
+        delay = job.created_at + self.coalesce_window - time.time()
+        if delay > 0:
+            time.sleep(delay)
+        batch, rows = [job], job.total_rows
+        with self._lock:
+            for other in list(self._pending):
+                if (
+                    other.status == QUEUED
+                    and other.coalesce_key == job.coalesce_key
+                    and rows + other.total_rows <= self.max_coalesced_rows
+                ):
+                    self._pending.remove(other)
+                    batch.append(other)
+                    rows += other.total_rows
+            # jobs cancelled while the window was open never start
+            return [j for j in batch if j.status == QUEUED]
+
+    def _work(self):
+        while True:
+            batch = self._next_batch()
+            if not batch:
+                continue
+            with self._lock:
+                self.batches += 1
+                self.coalesced += len(batch) - 1
+                for job in batch:
+                    job.status = RUNNING
+                    job.started_at = time.time()
+                    job.coalesced_jobs = len(batch)
+            if len(batch) > 1:
+                logger.info(
+                    f"Coalesced {len(batch)} {batch[0].kind} jobs "
+                    f"({sum(job.total_rows for job in batch)} rows)"
+                )
+            try:
+                results = batch[0].run(batch, _batch_progress(batch))
+                error = None
+            except JobCancelled:
+                results, error = [None] * len(batch), None
+                logger.info(f"Cancelled jobs {', '.join(job.id for job in batch)}")
+            except Exception as e:
+                results, error = [None] * len(batch), str(e)
+                logger.error(f"Error in {batch[0].kind} jobs: {e}")
+            storing = []
+            with self._lock:
+                for job, result in zip(batch, results):
+                    if job.cancelled:
+                        job.status = CANCELLED
+                    elif error is not None:
+                        job.status, job.error = FAILED, error
+                    elif job.stored is not None:
+                        # finished by _stored once its results are written
+                        job.result = result
+                        storing.append(job)
+                        continue
+                    else:
+                        job.status, job.result = COMPLETED, result
+                    job.finished_at = time.time()
+                self._drop_finished()
+            # outside the lock: a finished write calls back right away
+            for job in storing:
+                job.stored.add_done_callback(lambda stored, job=job: self._stored(job, stored))
+
+    def _stored(self, job: Job, stored: Future):
+        with self._lock:
+            if stored.exception() is None:
+                job.status = COMPLETED
+            else:
+                job.status = FAILED
+                job.error = f"Results could not be stored: {stored.exception()}"
+            job.finished_at = time.time()
+            self._drop_finished()
+
+    def _drop_finished(self):
+        finished = [job_id for job_id, job in self._jobs.items() if job.done]
+        for job_id in finished[: max(len(finished) - self.max_finished, 0)]:
+            del self._jobs[job_id]
+
+    def stats(self) -> Dict[str, Any]:
+        """Number of jobs in every status and of coalesced batches for reporting"""
+        with self._lock:
+            counts = {status: 0 for status in (QUEUED, RUNNING, COMPLETED, FAILED, CANCELLED)}
+            for job in self._jobs.values():
+                counts[job.status] += 1
+            return {
+                **counts,
+                "batches": self.batches,
+                "coalesced_jobs": self.coalesced,
+                "coalesce_window_ms": self.coalesce_window * 1000,
+            }
+
+
+# Shared by all tools in the server process
+job_manager = JobManager()
@@ -0,0 +1,262 @@
+"""
+Logits processors for the batched decode loops.
+
+A processor rewrites the ``(batch, vocab)`` logits of every step before
+sampling. :class:`LogitsPipeline` chains them in three kinds:
+
+- static processors (``bias(vocab_size)``) do not depend on the generated
+  tokens, e.g. :class:`LogitBias` and :class:`BannedTokens`. They are folded
+  once per batch into a single dense additive bias.
+- stateful processors (``state``, ``apply(logits, *state)`` and
+  ``update(tokens)``) keep their per-row state in arrays, e.g.
+  :class:`TokenPenalties` and :class:`StopSequenceLookahead`. ``apply`` is a
+  pure function of its inputs, so the bias and all ``apply`` calls run as one
+  function compiled with :func:`mx.compile`.
+- anything else is a callable ``fn(logits) -> logits`` run after the
+  compiled part, optionally with an ``update(tokens)`` method.
+
+Processors with ``final = True`` are masks, e.g.
+:class:`constrained.GrammarConstraint`. They run after all of the above,
+whatever their position in the chain, so no other processor can make a
+token likely that they forbid.
+
+Processors with a ``setup(vocab_size)`` method get it called on the first
+step, once the vocabulary size is known.
+"""
+
+from typing import Callable, Dict, Iterable, List, Optional, Sequence, Union
+
+import mlx.core as mx
+
+from sample_utils import _per_row
+
+
+class LogitBias:
+    """Add a fixed bias to the given token ids, shared by every row."""
+
+    def __init__(self, logit_bias: Dict[int, float]):
+        self.logit_bias = logit_bias
+
+    def bias(self, vocab_size: int) -> mx.array:
+        bias = mx.zeros((vocab_size,))
+        bias[mx.array(list(self.logit_bias.keys()))] = mx.array(
+            list(self.logit_bias.values()), dtype=mx.float32
+        )
+        return bias
+
+
+class BannedTokens:
+    """Never sample the given token ids."""
+
+    def __init__(self, token_ids: Iterable[int]):
+        self.token_ids = list(token_ids)
+
+    def bias(self, vocab_size: int) -> mx.array:
+        bias = mx.zeros((vocab_size,))
+        bias[mx.array(self.token_ids)] = -float("inf")
+        return bias
+
+
+class TokenPenalties:
+    """
+    Repetition, frequency and presence penalties for a batch of rows.
+
+    Every row's token counts over its context window are kept on device as a
+    ``(batch, vocab)`` tensor and updated with a scatter-add after each step,
+    so applying the penalties never goes back to Python per row. With a
+    ``context_size`` the last tokens of each row are kept in a ring buffer
+    and the token leaving the window is subtracted again.
+
+    Penalties are either shared or given per row:
+
+    - ``repetition_penalty`` divides positive (multiplies negative) logits of
+      tokens seen in the window (https://arxiv.org/abs/1909.05858).
+    - ``frequency_penalty`` subtracts ``penalty * count`` from the logits.
+    - ``presence_penalty`` subtracts ``penalty`` from tokens seen at least once.
+
+    Args:
+        context (List[List[int]]): The prompt tokens of every row, without
+          padding.
+        repetition_penalty (float, optional): Repetition penalty factor.
+        frequency_penalty (float): Frequency penalty. Default: ``0``.
+        presence_penalty (float): Presence penalty. Default: ``0``.
+        context_size (int, optional): Number of most recent tokens counted
+          per row. Default: every prompt and generated token.
+    """
+
+    def __init__(
+        self,
+        context: List[List[int]],
+        repetition_penalty: Optional[Union[float, Sequence[float]]] = None,
+        frequency_penalty: Union[float, Sequence[float]] = 0.0,
+        presence_penalty: Union[float, Sequence[float]] = 0.0,
+        context_size: Optional[int] = None,
+    ):
+        B = len(context)
+
+        def _column(value, default):
+            values = [default if v is None else v for v in _per_row(value, B)]
+            return mx.array(values, dtype=mx.float32)[:, None]
+
+        self.repetition_penalty = (
+            _column(repetition_penalty, 1.0) if repetition_penalty is not None else None
+        )
+        self.frequency_penalty = _column(frequency_penalty, 0.0) if frequency_penalty else None
+        self.presence_penalty = _column(presence_penalty, 0.0) if presence_penalty else None
+        self.context = context
+        self.context_size = context_size
+        self.counts = None
+
+    def setup(self, vocab_size: int):
+        B = len(self.context)
+        # column ``vocab_size`` counts padding and is never read
+        self.vocab_size = vocab_size
+        width = self.context_size or max((len(c) for c in self.context), default=0)
+        window = [c[max(len(c) - width, 0) :] if width else [] for c in self.context]
+        history = mx.array(
+            [[vocab_size] * (width - len(w)) + w for w in window], dtype=mx.int32
+        ).reshape(B, width)
+        self._rows = mx.arange(B)
+        self.counts = mx.zeros((B, vocab_size + 1), dtype=mx.float32)
+        self.counts = self.counts.at[self._rows[:, None], history].add(1)
+        # oldest token of the window is at ``_pos``
+        self._history = history if self.context_size else None
+        self._pos = 0
+
+    @property
+    def state(self) -> List[mx.array]:
+        return [self.counts]
+
+    def apply(self, logits: mx.array, counts: mx.array) -> mx.array:
+        dtype = logits.dtype
+        counts = counts[:, : self.vocab_size]
+        if self.repetition_penalty is not None:
+            penalized = mx.where(
+                logits < 0, logits * self.repetition_penalty, logits / self.repetition_penalty
+            )
+            logits = mx.where(counts > 0, penalized, logits)
+        if self.frequency_penalty is not None:
+            logits = logits - self.frequency_penalty * counts
+        if self.presence_penalty is not None:
+            logits = logits - self.presence_penalty * (counts > 0)
+        return logits.astype(dtype)
+
+    def __call__(self, logits: mx.array) -> mx.array:
+        return self.apply(logits, self.counts)
+
+    def update(self, tokens: mx.array):
+        """Count the ``(batch, 1)`` tokens sampled in the last step."""
+        tokens = tokens.reshape(-1)
+        if self._history is not None:
+            self.counts = self.counts.at[self._rows, self._history[:, self._pos]].add(-1)
+            self._history[:, self._pos] = tokens
+            self._pos = (self._pos + 1) % self.context_size
+        self.counts = self.counts.at[self._rows, tokens].add(1)
+
+
+class StopSequenceLookahead:
+    """
+    End rows on multi-token stop sequences before they are completed.
+
+    Each row's last generated tokens are kept on device. When they match all
+    but the last token of a stop sequence, the probability of that last token
+    is moved to ``eos_token_id``, so the row finishes instead of completing
+    the sequence. The tokens of the sequence generated before that stay in
+    the output.
+
+    Args:
+        stop_sequences (List[List[int]]): Token ids of every stop sequence.
+        eos_token_id (int): Token that finishes a row.
+        batch_size (int): Number of rows.
+    """
+
+    def __init__(self, stop_sequences: List[List[int]], eos_token_id: int, batch_size: int):
+        self.stop_sequences = [list(s) for s in stop_sequences if s]
+        self.eos_token_id = eos_token_id
+        width = max((len(s) for s in self.stop_sequences), default=1) - 1
+        # -1 never matches a token id
+        self.history = mx.full((batch_size, width), -1, dtype=mx.int32)
+
+    @property
+    def state(self) -> List[mx.array]:
+        return [self.history]
+
+    def apply(self, logits: mx.array, history: mx.array) -> mx.array:
+        vocab = mx.arange(logits.shape[-1])
+        is_eos = vocab == self.eos_token_id
+        for seq in self.stop_sequences:
+            n = len(seq) - 1
+            if n > 0:
+                match = mx.all(history[:, history.shape[1] - n :] == mx.array(seq[:-1]), axis=1)
+            else:
+                match = mx.ones((logits.shape[0],), dtype=mx.bool_)
+            last = logits[:, seq[-1]]
+            eos = mx.where(match, mx.logaddexp(logits[:, self.eos_token_id], last), logits[:, self.eos_token_id])
+            logits = mx.where(is_eos, eos[:, None].astype(logits.dtype), logits)
+            logits = mx.where(match[:, None] & (vocab == seq[-1]), -float("inf"), logits)
+        return logits
+
+    def update(self, tokens: mx.array):
+        if self.history.shape[1] > 0:
+            self.history = mx.concatenate([self.history[:, 1:], tokens.astype(mx.int32)], axis=1)
+
+
+class LogitsPipeline:
+    """
+    Run a chain of logits processors, see the module docstring.
+
+    The dense bias of the static processors is built on the first call. The
+    stateful processors are fused with it into one compiled function, which
+    takes their current state arrays as inputs on every step.
+    """
+
+    def __init__(self, processors: Iterable[Callable]):
+        processors = list(processors)
+        self.final = [p for p in processors if getattr(p, "final", False)]
+        processors = [p for p in processors if p not in self.final]
+        self.static = [p for p in processors if hasattr(p, "bias")]
+        self.stateful = [p for p in processors if hasattr(p, "apply") and not hasattr(p, "bias")]
+        self.callables = [p for p in processors if p not in self.static and p not in self.stateful]
+        self._bias = None
+        self._fused = None
+
+    def _setup(self, vocab_size: int):
+        for p in self.static + self.stateful + self.callables + self.final:
+            if hasattr(p, "setup"):
+                p.setup(vocab_size)
+        if self.static:
+            self._bias = sum(p.bias(vocab_size) for p in self.static)
+        stateful = self.stateful
+        sizes = [len(p.state) for p in stateful]
+
+        def fused(logits, *inputs):
+            if self._bias is not None:
+                bias, inputs = inputs[0], inputs[1:]
+                logits = (logits + bias).astype(logits.dtype)
+            i = 0
+            for p, n in zip(stateful, sizes):
+                logits = p.apply(logits, *inputs[i : i + n])
+                i += n
+            return logits
+
+        self._fused = mx.compile(fused)
+
+    def __call__(self, logits: mx.array) -> mx.array:
+        if self._fused is None:
+            self._setup(logits.shape[-1])
+        if self._bias is not None or self.stateful:
+            inputs = [] if self._bias is None else [self._bias]
+            for p in self.stateful:
+                inputs.extend(p.state)
+            logits = self._fused(logits, *inputs)
+        for p in self.callables:
+            logits = p(logits)
+        for p in self.final:
+            logits = p.apply(logits, *p.state) if hasattr(p, "apply") else p(logits)
+        return logits
+
+    def update(self, tokens: mx.array):
+        """Let the stateful processors see the ``(batch, 1)`` sampled tokens."""
+        for p in self.stateful + self.callables + self.final:
+            if hasattr(p, "update"):
+                p.update(tokens)
@@ -8,12 +8,16 @@ import asyncio
 import json
 import logging
 from datetime import datetime
-from typing import Any, Dict, List, Optional
+from typing import Any, Dict, List, Optional, Union
 from pydantic import BaseModel, Field
 
 from mcp.server import FastMCP
-from utils import load, generate, batch_generate
-from database import init_database, save_generation_result, get_batch_results, get_recent_results, get_results_by_model
+from utils import generate, batch_generate, continuous_batch_generate, _format_prompts, _select_rows
+from model_registry import model_registry
+from prompt_cache import prompt_cache
+from result_cache import result_cache, result_key
+from jobs import Job, job_manager
+from database import init_database, queue_generation_results, get_batch_results, get_recent_results, get_results_by_model, export_results
 
 # Set up logging
 logging.basicConfig(level=logging.INFO)
@@ -22,7 +26,10 @@ logger = logging.getLogger(__name__)
 # Create FastMCP app
 app = FastMCP("mlx-batch-generator")
 
-# No model cache - load fresh each time like demo notebook
+# Models stay resident between tool calls, see model_registry.py, and so do
+# the KV caches of shared prompt prefixes, see prompt_cache.py. Generation runs
+# as jobs on one inference worker thread, see jobs.py, and repeated greedy
+# generations are served from result_cache.py
 
 def _format_prompts_by_type(prompts: List[str], prompt_type: str, max_tokens: int) -> List[str]:
     """
@@ -39,77 +46,317 @@ def _format_prompts_by_type(prompts: List[str], prompt_type: str, max_tokens: in
     # For now, only raw passthrough is supported
     return prompts
 
+def _row_value(value: Any, i: int) -> Any:
+    """Value of prompt ``i`` for a parameter given either shared or per prompt"""
+    return value[i] if isinstance(value, list) else value
+
+def _merge_rows(jobs: List[Job], name: str) -> Any:
+    """
+    Value of the request parameter ``name`` for the concatenated prompts of
+    coalesced jobs: shared if every job gives the same shared value, otherwise
+    one value per prompt
+    """
+    values = [job.request[name] for job in jobs]
+    if all(not isinstance(v, list) and v == values[0] for v in values):
+        return values[0]
+    return [
+        v
+        for job, value in zip(jobs, values)
+        for v in (value if isinstance(value, list) else [value] * job.total_rows)
+    ]
+
+def _result_cache_keys(jobs: List[Job], model_name: str, formatted_prompts: List[str]) -> List[Optional[bytes]]:
+    """
+    Result cache key of every prompt of the coalesced jobs, None for prompts
+    sampled with a temperature above 0, whose responses are not reproducible
+    """
+    if not result_cache.enabled:
+        return [None] * len(formatted_prompts)
+    revision = model_registry.revision(model_name)
+    keys = []
+    rows = iter(formatted_prompts)
+    for job in jobs:
+        request = job.request
+        for i, prompt in zip(range(job.total_rows), rows):
+            if _row_value(request["temperature"], i) != 0:
+                keys.append(None)
+                continue
+            keys.append(result_key(model_name, revision, prompt, {
+                "max_tokens": _row_value(request["max_tokens"], i),
+                "repetition_penalty": _row_value(request["repetition_penalty"], i),
+                "frequency_penalty": _row_value(request["frequency_penalty"], i),
+                "presence_penalty": _row_value(request["presence_penalty"], i),
+                "json_schema": request["json_schema"],
+                "kv_bits": request["kv_bits"],
+                "kv_group_size": request["kv_group_size"]
+            }))
+    return keys
+
+def _run_batch_generation(jobs: List[Job], progress) -> List[Optional[Dict[str, Any]]]:
+    """
+    Generate the prompts of one or more coalesced batch_generate_text jobs in one
+    batch and store every job's responses under its own batch_id.
+    
+    Args:
+        jobs: Jobs sharing the batch-wide settings, see batch_generate_text
+        progress: Per-row progress callback, see jobs.JobManager
+    
+    Returns:
+        The result of every job, None for jobs cancelled meanwhile
+    """
+    request = jobs[0].request
+    model_name = request["model_name"]
+    
+    # Reuse the resident model if a previous call already loaded it
+    model, tokenizer = model_registry.get(model_name)
+    
+    # Apply prompt type formatting, and the chat template here so the result cache
+    # keys see the prompts the model sees
+    prompts = [prompt for job in jobs for prompt in job.request["prompts"]]
+    max_tokens = _merge_rows(jobs, "max_tokens")
+    formatted_prompts = _format_prompts_by_type(prompts, request["prompt_type"], max_tokens)
+    if request["format_prompts"]:
+        formatted_prompts = _format_prompts(tokenizer, formatted_prompts)
+    
+    # Serve repeated greedy rows from the result cache and generate only the misses
+    cache_keys = _result_cache_keys(jobs, model_name, formatted_prompts)
+    row_jobs = [job for job in jobs for _ in range(job.total_rows)]
+    responses = result_cache.get_many([
+        key if job.request["use_result_cache"] else None
+        for key, job in zip(cache_keys, row_jobs)
+    ])
+    misses = [i for i, response in enumerate(responses) if response is None]
+    
+    def miss_progress(lengths: List[int], finished: List[bool]):
+        # cached rows count as finished
+        row_lengths, row_finished = [0] * len(prompts), [True] * len(prompts)
+        for j, i in enumerate(misses):
+            row_lengths[i], row_finished[i] = lengths[j], finished[j]
+        progress(row_lengths, row_finished)
+    
+    def rows(name: str) -> Any:
+        # per-prompt values of the rows that are generated
+        return _select_rows(_merge_rows(jobs, name), misses)
+    
+    # Generate responses
+    if not misses:
+        generated = []
+        miss_progress([], [])
+    elif request["max_batch_size"]:
+        generated = continuous_batch_generate(
+            model,
+            tokenizer,
+            prompts=_select_rows(formatted_prompts, misses),
+            max_tokens=_select_rows(max_tokens, misses),
+            max_batch_size=request["max_batch_size"],
+            verbose=request["verbose"],
+            temp=rows("temperature"),
+            top_p=rows("top_p"),
+            top_k=rows("top_k"),
+            min_p=rows("min_p"),
+            seed=rows("seed"),
+            format_prompts=False,
+            kv_blocks=request["kv_blocks"],
+            kv_bits=request["kv_bits"],
+            kv_group_size=request["kv_group_size"],
+            progress=miss_progress
+        )
+    else:
+        generated = batch_generate(
+            model,
+            tokenizer,
+            prompts=_select_rows(formatted_prompts, misses),
+            max_tokens=_select_rows(max_tokens, misses),
+            verbose=request["verbose"],
+            temp=rows("temperature"),
+            top_p=rows("top_p"),
+            top_k=rows("top_k"),
+            min_p=rows("min_p"),
+            seed=rows("seed"),
+            format_prompts=False,
+            max_batch_tokens=request["max_batch_tokens"],
+            kv_blocks=request["kv_blocks"],
+            kv_bits=request["kv_bits"],
+            kv_group_size=request["kv_group_size"],
+            prompt_cache=prompt_cache,
+            repetition_penalty=rows("repetition_penalty"),
+            frequency_penalty=rows("frequency_penalty"),
+            presence_penalty=rows("presence_penalty"),
+            json_schema=rows("json_schema"),
+            prompt_cache_key=model_name,
+            progress=miss_progress
+        )
+    for i, response in zip(misses, generated):
+        responses[i] = response
+    result_cache.put_many({
+        cache_keys[i]: responses[i] for i in misses if cache_keys[i] is not None
+    })
+    
+    results, start = [], 0
+    for job in jobs:
+        job_responses = responses[start:start + job.total_rows]
+        job_keys = cache_keys[start:start + job.total_rows]
+        cached = job.total_rows - sum(1 for i in misses if start <= i < start + job.total_rows)
+        start += job.total_rows
+        if job.cancelled:
+            results.append(None)
+            continue
+        
+        # Generate batch ID for this batch
+        batch_id = f"batch_{datetime.now().strftime('%Y%m%d_%H%M%S_%f')}"
+        
+        # Save all results to database in the background (no results in response);
+        # the job completes once they are stored
+        job.stored = queue_generation_results([{
+            "model_name": model_name,
+            "prompt": prompt,
+            "response": response,
+            "max_tokens": _row_value(job.request["max_tokens"], i),
+            "temperature": _row_value(job.request["temperature"], i),
+            "prompt_index": i,
+            "batch_id": batch_id,
+            "is_batch": True,
+            "cache_key": cache_key
+        } for i, (prompt, response, cache_key) in enumerate(
+            zip(job.request["prompts"], job_responses, job_keys)
+        )])
+        
+        results.append({
+            "batch_id": batch_id,
+            "cached": cached,
+            "message": "Batch processing completed. Use read_batch_results to retrieve results."
+        })
+    return results
+
 @app.tool()
 def batch_generate_text(
     prompts: List[str],
     model_name: str = "microsoft/Phi-3-mini-4k-instruct",
-    max_tokens: int = 300,
-    temperature: float = 0.7,
+    max_tokens: Union[int, List[int]] = 300,
+    temperature: Union[float, List[float]] = 0.7,
     verbose: bool = False,
     format_prompts: bool = True,
-    prompt_type: str = "raw"
+    prompt_type: str = "raw",
+    top_p: Union[float, List[float]] = 1.0,
+    top_k: Union[int, List[int]] = 0,
+    min_p: Union[float, List[float]] = 0.0,
+    seed: Optional[Union[int, List[Optional[int]]]] = None,
+    repetition_penalty: Optional[Union[float, List[float]]] = None,
+    frequency_penalty: Union[float, List[float]] = 0.0,
+    presence_penalty: Union[float, List[float]] = 0.0,
+    max_batch_size: Optional[int] = None,
+    max_batch_tokens: Optional[int] = None,
+    kv_blocks: Optional[int] = None,
+    kv_bits: Optional[int] = None,
+    kv_group_size: Optional[int] = None,
+    json_schema: Optional[Dict[str, Any]] = None,
+    use_result_cache: bool = True
 ) -> str:
     """
     Generate text from multiple prompts in parallel using MLX models.
     
+    Generation runs as a job on the inference worker. Calls arriving within
+    MLX_COALESCE_WINDOW_MS of each other for the same model, without seed or
+    max_batch_size and with the same prompt formatting and KV cache settings, are
+    decoded as one batch; each call still gets its own job and batch_id.
+    
     Args:
         prompts: List of prompts to generate from
         model_name: Model to use for generation
-        max_tokens: Maximum tokens to generate
-        temperature: Temperature for generation
+        max_tokens: Maximum tokens to generate, shared or one value per prompt
+        temperature: Temperature for generation, shared or one value per prompt
         verbose: Enable verbose output
         format_prompts: Format prompts for chat models
         prompt_type: Type of prompt formatting to apply (currently only "raw" supported)
+        top_p: Nucleus sampling threshold, shared or one value per prompt
+        top_k: Sample only from the top_k most likely tokens (0 disables), shared or
+            one value per prompt
+        min_p: Sample only tokens with at least min_p times the probability of the most
+            likely token (0 disables), shared or one value per prompt
+        seed: Sampling seed, shared or one value per prompt, for reproducible samples.
+            Per-prompt temperature/top_p/top_k/min_p/seed values are sampled in one batch
+            and require max_batch_size to be unset
+        repetition_penalty: Penalty factor for tokens seen in the last 20 tokens
+        frequency_penalty: Subtracted from a token's logit once per occurrence in the
+            last 20 tokens
+        presence_penalty: Subtracted from the logits of tokens seen in the last 20 tokens.
+            Penalties are shared or one value per prompt, and require max_batch_size
+            to be unset
+        max_batch_size: If set, decode at most this many prompts at once with continuous
+            batching, refilling slots as prompts finish
+        max_batch_tokens: If set, group prompts of similar length into batches of at most
+            this many padded prompt tokens (rows x longest prompt)
+        kv_blocks: If set, use a paged KV cache with this many 64-token blocks per layer
+        kv_bits: If set (8 or 4), store the KV cache quantized to this many bits, which
+            fits 2-4x more concurrent rows in the same memory at a small accuracy cost
+        kv_group_size: Values sharing one KV quantization scale (32, 64 or 128, dividing
+            the model's head dimension). Defaults to 64, or 32 for models such as Phi-3
+            whose head dimension is not a multiple of 64
+        json_schema: If set, every response is constrained to a JSON document matching
+            this schema (objects, arrays, strings, numbers, booleans, enums). Requires
+            max_batch_size to be unset
+        use_result_cache: Serve prompts with temperature 0 that were already answered
+            with the same model revision and settings from the result cache instead of
+            generating them again. Fresh greedy responses are cached either way
     
     Returns:
-        JSON string containing the batch generation results
+        JSON string containing the job_id of the queued generation; poll get_job_status
+        for its progress and the batch_id of the stored results
     """
     try:
-        # Load model fresh each time (like demo notebook)
-        logger.info(f"Loading model: {model_name}")
-        model, tokenizer = load(model_name)
-        logger.info(f"Model loaded successfully: {model_name}")
-        
         # Debug: Log the max_tokens parameter
         logger.info(f"batch_generate_text called with max_tokens: {max_tokens}")
         
-        # Apply prompt type formatting
-        formatted_prompts = _format_prompts_by_type(prompts, prompt_type, max_tokens)
-        
-        # Generate responses
-        responses = batch_generate(
-            model,
-            tokenizer,
-            prompts=formatted_prompts,
-            max_tokens=max_tokens,
-            verbose=verbose,
-            temp=temperature,
-            format_prompts=format_prompts
-        )
-        
-        # Generate batch ID for this batch
-        batch_id = f"batch_{datetime.now().strftime('%Y%m%d_%H%M%S_%f')}"
-        
-        # Save all results to database (no results in response)
-        for i, (prompt, response) in enumerate(zip(prompts, responses)):
-            save_generation_result(
-                model_name=model_name,
-                prompt=prompt,
-                response=response,
-                max_tokens=max_tokens,
-                temperature=temperature,
-                prompt_index=i,
-                batch_id=batch_id,
-                is_batch=True
+        if max_batch_size and (
+            repetition_penalty is not None or frequency_penalty or presence_penalty
+        ):
+            raise ValueError("Penalties are not supported with max_batch_size")
+        if max_batch_size and json_schema is not None:
+            raise ValueError("json_schema is not supported with max_batch_size")
+
+        request = {
+            "prompts": prompts,
+            "model_name": model_name,
+            "max_tokens": max_tokens,
+            "temperature": temperature,
+            "verbose": verbose,
+            "format_prompts": format_prompts,
+            "prompt_type": prompt_type,
+            "top_p": top_p,
+            "top_k": top_k,
+            "min_p": min_p,
+            "seed": seed,
+            "repetition_penalty": repetition_penalty,
+            "frequency_penalty": frequency_penalty,
+            "presence_penalty": presence_penalty,
+            "max_batch_size": max_batch_size,
+            "max_batch_tokens": max_batch_tokens,
+            "kv_blocks": kv_blocks,
+            "kv_bits": kv_bits,
+            "kv_group_size": kv_group_size,
+            "json_schema": json_schema,
+            "use_result_cache": use_result_cache
+        }
+        # Concurrent calls with the same batch-wide settings are decoded as one batch;
+        # seeded calls stay alone so their samples do not depend on other requests
+        coalesce_key = None
+        if seed is None and not max_batch_size:
+            coalesce_key = (
+                "batch_generation", model_name, format_prompts, prompt_type,
+                max_batch_tokens, kv_blocks, kv_bits, kv_group_size, verbose
             )
+        job = job_manager.submit(
+            "batch_generation", model_name, request, len(prompts), _run_batch_generation,
+            coalesce_key=coalesce_key
+        )
         
-        # Return only batch_id and status for modular processing
+        # Return only the job handle; the batch_id is reported by get_job_status
         return json.dumps({
-            "status": "success",
+            "status": "queued",
+            "job_id": job.id,
             "model": model_name,
             "total_prompts": len(prompts),
-            "batch_id": batch_id,
-            "message": "Batch processing completed. Use read_batch_results to retrieve results."
+            "message": "Batch generation queued. Use get_job_status to follow it and cancel_job to stop it."
         }, indent=2)
         
     except Exception as e:
@@ -121,6 +368,92 @@ def batch_generate_text(
             "total_prompts": len(prompts)
         }, indent=2)
 
+# Every NER response is constrained to this schema, so it always parses
+NER_ENTITY_TYPES = ["persons", "organizations", "locations", "dates", "misc"]
+NER_SCHEMA = {
+    "type": "object",
+    "properties": {
+        entity_type: {"type": "array", "items": {"type": "string"}}
+        for entity_type in NER_ENTITY_TYPES
+    },
+    "required": NER_ENTITY_TYPES,
+}
+
+def _format_ner_prompt(text: str) -> str:
+    """Instruction asking for the named entities of ``text`` as JSON"""
+    return (
+        "Extract the named entities from the text below. Answer with a JSON object "
+        f"with the keys {', '.join(NER_ENTITY_TYPES)}, each a list of the entities "
+        "of that type exactly as they appear in the text.\n\n"
+        f"Text: {text}"
+    )
+
+def _run_ner(jobs: List[Job], progress) -> List[Optional[Dict[str, Any]]]:
+    """
+    Extract the entities of one or more coalesced batch_ner_processing jobs in one
+    batch and store every job's responses under its own batch_id.
+    
+    Args:
+        jobs: Jobs sharing the model and prompt formatting
+        progress: Per-row progress callback, see jobs.JobManager
+    
+    Returns:
+        The result of every job, None for jobs cancelled meanwhile
+    """
+    request = jobs[0].request
+    model_name = request["model_name"]
+    model, tokenizer = model_registry.get(model_name)
+    
+    texts = [text for job in jobs for text in job.request["texts"]]
+    responses = batch_generate(
+        model,
+        tokenizer,
+        prompts=[_format_ner_prompt(text) for text in texts],
+        max_tokens=_merge_rows(jobs, "max_tokens"),
+        verbose=request["verbose"],
+        temp=_merge_rows(jobs, "temperature"),
+        format_prompts=request["format_prompts"],
+        prompt_cache=prompt_cache,
+        prompt_cache_key=model_name,
+        json_schema=NER_SCHEMA,
+        progress=progress
+    )
+    
+    results, start = [], 0
+    for job in jobs:
+        job_responses = responses[start:start + job.total_rows]
+        start += job.total_rows
+        if job.cancelled:
+            results.append(None)
+            continue
+        
+        batch_id = f"ner_batch_{datetime.now().strftime('%Y%m%d_%H%M%S_%f')}"
+        
+        # Responses are stored as the extracted JSON, keyed by the original text
+        truncated = 0
+        for response in job_responses:
+            try:
+                json.loads(response)
+            except json.JSONDecodeError:
+                truncated += 1
+        job.stored = queue_generation_results([{
+            "model_name": model_name,
+            "prompt": text,
+            "response": response,
+            "max_tokens": job.request["max_tokens"],
+            "temperature": job.request["temperature"],
+            "prompt_index": i,
+            "batch_id": batch_id,
+            "is_batch": True
+        } for i, (text, response) in enumerate(zip(job.request["texts"], job_responses))])
+        
+        results.append({
+            "batch_id": batch_id,
+            "truncated": truncated,
+            "message": "NER processing completed. Use read_batch_results to retrieve the entities."
+        })
+    return results
+
 @app.tool()
 def batch_ner_processing(
     texts: List[str],
@@ -131,9 +464,11 @@ def batch_ner_processing(
     format_prompts: bool = True
 ) -> str:
     """
-    Named Entity Recognition batch processing - STUB IMPLEMENTATION
+    Named Entity Recognition batch processing
     
-    This function will process texts for NER extraction (entities, locations, persons, etc.)
+    Extracts persons, organizations, locations, dates and other entities from every
+    text. Decoding is constrained to NER_SCHEMA, so each response is a JSON object
+    unless it hits max_tokens first.
     
     Args:
         texts: List of text content to process for NER
@@ -144,22 +479,30 @@ def batch_ner_processing(
         format_prompts: Format prompts for chat models
     
     Returns:
-        JSON string containing batch_id and status (results retrieved separately)
+        JSON string containing the job_id of the queued processing; get_job_status
+        reports the batch_id once it completed (results retrieved separately)
     """
     try:
-        # TODO: Implement NER-specific prompt formatting
-        # TODO: Implement NER-specific result processing
-        # TODO: Implement NER-specific database storage
-        
-        # For now, return stub response
-        batch_id = f"ner_batch_{datetime.now().strftime('%Y%m%d_%H%M%S_%f')}"
+        request = {
+            "texts": texts,
+            "model_name": model_name,
+            "max_tokens": max_tokens,
+            "temperature": temperature,
+            "verbose": verbose,
+            "format_prompts": format_prompts
+        }
+        job = job_manager.submit(
+            "ner", model_name, request, len(texts), _run_ner,
+            coalesce_key=("ner", model_name, format_prompts, verbose)
+        )
         
         return json.dumps({
-            "status": "stub_implementation",
+            "status": "queued",
             "processing_type": "ner",
+            "job_id": job.id,
+            "model": model_name,
             "total_texts": len(texts),
-            "batch_id": batch_id,
-            "message": "NER batch processing - stub implementation. Persistence schema to be decided."
+            "message": "NER processing queued. Use get_job_status to follow it and cancel_job to stop it."
         }, indent=2)
     
     except Exception as e:
@@ -171,26 +514,115 @@ def batch_ner_processing(
             "total_texts": len(texts)
         }, indent=2)
 
+@app.tool()
+def get_job_status(job_id: str) -> str:
+    """
+    Get the status and progress of a generation job.
+    
+    Args:
+        job_id: Job ID returned by batch_generate_text or batch_ner_processing
+    
+    Returns:
+        JSON string containing the job status (queued, running, completed, failed or
+        cancelled), its progress (tokens generated, rows finished of total rows), and
+        once completed its result with the batch_id for read_batch_results
+    """
+    try:
+        job = job_manager.get(job_id)
+        if job is None:
+            return json.dumps({
+                "status": "error",
+                "error": f"Unknown job: {job_id}"
+            }, indent=2)
+        return json.dumps(job.to_dict(), indent=2)
+    
+    except Exception as e:
+        logger.error(f"Error in get_job_status: {e}")
+        return json.dumps({
+            "status": "error",
+            "error": str(e)
+        }, indent=2)
+
+@app.tool()
+def list_jobs() -> str:
+    """
+    List the queued, running and recently finished generation jobs.
+    
+    Returns:
+        JSON string containing the jobs, most recently submitted first, and the number
+        of jobs in every status
+    """
+    try:
+        return json.dumps({
+            "status": "success",
+            "counts": job_manager.stats(),
+            "jobs": [job.to_dict() for job in job_manager.list()]
+        }, indent=2)
+    
+    except Exception as e:
+        logger.error(f"Error in list_jobs: {e}")
+        return json.dumps({
+            "status": "error",
+            "error": str(e)
+        }, indent=2)
+
+@app.tool()
+def cancel_job(job_id: str) -> str:
+    """
+    Cancel a generation job. A queued job never starts, a running one stores no
+    results. Its batch stops after the current decode step unless it was coalesced
+    with other jobs that are still running.
+    
+    Args:
+        job_id: Job ID returned by batch_generate_text or batch_ner_processing
+    
+    Returns:
+        JSON string containing the job status after the request
+    """
+    try:
+        job = job_manager.cancel(job_id)
+        if job is None:
+            return json.dumps({
+                "status": "error",
+                "error": f"Unknown job: {job_id}"
+            }, indent=2)
+        return json.dumps({
+            **job.to_dict(),
+            "cancel_requested": job.cancel_requested.is_set()
+        }, indent=2)
+    
+    except Exception as e:
+        logger.error(f"Error in cancel_job: {e}")
+        return json.dumps({
+            "status": "error",
+            "error": str(e)
+        }, indent=2)
+
 @app.tool()
 def get_model_info() -> str:
     """
-    Get information about the currently loaded model.
+    Get information about the models resident in the server.
     
     Returns:
-        JSON string containing model information
+        JSON string containing resident models, their sizes and cache hit/miss stats,
+        and the size and hit rate of the prompt-prefix KV cache
     """
     try:
-        if model_cache["current_model_name"] is None:
+        stats = model_registry.stats()
+        stats["prompt_cache"] = prompt_cache.stats()
+        stats["jobs"] = job_manager.stats()
+        stats["result_cache"] = result_cache.stats()
+        if not stats["resident_models"]:
             return json.dumps({
                 "status": "no_model_loaded",
-                "message": "No model is currently loaded"
+                "message": "No model is currently loaded",
+                **stats
             }, indent=2)
         
         return json.dumps({
             "status": "model_loaded",
-            "model_name": model_cache["current_model_name"],
-            "model_loaded": model_cache["model"] is not None,
-            "tokenizer_loaded": model_cache["tokenizer"] is not None
+            "model_name": stats["resident_models"][0]["model_name"],
+            **stats
         }, indent=2)
         
     except Exception as e:
@@ -200,55 +632,72 @@ def get_model_info() -> str:
             "status": "error"
         }, indent=2)
 
+def _next_cursor(results: List[Dict[str, Any]], limit: Optional[int]) -> Optional[int]:
+    """after_id of the next page, or None once the last page was read"""
+    if limit is None or len(results) < limit:
+        return None
+    return results[-1]["id"]
+
 @app.tool()
 def read_batch_results(
     batch_id: str = None,
     model_name: str = None,
-    limit: int = 10
+    limit: Optional[int] = None,
+    after_id: Optional[int] = None
 ) -> str:
     """
     Read batch generation results from SQLite database.
     
+    Results are paginated with a cursor: pass the next_cursor of a response as
+    after_id to get the page that follows it. next_cursor is null on the last page.
+    
     Args:
-        batch_id: Specific batch ID to fetch results for
-        model_name: Filter results by model name
-        limit: Maximum number of results to return (default: 10)
+        batch_id: Specific batch ID to fetch results for, in prompt order
+        model_name: Filter results by model name, newest first
+        limit: Maximum number of results to return (default: 10, or the whole batch
+            for batch_id)
+        after_id: Cursor, return the results following the result with this id
     
     Returns:
-        JSON string containing the query results
+        JSON string containing the query results and the next_cursor
     """
     try:
         if batch_id:
             # Get results for specific batch
-            results = get_batch_results(batch_id)
+            results = get_batch_results(batch_id, limit, after_id)
             return json.dumps({
                 "status": "success",
                 "query_type": "batch_results",
                 "batch_id": batch_id,
+                "limit": limit,
                 "total_results": len(results),
+                "next_cursor": _next_cursor(results, limit),
                 "results": results
             }, indent=2)
         
-        elif model_name:
+        limit = 10 if limit is None else limit
+        if model_name:
             # Get results for specific model
-            results = get_results_by_model(model_name, limit)
+            results = get_results_by_model(model_name, limit, after_id)
             return json.dumps({
                 "status": "success",
                 "query_type": "model_results",
                 "model_name": model_name,
                 "limit": limit,
                 "total_results": len(results),
+                "next_cursor": _next_cursor(results, limit),
                 "results": results
             }, indent=2)
         
         else:
             # Get recent results
-            results = get_recent_results(limit)
+            results = get_recent_results(limit, after_id)
             return json.dumps({
                 "status": "success",
                 "query_type": "recent_results",
                 "limit": limit,
                 "total_results": len(results),
+                "next_cursor": _next_cursor(results, limit),
                 "results": results
             }, indent=2)
     
@@ -259,6 +708,52 @@ def read_batch_results(
             "error": str(e)
         }, indent=2)
 
+@app.tool()
+def export_batch_results(
+    batch_id: str = None,
+    model_name: str = None,
+    format: str = "jsonl",
+    path: Optional[str] = None,
+    overwrite: bool = False
+) -> str:
+    """
+    Export results from the SQLite database to a file on the server's disk.
+    
+    Unlike read_batch_results, the results are streamed from the database in
+    chunks and never sent through the response, so batches of any size export
+    in bounded memory. Only the file path and the row count are returned.
+    
+    Args:
+        batch_id: Specific batch ID to export, in prompt order
+        model_name: Export the results of this model, newest first (all results
+            without batch_id and model_name)
+        format: "jsonl" (one result object per line) or "parquet" (requires pyarrow)
+        path: Output file relative to MLX_EXPORT_DIR (default: exports/ next to the
+            database); absolute paths, ~ and .. are rejected. Default file name from
+            the batch or model and the time
+        overwrite: Replace an existing file at path instead of failing
+    
+    Returns:
+        JSON string containing the path of the exported file and the number of rows
+    """
+    try:
+        path, rows = export_results(path, format, batch_id, model_name, overwrite=overwrite)
+        return json.dumps({
+            "status": "success",
+            "query_type": "batch_results" if batch_id else "model_results" if model_name else "recent_results",
+            "format": format,
+            "path": path,
+            "total_results": rows,
+            "message": f"Exported {rows} results to {path}"
+        }, indent=2)
+    
+    except Exception as e:
+        logger.error(f"Error in export_batch_results: {e}")
+        return json.dumps({
+            "status": "error",
+            "error": str(e)
+        }, indent=2)
+
 if __name__ == "__main__":
     logger.info("Starting MLX MCP Server with FastMCP...")
     # Initialize database
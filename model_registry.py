@@ -0,0 +1,237 @@
+#!/usr/bin/env python3
+"""
+Model registry for MLX MCP Server
+Keeps loaded (model, tokenizer) pairs resident between tool calls and evicts
+the least recently used ones once their parameters exceed a byte budget
+"""
+
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Any, Callable, Dict, Hashable, Optional, Tuple
+
+import mlx.nn as nn
+from mlx.utils import tree_flatten
+from mlx_lm.tokenizer_utils import TokenizerWrapper
+
+from utils import get_model_path, load
+
+logger = logging.getLogger(__name__)
+
+# Registry configuration - byte budget for resident model parameters
+MAX_RESIDENT_GB = float(os.environ.get("MLX_MODEL_CACHE_GB", "16"))
+
+
+def model_nbytes(model: nn.Module) -> int:
+    """Total size in bytes of the model parameters (quantized scales included)"""
+    return sum(v.nbytes for _, v in tree_flatten(model.parameters()))
+
+
+def model_revision(model_path: Path) -> str:
+    """
+    Identifies the weights in a resolved model directory: the commit hash of
+    a Hub snapshot, or for a local directory a digest of the names, sizes and
+    modification times of its files
+    """
+    model_path = Path(model_path)
+    if model_path.parent.name == "snapshots":
+        return model_path.name
+    h = hashlib.sha256()
+    for path in sorted(model_path.iterdir()):
+        if path.is_file():
+            stat = path.stat()
+            h.update(f"{path.name}:{stat.st_size}:{stat.st_mtime_ns}\0".encode("utf-8"))
+    return h.hexdigest()[:16]
+
+
+def _format_time(ts: float) -> str:
+    return time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(ts))
+
+
+@dataclass
+class ResidentModel:
+    model: nn.Module
+    tokenizer: TokenizerWrapper
+    nbytes: int
+    load_time: float
+    revision: Optional[str] = None
+    loaded_at: float = field(default_factory=time.time)
+    last_used: float = field(default_factory=time.time)
+    hits: int = 0
+
+
+class ModelRegistry:
+    """
+    Process-wide LRU cache of loaded models.
+
+    Entries are keyed by ``(model path, revision, adapter path, model_config)``
+    and kept in least- to most-recently-used order. After every load the
+    oldest entries are dropped until the resident parameters fit in
+    ``max_bytes``; the entry that was just loaded is never evicted, so a
+    single model larger than the budget still stays resident.
+    """
+
+    def __init__(
+        self,
+        max_bytes: int = int(MAX_RESIDENT_GB * (1 << 30)),
+        loader: Callable[..., Tuple[nn.Module, TokenizerWrapper]] = load,
+    ):
+        self.max_bytes = max_bytes
+        self._loader = loader
+        self._entries: "OrderedDict[Hashable, ResidentModel]" = OrderedDict()
+        # keys being loaded, set once their load finished or failed
+        self._loading: Dict[Hashable, threading.Event] = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @staticmethod
+    def make_key(
+        model_name: str,
+        revision: Optional[str] = None,
+        adapter_path: Optional[str] = None,
+        model_config: Optional[Dict[str, Any]] = None,
+    ) -> Tuple[str, Optional[str], Optional[str], str]:
+        config_key = json.dumps(model_config or {}, sort_keys=True, default=str)
+        return (model_name, revision, adapter_path, config_key)
+
+    @property
+    def resident_bytes(self) -> int:
+        return sum(entry.nbytes for entry in self._entries.values())
+
+    def get(
+        self,
+        model_name: str,
+        revision: Optional[str] = None,
+        adapter_path: Optional[str] = None,
+        model_config: Optional[Dict[str, Any]] = None,
+    ) -> Tuple[nn.Module, TokenizerWrapper]:
+        """
+        Return the resident model and tokenizer for the key, loading on a miss.
+
+        Models load outside the registry lock, so lookups and stats of other
+        models never wait for a load. Concurrent calls for a key that is being
+        loaded wait for that load instead of loading the model twice.
+        """
+        key = self.make_key(model_name, revision, adapter_path, model_config)
+        while True:
+            with self._lock:
+                entry = self._entries.get(key)
+                if entry is not None:
+                    self._entries.move_to_end(key)
+                    entry.hits += 1
+                    entry.last_used = time.time()
+                    self.hits += 1
+                    return entry.model, entry.tokenizer
+                loading = self._loading.get(key)
+                if loading is None:
+                    loading = self._loading[key] = threading.Event()
+                    self.misses += 1
+                    break
+            # resident once the other load finished; if it failed, load again
+            loading.wait()
+
+        try:
+            logger.info(f"Loading model: {model_name}")
+            tic = time.perf_counter()
+            model_path = get_model_path(model_name, revision=revision)
+            model, tokenizer = self._loader(
+                str(model_path),
+                model_config=model_config or {},
+                adapter_path=adapter_path,
+                revision=revision,
+            )
+            entry = ResidentModel(
+                model=model,
+                tokenizer=tokenizer,
+                nbytes=model_nbytes(model),
+                load_time=time.perf_counter() - tic,
+                revision=model_revision(model_path),
+            )
+            with self._lock:
+                self._entries[key] = entry
+                self._evict_over_budget()
+            logger.info(
+                f"Model loaded: {model_name} ({entry.nbytes / (1 << 20):.1f} MiB "
+                f"in {entry.load_time:.2f}s)"
+            )
+            return model, tokenizer
+        finally:
+            with self._lock:
+                del self._loading[key]
+            loading.set()
+
+    def revision(
+        self,
+        model_name: str,
+        revision: Optional[str] = None,
+        adapter_path: Optional[str] = None,
+        model_config: Optional[Dict[str, Any]] = None,
+    ) -> Optional[str]:
+        """Revision of the resident model for the key (see model_revision), loading on a miss"""
+        key = self.make_key(model_name, revision, adapter_path, model_config)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                return entry.revision
+        self.get(model_name, revision, adapter_path, model_config)
+        with self._lock:
+            entry = self._entries.get(key)
+            return entry.revision if entry is not None else None
+
+    def _evict_over_budget(self):
+        while len(self._entries) > 1 and self.resident_bytes > self.max_bytes:
+            key, entry = self._entries.popitem(last=False)
+            self.evictions += 1
+            logger.info(
+                f"Evicted model: {key[0]} ({entry.nbytes / (1 << 20):.1f} MiB)"
+            )
+        if self.resident_bytes > self.max_bytes:
+            logger.warning(
+                f"Resident model exceeds the registry budget of {self.max_bytes} bytes"
+            )
+
+    def clear(self):
+        with self._lock:
+            self.evictions += len(self._entries)
+            self._entries.clear()
+
+    def stats(self) -> Dict[str, Any]:
+        """Residency, size and hit/miss counters for reporting"""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "resident_models": [
+                    {
+                        "model_name": key[0],
+                        "requested_revision": key[1],
+                        "adapter_path": key[2],
+                        "model_config": json.loads(key[3]),
+                        "size_bytes": entry.nbytes,
+                        "load_time_s": round(entry.load_time, 3),
+                        "resolved_revision": entry.revision,
+                        "loaded_at": _format_time(entry.loaded_at),
+                        "last_used": _format_time(entry.last_used),
+                        "hits": entry.hits,
+                    }
+                    # most recently used first
+                    for key, entry in reversed(self._entries.items())
+                ],
+                "resident_bytes": self.resident_bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+            }
+
+
+# Shared by all tools in the server process
+model_registry = ModelRegistry()
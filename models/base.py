@@ -2,6 +2,7 @@ import inspect
 from dataclasses import dataclass
 
 import mlx.core as mx
+from mlx.utils import tree_map
 
 def create_additive_causal_mask(N: int, offset: int = 0):
     rinds = mx.arange(offset + N)
@@ -9,19 +10,43 @@ def create_additive_causal_mask(N: int, offset: int = 0):
     mask = linds[:, None] < rinds[None]
     return mask * -1e9
 
+
+def create_attention_mask(h: mx.array, cache=None):
+    """
+    Additive attention mask for the hidden states ``h`` of shape ``(B, N, D)``.
+
+    Without a cache this is the plain causal mask (``None`` for a single
+    token). With a list of per-layer caches the mask also hides each row's
+    left padding, see :meth:`BatchedKVCache.make_mask`; it is computed once
+    and shared by every layer.
+    """
+    N = h.shape[1]
+    if cache is not None and cache[0] is not None:
+        return cache[0].make_mask(N, h.dtype)
+    if N > 1:
+        return create_additive_causal_mask(N).astype(h.dtype)
+    return None
+
 class BatchedKVCache:
 
-    def __init__(self, head_dim, n_kv_heads, batch_size=1):
+    def __init__(self, head_dim, n_kv_heads, batch_size=1, offset=0, left_padding=None):
         self.n_kv_heads = n_kv_heads
         self.head_dim = head_dim
         self.batch_size = batch_size
         self.keys = None
         self.values = None
-        self.offset = 0
+        # RoPE position of the next token. It only matches the number of
+        # cached positions (``length``) until rows are merged or trimmed.
+        self.offset = offset
+        self.length = 0
+        # number of leading cached positions that are padding, per row
+        self.left_padding = list(left_padding) if left_padding is not None else [0] * batch_size
         self.step = 256
+        # additive mask over cached positions, reused across decode steps
+        self._key_mask = None
 
     def update_and_fetch(self, keys, values):
-        prev = self.offset
+        prev = self.length
         if self.keys is None or (prev + keys.shape[2]) > self.keys.shape[2]:
             n_steps = (self.step + keys.shape[2] - 1) // self.step
             shape = (self.batch_size, self.n_kv_heads, n_steps * self.step, self.head_dim)
@@ -37,9 +62,458 @@ class BatchedKVCache:
                 self.keys, self.values = new_k, new_v
 
         self.offset += keys.shape[2]
-        self.keys[..., prev : self.offset, :] = keys
-        self.values[..., prev : self.offset, :] = values
-        return self.keys[..., : self.offset, :], self.values[..., : self.offset, :]
+        self.length += keys.shape[2]
+        self.keys[..., prev : self.length, :] = keys
+        self.values[..., prev : self.length, :] = values
+        return self.keys[..., : self.length, :], self.values[..., : self.length, :]
+
+    @property
+    def state(self):
+        """The cached keys and values, e.g. to keep a prefilled prefix around."""
+        return tree_map(lambda x: x[..., : self.length, :], (self.keys, self.values))
+
+    @state.setter
+    def state(self, v):
+        """Restore an unpadded cache starting at RoPE position 0."""
+        self.keys, self.values = v
+        self.batch_size = self.keys.shape[0]
+        self.offset = self.length = self.keys.shape[2]
+        self.left_padding = [0] * self.batch_size
+        self._key_mask = None
+
+    def make_mask(self, N, dtype=mx.float32):
+        """
+        Additive mask for ``N`` new queries attending to the cached positions
+        plus themselves.
+
+        Combines the causal mask with each row's left padding. Padding queries
+        still attend to themselves so no row of the mask is fully masked. For
+        single-token decode steps the padding mask only depends on the cached
+        positions, so it is built once per ``step`` positions and sliced on
+        later calls.
+        """
+        padded = any(self.left_padding)
+        if N == 1:
+            if not padded:
+                return None
+            total = self.length + 1
+            if self._key_mask is None or self._key_mask.shape[-1] < total:
+                capacity = ((total + self.step - 1) // self.step) * self.step
+                positions = mx.arange(capacity)[None]
+                left_padding = mx.array(self.left_padding)[:, None]
+                mask = (positions < left_padding) * -1e9
+                self._key_mask = mask[:, None, None, :].astype(dtype)
+            return self._key_mask[..., :total]
+
+        mask = create_additive_causal_mask(N, self.length)
+        if padded:
+            queries = mx.arange(self.length, self.length + N)[:, None]
+            keys = mx.arange(self.length + N)[None]
+            left_padding = mx.array(self.left_padding)[:, None, None]
+            hidden = (keys < left_padding) & (keys != queries)
+            mask = mask + (hidden * -1e9)[:, None]
+        return mask.astype(dtype)
+
+    def filter(self, rows):
+        """Keep only the given batch rows, in the given order."""
+        rows = list(rows)
+        idx = mx.array(rows, dtype=mx.int32)
+        self.keys, self.values = tree_map(lambda x: x[idx], (self.keys, self.values))
+        self.left_padding = [self.left_padding[i] for i in rows]
+        self.batch_size = len(rows)
+        self._key_mask = None
+        self.trim(min(self.left_padding, default=0))
+
+    def trim(self, n):
+        """Drop the first ``n`` cached positions, which must be padding in every row."""
+        if n <= 0:
+            return
+        self.keys, self.values = tree_map(
+            lambda x: x[..., n : self.length, :], (self.keys, self.values)
+        )
+        self.length -= n
+        self.left_padding = [p - n for p in self.left_padding]
+        self._key_mask = None
+
+    def rewind(self, n):
+        """
+        Drop the last ``n`` cached positions of every row, e.g. draft tokens
+        rejected by speculative decoding. Their keys and values are
+        overwritten by the next update.
+        """
+        if n <= 0:
+            return
+        self.offset -= n
+        self.length -= n
+
+    def extend(self, other):
+        """
+        Append the rows of ``other`` to this cache.
+
+        Both caches must be at the same RoPE ``offset``. The shorter one is
+        left-padded so that the last cached position of every row lines up.
+        """
+        if other.offset != self.offset:
+            raise ValueError(
+                f"Cannot merge caches at offsets {self.offset} and {other.offset}"
+            )
+        length = max(self.length, other.length)
+
+        def _aligned(cache):
+            pad = length - cache.length
+            widths = [(0, 0), (0, 0), (pad, 0), (0, 0)]
+            kv = tree_map(
+                lambda x: mx.pad(x[..., : cache.length, :], widths),
+                (cache.keys, cache.values),
+            )
+            return kv, [p + pad for p in cache.left_padding]
+
+        kv, left_padding = _aligned(self)
+        other_kv, other_left_padding = _aligned(other)
+        self.keys, self.values = tree_map(
+            lambda x, y: mx.concatenate([x, y], axis=0), kv, other_kv
+        )
+        self.left_padding = left_padding + other_left_padding
+        self.batch_size += other.batch_size
+        self.length = length
+        self._key_mask = None
+
+    def repeat(self, batch_size):
+        """Copy a single-row cache into ``batch_size`` identical rows."""
+        self.keys, self.values = tree_map(
+            lambda x: mx.repeat(x[..., : self.length, :], batch_size, axis=0),
+            (self.keys, self.values),
+        )
+        self.left_padding = self.left_padding * batch_size
+        self.batch_size = batch_size
+        self._key_mask = None
+
+    def move_padding_left(self, right_padding, rope):
+        """
+        Turn trailing per-row padding into left padding.
+
+        Row ``r`` is rolled right by ``right_padding[r]`` positions so that its
+        trailing padding moves to the front, and its keys are rotated forward
+        by the same number of positions with ``rope`` (the layer's
+        ``nn.RoPE``) so that RoPE positions match cached positions again.
+        """
+        L = self.length
+        keys, values = self.keys[..., :L, :], self.values[..., :L, :]
+        shifts = mx.array(right_padding)[:, None, None, None]
+        idx = mx.broadcast_to((mx.arange(L)[None, None, :, None] - shifts) % L, keys.shape)
+        keys = mx.take_along_axis(keys, idx, axis=2)
+        values = mx.take_along_axis(values, idx, axis=2)
+
+        _, H, _, D = keys.shape
+        for shift in sorted(set(right_padding) - {0}):
+            rows = [r for r, p in enumerate(right_padding) if p == shift]
+            idx = mx.array(rows)
+            # a length-1 "sequence" at ``offset=shift`` rotates every key by ``shift``
+            shifted = rope(keys[idx].reshape(len(rows), H * L, 1, D), offset=shift)
+            keys[idx] = shifted.reshape(len(rows), H, L, D)
+
+        self.keys, self.values = keys, values
+        self.left_padding = [p + s for p, s in zip(self.left_padding, right_padding)]
+        self._key_mask = None
+
+
+class BlockPool:
+    """
+    Fixed-size KV blocks shared by the paged caches of one layer.
+
+    Storage is a flat array of ``num_blocks * block_size`` token slots,
+    allocated on the first write. Block 0 is never handed out: positions that
+    hold no data (left padding) are mapped to it.
+    """
+
+    def __init__(self, num_blocks, block_size=64):
+        if num_blocks < 2:
+            raise ValueError(f"A block pool needs at least 2 blocks, got {num_blocks}")
+        self.num_blocks = num_blocks
+        self.block_size = block_size
+        self.keys = None
+        self.values = None
+        self._free = list(range(num_blocks - 1, 0, -1))
+
+    @property
+    def num_free(self):
+        return len(self._free)
+
+    @property
+    def num_used(self):
+        return self.num_blocks - 1 - len(self._free)
+
+    def allocate(self):
+        if not self._free:
+            raise RuntimeError(
+                f"KV block pool exhausted ({self.num_blocks} blocks of {self.block_size} tokens)"
+            )
+        return self._free.pop()
+
+    def release(self, blocks):
+        self._free.extend(blocks)
+
+
+class PagedKVCache(BatchedKVCache):
+    """
+    Batched KV cache backed by blocks of a shared :class:`BlockPool`.
+
+    Each row owns a block table covering only its real tokens, so rows of
+    different lengths do not reserve the padded length, and growing the cache
+    allocates blocks instead of copying it. Cached position ``c`` of row ``r``
+    is token ``c - left_padding[r]`` of that row; padding positions map to the
+    reserved block 0 and are hidden by :meth:`make_mask`. Since no data is
+    stored for padding, ``extend`` and ``trim`` only adjust bookkeeping.
+    """
+
+    def __init__(self, pool, head_dim, n_kv_heads, batch_size=1, offset=0, left_padding=None):
+        super().__init__(head_dim, n_kv_heads, batch_size, offset, left_padding)
+        self.pool = pool
+        self.block_tables = [[] for _ in range(batch_size)]
+        # device copies of the block tables and left padding, rebuilt only
+        # when a block is allocated or rows change, and the pool slots of
+        # all cached positions, extended by the slots of every new token
+        self._tables = None
+        self._padding = None
+        self._cached_slots = None
+
+    def _slots(self, start, end):
+        """Pool slot of every row for cached positions ``start:end``, shape ``(B, end - start)``."""
+        block_size = self.pool.block_size
+        if self._tables is None:
+            width = max((len(t) for t in self.block_tables), default=0) or 1
+            self._tables = mx.array([t + [0] * (width - len(t)) for t in self.block_tables])
+        if self._padding is None:
+            self._padding = mx.array(self.left_padding)[:, None]
+        tokens = mx.arange(start, end)[None] - self._padding
+        valid = tokens >= 0
+        tokens = mx.maximum(tokens, 0)
+        blocks = mx.take_along_axis(self._tables, tokens // block_size, axis=1)
+        return mx.where(valid, blocks * block_size + tokens % block_size, 0)
+
+    def _invalidate(self):
+        self._tables = None
+        self._padding = None
+        self._cached_slots = None
+        self._key_mask = None
+
+    def update_and_fetch(self, keys, values):
+        B, _, N, _ = keys.shape
+        pool = self.pool
+        if pool.keys is None:
+            shape = (pool.num_blocks * pool.block_size, self.n_kv_heads, self.head_dim)
+            pool.keys = mx.zeros(shape, keys.dtype)
+            pool.values = mx.zeros(shape, values.dtype)
+
+        prev = self.length
+        self.offset += N
+        self.length += N
+        for table, padding in zip(self.block_tables, self.left_padding):
+            n_tokens = max(self.length - padding, 0)
+            while len(table) * pool.block_size < n_tokens:
+                table.append(pool.allocate())
+                self._tables = None
+
+        new_slots = self._slots(prev, self.length)
+        flat = new_slots.reshape(-1)
+        pool.keys[flat] = keys.transpose(0, 2, 1, 3).reshape(B * N, self.n_kv_heads, -1)
+        pool.values[flat] = values.transpose(0, 2, 1, 3).reshape(B * N, self.n_kv_heads, -1)
+
+        # gather every row's cached positions through its block table
+        if self._cached_slots is None:
+            self._cached_slots = self._slots(0, self.length)
+        else:
+            self._cached_slots = mx.concatenate([self._cached_slots, new_slots], axis=1)
+        slots = self._cached_slots
+        return (
+            pool.keys[slots].transpose(0, 2, 1, 3),
+            pool.values[slots].transpose(0, 2, 1, 3),
+        )
+
+    def filter(self, rows):
+        rows = list(rows)
+        kept = set(rows)
+        for i, table in enumerate(self.block_tables):
+            if i not in kept:
+                self.pool.release(table)
+        self.block_tables = [self.block_tables[i] for i in rows]
+        self.left_padding = [self.left_padding[i] for i in rows]
+        self.batch_size = len(rows)
+        self._invalidate()
+        self.trim(min(self.left_padding, default=0))
+
+    def trim(self, n):
+        if n <= 0:
+            return
+        self.length -= n
+        self.left_padding = [p - n for p in self.left_padding]
+        # positions shift along with the padding, so the slots stay valid
+        if self._cached_slots is not None:
+            self._cached_slots = self._cached_slots[:, n:]
+        self._padding = None
+        self._key_mask = None
+
+    def rewind(self, n):
+        super().rewind(n)
+        if n > 0 and self._cached_slots is not None:
+            self._cached_slots = self._cached_slots[:, : self.length]
+
+    def extend(self, other):
+        if other.pool is not self.pool:
+            raise ValueError("Cannot merge paged caches backed by different block pools")
+        if other.offset != self.offset:
+            raise ValueError(
+                f"Cannot merge caches at offsets {self.offset} and {other.offset}"
+            )
+        length = max(self.length, other.length)
+        self.left_padding = [p + length - self.length for p in self.left_padding] + [
+            p + length - other.length for p in other.left_padding
+        ]
+        self.block_tables = self.block_tables + other.block_tables
+        self.batch_size += other.batch_size
+        self.length = length
+        self._invalidate()
+
+
+class QuantizedKVCache(BatchedKVCache):
+    """
+    Batched KV cache storing keys and values as grouped-quantized blocks.
+
+    Keys and values are quantized with :func:`mx.quantize` as they are added,
+    so each cached position takes ``bits / 16`` of its float16 size plus one
+    scale and bias per ``group_size`` values. The cached positions are
+    dequantized when fetched for attention. ``keys`` and ``values`` are
+    ``(weights, scales, biases)`` tuples, which the row operations inherited
+    from :class:`BatchedKVCache` handle alike.
+    """
+
+    def __init__(
+        self, head_dim, n_kv_heads, batch_size=1, offset=0, left_padding=None,
+        group_size=64, bits=8,
+    ):
+        super().__init__(head_dim, n_kv_heads, batch_size, offset, left_padding)
+        self.group_size = group_size
+        self.bits = bits
+
+    def update_and_fetch(self, keys, values):
+        B, _, N, _ = keys.shape
+        prev = self.length
+        if self.keys is None or (prev + N) > self.keys[0].shape[2]:
+            n_steps = (self.step + N - 1) // self.step
+            el_per_int = 32 // self.bits
+            shape = (B, self.n_kv_heads, n_steps * self.step)
+
+            def _empty(dtype):
+                return (
+                    mx.zeros((*shape, self.head_dim // el_per_int), mx.uint32),
+                    mx.zeros((*shape, self.head_dim // self.group_size), dtype),
+                    mx.zeros((*shape, self.head_dim // self.group_size), dtype),
+                )
+
+            new_k, new_v = _empty(keys.dtype), _empty(values.dtype)
+            if self.keys is not None:
+                self.keys, self.values = tree_map(
+                    lambda x, y: mx.concatenate([x[..., :prev, :], y], axis=2),
+                    (self.keys, self.values),
+                    (new_k, new_v),
+                )
+            else:
+                self.keys, self.values = new_k, new_v
+
+        self.offset += N
+        self.length += N
+        for cached, new in (
+            (self.keys, mx.quantize(keys, self.group_size, self.bits)),
+            (self.values, mx.quantize(values, self.group_size, self.bits)),
+        ):
+            for c, n in zip(cached, new):
+                c[..., prev : self.length, :] = n
+        return tuple(
+            mx.dequantize(
+                *(x[..., : self.length, :] for x in cached),
+                group_size=self.group_size,
+                bits=self.bits,
+            )
+            for cached in (self.keys, self.values)
+        )
+
+
+# Group sizes supported by mx.quantize
+QUANTIZATION_GROUP_SIZES = (128, 64, 32)
+
+
+def quantization_group_size(head_dim, group_size=None):
+    """
+    Group size for quantizing ``head_dim`` values: ``group_size`` if given,
+    else ``64`` or the largest smaller supported size dividing ``head_dim``.
+    """
+    if group_size is None:
+        group_size = next(
+            (g for g in QUANTIZATION_GROUP_SIZES if g <= 64 and head_dim % g == 0), None
+        )
+        if group_size is None:
+            raise ValueError(
+                f"Cannot quantize the KV cache: head dimension {head_dim} is not "
+                f"a multiple of any of the group sizes {QUANTIZATION_GROUP_SIZES}"
+            )
+    elif group_size not in QUANTIZATION_GROUP_SIZES or head_dim % group_size:
+        raise ValueError(
+            f"KV group size {group_size} must be one of {QUANTIZATION_GROUP_SIZES} "
+            f"and divide the head dimension {head_dim}"
+        )
+    return group_size
+
+
+def make_cache(
+    model, batch_size=1, offset=0, left_padding=None, block_pools=None, kv_bits=None,
+    kv_group_size=None,
+):
+    """
+    Create one batched KV cache per layer of ``model``.
+
+    Args:
+        model: The model, providing ``layers``, ``head_dim`` and ``n_kv_heads``.
+        batch_size (int): Number of rows. Default: ``1``.
+        offset (int): RoPE position of the first token. Default: ``0``.
+        left_padding (List[int], optional): Leading padding tokens per row.
+        block_pools (List[BlockPool], optional): One pool per layer. If given
+            the caches are :class:`PagedKVCache` objects drawing from them.
+        kv_bits (int, optional): If set (``8`` or ``4``), the caches are
+            :class:`QuantizedKVCache` objects storing this many bits per value.
+        kv_group_size (int, optional): Values sharing one quantization scale
+            and bias, one of ``32``, ``64`` or ``128`` dividing the head
+            dimension. Default: ``64``, or ``32`` for head dimensions that are
+            not a multiple of 64.
+    """
+    kv_heads = (
+        [model.n_kv_heads] * len(model.layers)
+        if isinstance(model.n_kv_heads, int)
+        else model.n_kv_heads
+    )
+    if block_pools is not None and kv_bits is not None:
+        raise ValueError("A paged KV cache cannot be quantized")
+    if block_pools is not None:
+        return [
+            PagedKVCache(pool, model.head_dim, n, batch_size, offset, left_padding)
+            for pool, n in zip(block_pools, kv_heads)
+        ]
+    if kv_bits is not None:
+        group_size = quantization_group_size(model.head_dim, kv_group_size)
+        return [
+            QuantizedKVCache(
+                model.head_dim, n, batch_size, offset, left_padding, group_size, kv_bits
+            )
+            for n in kv_heads
+        ]
+    return [
+        BatchedKVCache(model.head_dim, n, batch_size, offset, left_padding)
+        for n in kv_heads
+    ]
+
+
+def make_block_pools(model, num_blocks, block_size=64):
+    """Create one :class:`BlockPool` of ``num_blocks`` blocks per layer of ``model``."""
+    return [BlockPool(num_blocks, block_size) for _ in model.layers]
 
 @dataclass
 class BaseModelArgs:
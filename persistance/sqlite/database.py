@@ -2,142 +2,627 @@
 """
 Database module for MLX MCP Server
 Handles SQLite database operations for storing generation results
+
+Every thread keeps one long-lived connection in WAL mode, so readers never
+block the writer. Results of a batch are inserted with ``executemany`` in a
+single transaction, and ``queue_generation_results`` hands them to a
+background writer thread so inference never waits on disk. Reads flush the
+writer queue first, so they always see every queued result
+
+The schema is normalized: ``batches`` holds the model and parameters of a
+batch once per model, ``prompts`` every distinct prompt text once under its
+SHA-256, and ``results`` one row per response referencing both. Responses of at least
+``MLX_DB_COMPRESS_MIN_BYTES`` are stored compressed (zlib, or zstd with the
+optional ``zstandard`` package) and decompressed transparently on read
+
+``export_results`` streams a query into a JSONL or Parquet file (the latter
+with the optional ``pyarrow`` package) a chunk of rows at a time, so exports
+of large batches run in bounded memory
 """
 
+import atexit
+import hashlib
+import json
+import queue
+import re
 import sqlite3
+import tempfile
 import logging
+import threading
+import time
+import zlib
+from concurrent.futures import Future
 from datetime import datetime
-from typing import Optional
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple, Union
 from pathlib import Path
 import os
 
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
 logger = logging.getLogger(__name__)
 
 # Database configuration - use absolute path
 SCRIPT_DIR = Path(__file__).parent.absolute()
 DB_PATH = os.path.join(SCRIPT_DIR, "mlx_results.db")
+# NORMAL only fsyncs at WAL checkpoints: a power loss may drop the last
+# commits but never corrupts the database
+DB_SYNCHRONOUS = os.environ.get("MLX_DB_SYNCHRONOUS", "NORMAL")
+# Retries of a failed background write before its results are reported failed
+DB_WRITE_RETRIES = int(os.environ.get("MLX_DB_WRITE_RETRIES", "3"))
+# Responses of at least this many UTF-8 bytes are compressed with
+# MLX_DB_COMPRESSION ("zlib", "zstd" or "none")
+DB_COMPRESSION = os.environ.get("MLX_DB_COMPRESSION", "zlib")
+DB_COMPRESS_MIN_BYTES = int(os.environ.get("MLX_DB_COMPRESS_MIN_BYTES", "512"))
+# Exports are written here unless given an absolute path, and fetched from
+# SQLite this many rows at a time
+EXPORT_DIR = os.environ.get("MLX_EXPORT_DIR", os.path.join(SCRIPT_DIR, "exports"))
+EXPORT_CHUNK_ROWS = int(os.environ.get("MLX_EXPORT_CHUNK_ROWS", "1000"))
 
-def init_database():
-    """Initialize SQLite database with results table"""
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
-    
-    cursor.execute("""
-        CREATE TABLE IF NOT EXISTS generation_results (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            timestamp DATETIME DEFAULT CURRENT_TIMESTAMP,
+RESULT_COLUMNS = (
+    "model_name", "prompt", "response", "max_tokens", "temperature",
+    "prompt_index", "batch_id", "is_batch"
+)
+
+_local = threading.local()
+
+def get_connection() -> sqlite3.Connection:
+    """The calling thread's connection to DB_PATH, opened on first use"""
+    conn = getattr(_local, "conn", None)
+    if conn is None or _local.path != DB_PATH:
+        if conn is not None:
+            conn.close()
+        conn = sqlite3.connect(DB_PATH, timeout=30)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute(f"PRAGMA synchronous={DB_SYNCHRONOUS}")
+        _local.conn, _local.path = conn, DB_PATH
+    return conn
+
+def prompt_hash(text: str) -> bytes:
+    """Content address of a prompt in the prompts table"""
+    return hashlib.sha256(text.encode("utf-8")).digest()
+
+def _compress(response: str) -> Tuple[Union[str, bytes], Optional[str]]:
+    """Stored form of a response and its encoding, None for plain text"""
+    data = response.encode("utf-8")
+    if DB_COMPRESSION == "none" or len(data) < DB_COMPRESS_MIN_BYTES:
+        return response, None
+    if DB_COMPRESSION == "zstd":
+        if zstandard is None:
+            raise ValueError("MLX_DB_COMPRESSION=zstd requires the zstandard package")
+        return zstandard.ZstdCompressor().compress(data), "zstd"
+    if DB_COMPRESSION == "zlib":
+        return zlib.compress(data), "zlib"
+    raise ValueError(f"Unknown MLX_DB_COMPRESSION: {DB_COMPRESSION}")
+
+def _decompress(stored: Union[str, bytes], encoding: Optional[str]) -> str:
+    """Response text of a stored response"""
+    if encoding is None:
+        return stored
+    if encoding == "zstd":
+        if zstandard is None:
+            raise ValueError("Reading zstd-compressed responses requires the zstandard package")
+        return zstandard.ZstdDecompressor().decompress(stored).decode("utf-8")
+    return zlib.decompress(stored).decode("utf-8")
+
+def _insert_results(conn: sqlite3.Connection, results: List[Dict[str, Any]]):
+    """
+    Insert results into the normalized tables within the caller's transaction.
+
+    Results sharing a batch_id and model share one batches row, created on
+    first use with the parameters of the first of them, so a batch_id whose
+    results came from several models has one row per model; a result without
+    batch_id gets a batch of its own. Per-result max_tokens and temperature are only stored
+    where they differ from their batch's. An optional "timestamp" key sets the
+    creation time of new batches, an optional "cache_key" makes the response
+    a hit for get_cached_responses.
+    """
+    batches: Dict[Any, Tuple[int, Any, Any]] = {}
+    rows = []
+    for i, r in enumerate(results):
+        key = (r["batch_id"], r["model_name"]) if r.get("batch_id") else ("single", i)
+        if key not in batches:
+            params = (r.get("batch_id"), r["model_name"], r["max_tokens"], r["temperature"],
+                      r.get("is_batch", False), r.get("timestamp"))
+            cursor = conn.execute("""
+                INSERT OR IGNORE INTO batches
+                (batch_id, model_name, max_tokens, temperature, is_batch, created_at)
+                VALUES (?, ?, ?, ?, ?, COALESCE(?, CURRENT_TIMESTAMP))
+            """, params)
+            if cursor.rowcount:
+                batches[key] = (cursor.lastrowid, r["max_tokens"], r["temperature"])
+            else:
+                # a batch saved in several calls
+                batches[key] = conn.execute(
+                    "SELECT id, max_tokens, temperature FROM batches WHERE batch_id = ? AND model_name = ?",
+                    key
+                ).fetchone()
+        batch, max_tokens, temperature = batches[key]
+        response, encoding = _compress(r["response"])
+        rows.append((
+            batch,
+            prompt_hash(r["prompt"]),
+            r.get("prompt_index"),
+            None if r["max_tokens"] == max_tokens else r["max_tokens"],
+            None if r["temperature"] == temperature else r["temperature"],
+            response,
+            encoding
+        ))
+
+    conn.executemany(
+        "INSERT OR IGNORE INTO prompts (hash, text) VALUES (?, ?)",
+        [(prompt_hash(r["prompt"]), r["prompt"]) for r in results]
+    )
+    # only written when given: migration 2 inserts before the column exists
+    if any(r.get("cache_key") for r in results):
+        conn.executemany("""
+            INSERT INTO results
+            (batch, prompt, prompt_index, max_tokens, temperature, response, encoding, cache_key)
+            VALUES (?, (SELECT id FROM prompts WHERE hash = ?), ?, ?, ?, ?, ?, ?)
+        """, [row + (r.get("cache_key"),) for row, r in zip(rows, results)])
+    else:
+        conn.executemany("""
+            INSERT INTO results
+            (batch, prompt, prompt_index, max_tokens, temperature, response, encoding)
+            VALUES (?, (SELECT id FROM prompts WHERE hash = ?), ?, ?, ?, ?, ?)
+        """, rows)
+
+def _normalize_results(conn: sqlite3.Connection):
+    """Move the rows of the flat generation_results table into normalized tables"""
+    for statement in (
+        # a batch_id names one batches row per model it holds results of
+        """
+        CREATE TABLE batches (
+            id INTEGER PRIMARY KEY,
+            batch_id TEXT,
             model_name TEXT NOT NULL,
-            prompt TEXT NOT NULL,
-            response TEXT NOT NULL,
             max_tokens INTEGER,
             temperature REAL,
+            is_batch BOOLEAN DEFAULT FALSE,
+            created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+            UNIQUE (batch_id, model_name)
+        )
+        """,
+        "CREATE INDEX idx_batches_model ON batches (model_name)",
+        """
+        CREATE TABLE prompts (
+            id INTEGER PRIMARY KEY,
+            hash BLOB NOT NULL UNIQUE,
+            text TEXT NOT NULL
+        )
+        """,
+        """
+        CREATE TABLE results (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            batch INTEGER NOT NULL REFERENCES batches (id),
+            prompt INTEGER NOT NULL REFERENCES prompts (id),
             prompt_index INTEGER,
-            batch_id TEXT,
-            is_batch BOOLEAN DEFAULT FALSE
+            max_tokens INTEGER,
+            temperature REAL,
+            response BLOB NOT NULL,
+            encoding TEXT
         )
+        """,
+        # the rowid (id) is the implicit last column of every index
+        "CREATE INDEX idx_results_batch ON results (batch, prompt_index)",
+    ):
+        conn.execute(statement)
+
+    cursor = conn.execute("""
+        SELECT model_name, prompt, response, max_tokens, temperature, prompt_index,
+               batch_id, is_batch, timestamp
+        FROM generation_results
+        ORDER BY id
     """)
-    
-    conn.commit()
-    conn.close()
+    moved = 0
+    while rows := cursor.fetchmany(10000):
+        _insert_results(conn, [dict(zip(RESULT_COLUMNS + ("timestamp",), row)) for row in rows])
+        moved += len(rows)
+    conn.execute("DROP TABLE generation_results")
+    logger.info(f"Moved {moved} results into the normalized tables")
+
+# Schema migrations, applied in order by init_database. PRAGMA user_version
+# holds the number of migrations a database has already applied. A migration
+# is an SQL script or a function of the connection, run in one transaction
+MIGRATIONS: List[Union[str, Callable[[sqlite3.Connection], None]]] = [
+    # 1: results table
+    """
+    CREATE TABLE IF NOT EXISTS generation_results (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        timestamp DATETIME DEFAULT CURRENT_TIMESTAMP,
+        model_name TEXT NOT NULL,
+        prompt TEXT NOT NULL,
+        response TEXT NOT NULL,
+        max_tokens INTEGER,
+        temperature REAL,
+        prompt_index INTEGER,
+        batch_id TEXT,
+        is_batch BOOLEAN DEFAULT FALSE
+    );
+    """,
+    # 2: batches, content-hashed prompts and (compressed) results, with the
+    # indexes of the lookups by batch and by model
+    _normalize_results,
+    # 3: key of deterministic results in the result cache, see result_cache.py
+    """
+    ALTER TABLE results ADD COLUMN cache_key BLOB;
+    CREATE INDEX IF NOT EXISTS idx_results_cache_key
+        ON results (cache_key) WHERE cache_key IS NOT NULL;
+    """,
+]
+
+def init_database():
+    """Initialize SQLite database, applying the migrations it has not seen yet"""
+    conn = get_connection()
+    version = conn.execute("PRAGMA user_version").fetchone()[0]
+    for number, migration in enumerate(MIGRATIONS[version:], start=version + 1):
+        if callable(migration):
+            conn.execute("BEGIN")
+            try:
+                migration(conn)
+                conn.execute(f"PRAGMA user_version = {number}")
+            except Exception:
+                conn.rollback()
+                raise
+            conn.commit()
+        else:
+            conn.executescript(f"BEGIN; {migration} PRAGMA user_version = {number}; COMMIT;")
+        logger.info(f"Applied database migration {number}")
     logger.info(f"Database initialized at {DB_PATH}")
 
-def save_generation_result(model_name: str, prompt: str, response: str, 
-                         max_tokens: int, temperature: float, 
-                         prompt_index: Optional[int] = None, 
-                         batch_id: Optional[str] = None, 
+def save_generation_results(results: List[Dict[str, Any]]):
+    """
+    Save generation results to the database in one transaction.
+
+    Args:
+        results: One dict per result with the keys of RESULT_COLUMNS;
+            prompt_index and batch_id default to None, is_batch to False.
+            Deterministic results may carry their result cache_key
+    """
+    if not results:
+        return
+    conn = get_connection()
+    with conn:
+        _insert_results(conn, results)
+    logger.info(f"{len(results)} generation results saved to database")
+
+def save_generation_result(model_name: str, prompt: str, response: str,
+                         max_tokens: int, temperature: float,
+                         prompt_index: Optional[int] = None,
+                         batch_id: Optional[str] = None,
                          is_batch: bool = False):
     """Save a generation result to the database"""
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
-    
-    cursor.execute("""
-        INSERT INTO generation_results 
-        (model_name, prompt, response, max_tokens, temperature, prompt_index, batch_id, is_batch)
-        VALUES (?, ?, ?, ?, ?, ?, ?, ?)
-    """, (model_name, prompt, response, max_tokens, temperature, prompt_index, batch_id, is_batch))
-    
-    conn.commit()
-    conn.close()
-    logger.info(f"Generation result saved to database")
-
-def get_batch_results(batch_id: str):
-    """Get all results for a specific batch_id"""
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
-    
-    cursor.execute("""
-        SELECT id, timestamp, model_name, prompt, response, max_tokens, temperature, prompt_index, batch_id
-        FROM generation_results 
-        WHERE batch_id = ?
-        ORDER BY prompt_index
-    """, (batch_id,))
-    
-    results = cursor.fetchall()
-    conn.close()
-    
-    return [{
-        "id": row[0],
-        "timestamp": row[1],
-        "model_name": row[2],
-        "prompt": row[3],
-        "response": row[4],
-        "max_tokens": row[5],
-        "temperature": row[6],
-        "prompt_index": row[7],
-        "batch_id": row[8]
-    } for row in results]
-
-def get_recent_results(limit: int = 10):
-    """Get recent generation results"""
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
-    
-    cursor.execute("""
-        SELECT id, timestamp, model_name, prompt, response, max_tokens, temperature, prompt_index, batch_id
-        FROM generation_results 
-        ORDER BY timestamp DESC 
-        LIMIT ?
-    """, (limit,))
-    
-    results = cursor.fetchall()
-    conn.close()
-    
-    return [{
-        "id": row[0],
-        "timestamp": row[1],
-        "model_name": row[2],
-        "prompt": row[3],
-        "response": row[4],
-        "max_tokens": row[5],
-        "temperature": row[6],
-        "prompt_index": row[7],
-        "batch_id": row[8]
-    } for row in results]
-
-def get_results_by_model(model_name: str, limit: int = 10):
-    """Get recent results for a specific model"""
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
-    
-    cursor.execute("""
-        SELECT id, timestamp, model_name, prompt, response, max_tokens, temperature, prompt_index, batch_id
-        FROM generation_results 
-        WHERE model_name = ?
-        ORDER BY timestamp DESC 
-        LIMIT ?
-    """, (model_name, limit))
-    
-    results = cursor.fetchall()
-    conn.close()
-    
+    save_generation_results([{
+        "model_name": model_name,
+        "prompt": prompt,
+        "response": response,
+        "max_tokens": max_tokens,
+        "temperature": temperature,
+        "prompt_index": prompt_index,
+        "batch_id": batch_id,
+        "is_batch": is_batch
+    }])
+
+class ResultWriter:
+    """
+    Background thread saving queued results with save_generation_results.
+
+    All results queued while a transaction is written go into the next one,
+    so many small batches share a commit. A failed transaction is retried
+    ``retries`` times with exponential backoff from ``backoff`` seconds (e.g.
+    while another process holds the database lock), then every submission is
+    written on its own, so one bad submission does not fail the others.
+    ``submit`` returns a future that resolves once its results are stored,
+    or raises the error they could not be stored with.
+    """
+
+    def __init__(self, retries: int = DB_WRITE_RETRIES, backoff: float = 0.1):
+        self.retries = retries
+        self.backoff = backoff
+        self._queue: "queue.Queue[Tuple[List[Dict[str, Any]], Future]]" = queue.Queue()
+        self._lock = threading.Lock()
+        self._thread: Optional[threading.Thread] = None
+        self.failed = 0
+
+    def submit(self, results: List[Dict[str, Any]]) -> Future:
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(
+                    target=self._work, name="mlx-db-writer", daemon=True
+                )
+                self._thread.start()
+        stored: Future = Future()
+        self._queue.put((results, stored))
+        return stored
+
+    def flush(self):
+        """Wait until every queued result is written or failed"""
+        self._queue.join()
+
+    def _save(self, results: List[Dict[str, Any]]) -> Optional[Exception]:
+        """Save with retries, return the error of the last attempt if all failed"""
+        for attempt in range(self.retries + 1):
+            try:
+                save_generation_results(results)
+                return None
+            except Exception as e:
+                if attempt == self.retries:
+                    return e
+                delay = self.backoff * 2 ** attempt
+                logger.warning(f"Error saving generation results, retrying in {delay:.2f}s: {e}")
+                time.sleep(delay)
+
+    def _work(self):
+        while True:
+            items = [self._queue.get()]
+            while True:
+                try:
+                    items.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                error = self._save([r for results, _ in items for r in results])
+                errors = [error] * len(items)
+                if error is not None and len(items) > 1:
+                    logger.warning(
+                        f"Saving {len(items)} submissions at once failed, saving them one by one"
+                    )
+                    errors = [self._save(results) for results, _ in items]
+                for (results, stored), error in zip(items, errors):
+                    if error is None:
+                        stored.set_result(None)
+                    else:
+                        self.failed += len(results)
+                        logger.error(f"Error saving {len(results)} generation results: {error}")
+                        stored.set_exception(error)
+            finally:
+                for _ in items:
+                    self._queue.task_done()
+
+# Shared by all tools in the server process
+result_writer = ResultWriter()
+atexit.register(result_writer.flush)
+
+def queue_generation_results(results: List[Dict[str, Any]]) -> Future:
+    """
+    Save results like save_generation_results, without waiting for the write.
+    The returned future resolves once they are stored, see ResultWriter
+    """
+    return result_writer.submit(results)
+
+def _result_dicts(rows):
     return [{
         "id": row[0],
         "timestamp": row[1],
         "model_name": row[2],
         "prompt": row[3],
-        "response": row[4],
-        "max_tokens": row[5],
-        "temperature": row[6],
-        "prompt_index": row[7],
-        "batch_id": row[8]
-    } for row in results]
+        "response": _decompress(row[4], row[5]),
+        "max_tokens": row[6],
+        "temperature": row[7],
+        "prompt_index": row[8],
+        "batch_id": row[9]
+    } for row in rows]
+
+# Pages are read with keyset pagination: instead of an OFFSET, a page starts
+# right after the row with id after_id in the sort order, so every page is
+# one index range scan however deep it is. Results are sorted newest batch
+# first, and by prompt_index within a batch. Rows get their batch's creation
+# time and parameters unless they have their own. The sort keys name the
+# column each query walks an index of (r.batch or b.id), so SQLite only sorts
+# the results of one batch_id that came from several models
+SELECT_RESULTS = """
+    SELECT r.id, b.created_at, b.model_name, p.text, r.response, r.encoding,
+           COALESCE(r.max_tokens, b.max_tokens), COALESCE(r.temperature, b.temperature),
+           r.prompt_index, b.batch_id
+    FROM results r
+    JOIN batches b ON b.id = r.batch
+    JOIN prompts p ON p.id = r.prompt
+"""
+
+def _after(keys: str, columns: str, op: str, after_id: Optional[int]):
+    """
+    Keyset condition on (keys, r.id) past the result after_id, whose key values
+    are its results columns, and its parameters
+    """
+    if after_id is None:
+        return "", ()
+    return (f"AND ({keys}, r.id) {op} (SELECT {columns}, id FROM results WHERE id = ?)",
+            (after_id,))
+
+def _results_query(batch_id: Optional[str] = None, model_name: Optional[str] = None,
+                   after_id: Optional[int] = None) -> Tuple[str, tuple]:
+    """
+    Query and parameters of the results of a batch in prompt order, or of a
+    model or of all results newest first, following the result after_id
+    """
+    if batch_id is not None:
+        after, params = _after("r.prompt_index", "prompt_index", ">", after_id)
+        return f"""
+            {SELECT_RESULTS}
+            WHERE b.batch_id = ? {after}
+            ORDER BY r.prompt_index, r.id
+        """, (batch_id, *params)
+    if model_name is not None:
+        after, params = _after("b.id, r.prompt_index", "batch, prompt_index", "<", after_id)
+        return f"""
+            {SELECT_RESULTS}
+            WHERE b.model_name = ? {after}
+            ORDER BY b.id DESC, r.prompt_index DESC, r.id DESC
+        """, (model_name, *params)
+    after, params = _after("r.batch, r.prompt_index", "batch, prompt_index", "<", after_id)
+    return f"""
+        {SELECT_RESULTS}
+        WHERE 1 {after}
+        ORDER BY r.batch DESC, r.prompt_index DESC, r.id DESC
+    """, params
+
+def get_batch_results(batch_id: str, limit: Optional[int] = None, after_id: Optional[int] = None):
+    """Get the results for a specific batch_id in prompt order, all or a page of limit"""
+    result_writer.flush()
+    query, params = _results_query(batch_id=batch_id, after_id=after_id)
+    cursor = get_connection().execute(f"{query} LIMIT ?", (*params, -1 if limit is None else limit))
+
+    return _result_dicts(cursor.fetchall())
+
+def get_recent_results(limit: int = 10, after_id: Optional[int] = None):
+    """Get recent generation results, newest first"""
+    result_writer.flush()
+    query, params = _results_query(after_id=after_id)
+    cursor = get_connection().execute(f"{query} LIMIT ?", (*params, limit))
+
+    return _result_dicts(cursor.fetchall())
+
+def get_results_by_model(model_name: str, limit: int = 10, after_id: Optional[int] = None):
+    """Get recent results for a specific model, newest first"""
+    result_writer.flush()
+    query, params = _results_query(model_name=model_name, after_id=after_id)
+    cursor = get_connection().execute(f"{query} LIMIT ?", (*params, limit))
+
+    return _result_dicts(cursor.fetchall())
+
+def iter_results(batch_id: Optional[str] = None, model_name: Optional[str] = None,
+                 chunk_size: int = EXPORT_CHUNK_ROWS) -> Iterator[List[Dict[str, Any]]]:
+    """
+    Results of a batch, a model or all results, in the order of the matching
+    get_* function, as lists of at most chunk_size. Rows are stepped out of
+    one open SQLite cursor, so only a chunk is held in memory at a time
+    """
+    result_writer.flush()
+    query, params = _results_query(batch_id=batch_id, model_name=model_name)
+    cursor = get_connection().execute(query, params)
+    try:
+        while True:
+            rows = cursor.fetchmany(chunk_size)
+            if not rows:
+                return
+            yield _result_dicts(rows)
+    finally:
+        cursor.close()
+
+def _parquet_schema():
+    return pyarrow.schema([
+        ("id", pyarrow.int64()),
+        ("timestamp", pyarrow.string()),
+        ("model_name", pyarrow.string()),
+        ("prompt", pyarrow.string()),
+        ("response", pyarrow.string()),
+        ("max_tokens", pyarrow.int64()),
+        ("temperature", pyarrow.float64()),
+        ("prompt_index", pyarrow.int64()),
+        ("batch_id", pyarrow.string()),
+    ])
+
+def _export_path(path: Optional[str], format: str, batch_id: Optional[str],
+                 model_name: Optional[str]) -> str:
+    """
+    Absolute path of an export inside EXPORT_DIR. Paths come from MCP clients,
+    so absolute paths, ``~`` and ``..`` are rejected, and the resolved path
+    (symlinks followed) must stay under EXPORT_DIR
+    """
+    if path is None:
+        name = batch_id or model_name or "results"
+        # batch ids and model names become a single plain file name
+        name = re.sub(r"[^A-Za-z0-9_.-]", "_", name).lstrip(".") or "results"
+        path = f"{name}_{datetime.now().strftime('%Y%m%d_%H%M%S')}.{format}"
+    elif os.path.isabs(path) or path.startswith("~") or ".." in Path(path).parts:
+        raise ValueError(f"Export path must be relative to the export directory: {path}")
+    export_dir = os.path.realpath(EXPORT_DIR)
+    resolved = os.path.realpath(os.path.join(export_dir, path))
+    if resolved == export_dir or os.path.commonpath([export_dir, resolved]) != export_dir:
+        raise ValueError(f"Export path is outside the export directory: {path}")
+    return resolved
+
+def export_results(path: Optional[str] = None, format: str = "jsonl",
+                   batch_id: Optional[str] = None, model_name: Optional[str] = None,
+                   chunk_size: int = EXPORT_CHUNK_ROWS, overwrite: bool = False) -> Tuple[str, int]:
+    """
+    Write the results of a batch, a model or all results to a JSONL or
+    Parquet file in EXPORT_DIR and return its absolute path and the number
+    of rows.
+
+    Args:
+        path (str): Output file relative to EXPORT_DIR; absolute paths, ``~``
+          and ``..`` are rejected. Default: named after the batch or model
+          and the time.
+        format (str): ``"jsonl"``, one result object per line, or
+          ``"parquet"``, one row group per chunk (requires ``pyarrow``).
+        batch_id (str): Export this batch in prompt order.
+        model_name (str): Export the results of this model, newest first.
+          Without either, all results are exported newest first.
+        chunk_size (int): Rows fetched and written at a time.
+        overwrite (bool): Replace an existing file at ``path`` instead of
+          raising ``FileExistsError``. Default: ``False``.
+    """
+    if format not in ("jsonl", "parquet"):
+        raise ValueError(f"Unknown export format: {format}")
+    if format == "parquet" and pyarrow is None:
+        raise ValueError("Parquet exports require the pyarrow package")
+    path = _export_path(path, format, batch_id, model_name)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    if not overwrite:
+        # reserve the name with an empty file; fails if the file exists,
+        # also if it was created by a concurrent export
+        try:
+            os.close(os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL))
+        except FileExistsError:
+            raise FileExistsError(f"Export file already exists: {path}") from None
+
+    # write to a temporary file next to the target and move it into place,
+    # so a failed export leaves no partial file behind
+    partial = None
+    rows = 0
+    try:
+        fd, partial = tempfile.mkstemp(
+            prefix=".export_", suffix=".partial", dir=os.path.dirname(path)
+        )
+        os.close(fd)
+        if format == "parquet":
+            schema = _parquet_schema()
+            with pyarrow.parquet.ParquetWriter(partial, schema) as writer:
+                for chunk in iter_results(batch_id, model_name, chunk_size):
+                    writer.write_table(pyarrow.Table.from_pylist(chunk, schema=schema))
+                    rows += len(chunk)
+        else:
+            with open(partial, "w", encoding="utf-8") as f:
+                for chunk in iter_results(batch_id, model_name, chunk_size):
+                    f.writelines(json.dumps(r, ensure_ascii=False) + "\n" for r in chunk)
+                    rows += len(chunk)
+        os.replace(partial, path)
+    except BaseException:
+        if not overwrite:
+            os.remove(path)
+        raise
+    finally:
+        if partial is not None and os.path.exists(partial):
+            os.remove(partial)
+    logger.info(f"Exported {rows} results to {path}")
+    return path, rows
+
+def get_cached_responses(cache_keys: List[bytes]) -> Dict[bytes, str]:
+    """
+    Responses stored under the given result cache keys, the latest one for a
+    key stored several times. Results still queued for the writer are not
+    waited for; a miss only costs a generation
+    """
+    responses = {}
+    conn = get_connection()
+    # stay below SQLite's limit of bound parameters per statement
+    for start in range(0, len(cache_keys), 500):
+        chunk = cache_keys[start:start + 500]
+        cursor = conn.execute(f"""
+            SELECT cache_key, response, encoding
+            FROM results
+            WHERE cache_key IN ({", ".join("?" * len(chunk))})
+            ORDER BY id
+        """, chunk)
+        for cache_key, response, encoding in cursor:
+            responses[cache_key] = _decompress(response, encoding)
+    return responses
@@ -0,0 +1,244 @@
+#!/usr/bin/env python3
+"""
+Prompt-prefix KV cache for MLX MCP Server
+Keeps the KV cache of prompt prefixes that were prefilled before, keyed by a
+hash of their tokens, so later batches starting with the same prefix skip
+its prefill. Entries are evicted least recently used first once they exceed
+a byte budget, and optionally spilled to disk as safetensors files
+"""
+
+import hashlib
+import logging
+import os
+import threading
+from array import array
+from collections import Counter, OrderedDict
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Tuple
+
+import mlx.core as mx
+
+logger = logging.getLogger(__name__)
+
+# Cache configuration - byte budget of cached prefixes kept in memory
+MAX_PROMPT_CACHE_GB = float(os.environ.get("MLX_PROMPT_CACHE_GB", "2"))
+PROMPT_CACHE_DIR = os.environ.get("MLX_PROMPT_CACHE_DIR")
+
+KVState = List[Tuple[mx.array, mx.array]]
+
+
+def prefix_digest(model_key: str, tokens: List[int]) -> str:
+    """Content address of a token prefix for one model"""
+    h = hashlib.sha256(model_key.encode("utf-8"))
+    h.update(b"\0")
+    h.update(array("q", tokens).tobytes())
+    return h.hexdigest()
+
+
+def _state_nbytes(state: KVState) -> int:
+    return sum(k.nbytes + v.nbytes for k, v in state)
+
+
+@dataclass
+class _Entry:
+    model_key: str
+    length: int
+    nbytes: int
+    state: Optional[KVState] = None
+
+
+class PromptCache:
+    """
+    Bounded, content-addressed cache of prefilled prompt prefixes.
+
+    Every entry holds the per-layer ``(keys, values)`` of a single unpadded
+    row, see :attr:`models.base.BatchedKVCache.state`. :meth:`fetch` returns
+    the longest cached prefix of the given tokens, so a prefix that grew by a
+    few tokens since it was stored still reuses the stored part.
+
+    Args:
+        max_bytes (int): Budget for entries held in memory.
+        cache_dir (str, optional): If set, entries evicted from memory are
+          written there as safetensors files and loaded back on a hit. Files
+          found in the directory are indexed on startup.
+        max_disk_bytes (int, optional): Budget for spilled entries. Default:
+          unbounded.
+    """
+
+    def __init__(
+        self,
+        max_bytes: int = int(MAX_PROMPT_CACHE_GB * (1 << 30)),
+        cache_dir: Optional[str] = PROMPT_CACHE_DIR,
+        max_disk_bytes: Optional[int] = None,
+    ):
+        self.max_bytes = max_bytes
+        self.max_disk_bytes = max_disk_bytes
+        self.cache_dir = Path(cache_dir) if cache_dir else None
+        self._memory: "OrderedDict[str, _Entry]" = OrderedDict()
+        self._disk: "OrderedDict[str, _Entry]" = OrderedDict()
+        # cached prefix lengths per model, to look up the longest match
+        self._lengths: Dict[str, Counter] = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.disk_hits = 0
+        self.tokens_reused = 0
+        self.evictions = 0
+        if self.cache_dir is not None:
+            self.cache_dir.mkdir(parents=True, exist_ok=True)
+            self._index_disk()
+
+    def _path(self, digest: str) -> Path:
+        return self.cache_dir / f"{digest}.safetensors"
+
+    def _index_disk(self):
+        files = sorted(self.cache_dir.glob("*.safetensors"), key=lambda p: p.stat().st_mtime)
+        for path in files:
+            try:
+                _, metadata = mx.load(str(path), return_metadata=True)
+                entry = _Entry(
+                    model_key=metadata["model_key"],
+                    length=int(metadata["length"]),
+                    nbytes=path.stat().st_size,
+                )
+            except Exception as e:
+                logger.warning(f"Skipping unreadable prompt cache file {path}: {e}")
+                continue
+            self._disk[path.stem] = entry
+            self._lengths.setdefault(entry.model_key, Counter())[entry.length] += 1
+
+    def fetch(self, model_key: str, tokens: List[int]) -> Tuple[Optional[KVState], int]:
+        """
+        Look up the longest cached prefix of ``tokens``.
+
+        Returns:
+            The per-layer ``(keys, values)`` of the prefix and its length in
+            tokens, or ``(None, 0)`` on a miss.
+        """
+        with self._lock:
+            lengths = self._lengths.get(model_key, Counter())
+            for length in sorted(lengths, reverse=True):
+                if length > len(tokens):
+                    continue
+                digest = prefix_digest(model_key, tokens[:length])
+                state = self._get(digest)
+                if state is not None:
+                    self.hits += 1
+                    self.tokens_reused += length
+                    return state, length
+            self.misses += 1
+            return None, 0
+
+    def _get(self, digest: str) -> Optional[KVState]:
+        entry = self._memory.get(digest)
+        if entry is not None:
+            self._memory.move_to_end(digest)
+            return entry.state
+
+        entry = self._disk.pop(digest, None)
+        if entry is None:
+            return None
+        arrays = mx.load(str(self._path(digest)))
+        mx.eval(arrays)
+        os.remove(self._path(digest))
+        num_layers = len(arrays) // 2
+        state = [
+            (arrays[f"keys.{i}"], arrays[f"values.{i}"]) for i in range(num_layers)
+        ]
+        entry.state = state
+        entry.nbytes = _state_nbytes(state)
+        self.disk_hits += 1
+        self._memory[digest] = entry
+        self._evict_over_budget()
+        return state
+
+    def store(self, model_key: str, tokens: List[int], state: KVState):
+        """Cache the per-layer ``(keys, values)`` of the prefilled ``tokens``"""
+        digest = prefix_digest(model_key, tokens)
+        with self._lock:
+            if digest in self._memory or digest in self._disk:
+                return
+            mx.eval(state)
+            self._memory[digest] = _Entry(
+                model_key=model_key,
+                length=len(tokens),
+                nbytes=_state_nbytes(state),
+                state=state,
+            )
+            self._lengths.setdefault(model_key, Counter())[len(tokens)] += 1
+            self._evict_over_budget()
+
+    def _forget(self, entry: _Entry):
+        lengths = self._lengths[entry.model_key]
+        lengths[entry.length] -= 1
+        if lengths[entry.length] <= 0:
+            del lengths[entry.length]
+
+    def _evict_over_budget(self):
+        while self._memory and self.memory_bytes > self.max_bytes:
+            digest, entry = self._memory.popitem(last=False)
+            self.evictions += 1
+            if self.cache_dir is None:
+                self._forget(entry)
+                continue
+            arrays = {}
+            for i, (keys, values) in enumerate(entry.state):
+                arrays[f"keys.{i}"] = keys
+                arrays[f"values.{i}"] = values
+            mx.save_safetensors(
+                str(self._path(digest)),
+                arrays,
+                metadata={"model_key": entry.model_key, "length": str(entry.length)},
+            )
+            entry.state = None
+            entry.nbytes = self._path(digest).stat().st_size
+            self._disk[digest] = entry
+
+        while (
+            self.max_disk_bytes is not None
+            and self._disk
+            and self.disk_bytes > self.max_disk_bytes
+        ):
+            digest, entry = self._disk.popitem(last=False)
+            os.remove(self._path(digest))
+            self._forget(entry)
+
+    @property
+    def memory_bytes(self) -> int:
+        return sum(entry.nbytes for entry in self._memory.values())
+
+    @property
+    def disk_bytes(self) -> int:
+        return sum(entry.nbytes for entry in self._disk.values())
+
+    def clear(self):
+        with self._lock:
+            for digest in self._disk:
+                os.remove(self._path(digest))
+            self._memory.clear()
+            self._disk.clear()
+            self._lengths.clear()
+
+    def stats(self) -> Dict[str, Any]:
+        """Size and hit/miss counters for reporting"""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._memory),
+                "memory_bytes": self.memory_bytes,
+                "max_bytes": self.max_bytes,
+                "disk_entries": len(self._disk),
+                "disk_bytes": self.disk_bytes,
+                "cache_dir": str(self.cache_dir) if self.cache_dir else None,
+                "hits": self.hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "tokens_reused": self.tokens_reused,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+            }
+
+
+# Shared by all tools in the server process
+prompt_cache = PromptCache()
@@ -0,0 +1,133 @@
+#!/usr/bin/env python3
+"""
+Generation-result cache for MLX MCP Server
+Serves repeated deterministic (temperature 0) generations without running the
+model. Results are keyed by a hash of the model, its revision, the formatted
+prompt and every option that changes a greedy output, and looked up in an
+in-memory LRU first and then in the SQLite results store, where saved
+results carry their key
+"""
+
+import hashlib
+import json
+import logging
+import os
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional
+
+from database import get_cached_responses
+
+logger = logging.getLogger(__name__)
+
+# Cache configuration - number of responses kept in memory, 0 disables the
+# cache including its SQLite lookups
+MAX_RESULT_CACHE_ENTRIES = int(os.environ.get("MLX_RESULT_CACHE_ENTRIES", "10000"))
+
+
+def result_key(
+    model_name: str,
+    revision: Optional[str],
+    formatted_prompt: str,
+    options: Dict[str, Any],
+) -> bytes:
+    """
+    Content address of a greedy generation. ``options`` holds every setting
+    the output depends on besides the prompt, e.g. max_tokens, penalties and
+    the JSON schema; sampling filters do not change an argmax and are left out
+    """
+    h = hashlib.sha256()
+    for part in (model_name, revision or "", formatted_prompt):
+        h.update(part.encode("utf-8"))
+        h.update(b"\0")
+    h.update(json.dumps(options, sort_keys=True, default=str).encode("utf-8"))
+    return h.digest()
+
+
+class ResultCache:
+    """
+    LRU of responses in memory, backed by the results database.
+
+    Args:
+        max_entries (int): Responses kept in memory; ``0`` disables the cache.
+        use_store (bool): Look up memory misses in the results database.
+          Default: ``True``.
+    """
+
+    def __init__(self, max_entries: int = MAX_RESULT_CACHE_ENTRIES, use_store: bool = True):
+        self.max_entries = max_entries
+        self.use_store = use_store
+        self._memory: "OrderedDict[bytes, str]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.store_hits = 0
+        self.misses = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_entries > 0
+
+    def get_many(self, keys: List[Optional[bytes]]) -> List[Optional[str]]:
+        """Cached response of every key, None for misses and None keys"""
+        responses: List[Optional[str]] = [None] * len(keys)
+        if not self.enabled:
+            return responses
+        missing = []
+        with self._lock:
+            for i, key in enumerate(keys):
+                if key is None:
+                    continue
+                response = self._memory.get(key)
+                if response is None:
+                    missing.append(i)
+                else:
+                    self._memory.move_to_end(key)
+                    responses[i] = response
+                    self.hits += 1
+        if missing and self.use_store:
+            try:
+                stored = get_cached_responses(list({keys[i] for i in missing}))
+            except Exception as e:
+                logger.warning(f"Result cache lookup in the database failed: {e}")
+                stored = {}
+            for i in missing:
+                responses[i] = stored.get(keys[i])
+            self.put_many({key: response for key, response in stored.items()})
+        with self._lock:
+            for i in missing:
+                if responses[i] is None:
+                    self.misses += 1
+                else:
+                    self.store_hits += 1
+        return responses
+
+    def put_many(self, responses: Dict[bytes, str]):
+        if not self.enabled:
+            return
+        with self._lock:
+            for key, response in responses.items():
+                self._memory[key] = response
+                self._memory.move_to_end(key)
+            while len(self._memory) > self.max_entries:
+                self._memory.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._memory.clear()
+
+    def stats(self) -> Dict[str, Any]:
+        """Size and hit/miss counters for reporting"""
+        with self._lock:
+            lookups = self.hits + self.store_hits + self.misses
+            return {
+                "entries": len(self._memory),
+                "max_entries": self.max_entries,
+                "hits": self.hits,
+                "store_hits": self.store_hits,
+                "misses": self.misses,
+                "hit_rate": (self.hits + self.store_hits) / lookups if lookups else 0.0,
+            }
+
+
+# Shared by all tools in the server process
+result_cache = ResultCache()
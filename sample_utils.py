@@ -1,3 +1,5 @@
+from typing import Callable, List, Optional, Sequence, Tuple, Union
+
 import mlx.core as mx
 
 def top_p_sampling(logits: mx.array, top_p: float, temperature: float, axis: int = -1) -> mx.array:
@@ -36,4 +38,189 @@ def top_p_sampling(logits: mx.array, top_p: float, temperature: float, axis: int
     # Gather the original token indices
     tokens = mx.take_along_axis(sorted_indices, mx.expand_dims(sampled_indices, axis=axis), axis=axis)
     
-    return tokens #.squeeze(axis=axis)
\ No newline at end of file
+    return tokens #.squeeze(axis=axis)
+
+
+# Upper bound on the candidate tokens kept for top-p / min-p sampling
+MAX_CANDIDATES = 1024
+
+
+def sample_rows(
+    logits: mx.array,
+    temp: mx.array,
+    top_p: mx.array,
+    top_k: mx.array,
+    min_p: mx.array,
+    noise: mx.array,
+    num_candidates: Optional[int] = None,
+) -> mx.array:
+    """
+    Sample one token per row with per-row sampling parameters.
+
+    All rows are handled by the same vectorized ops. Rows with ``temp <= 0``
+    take the argmax. With ``num_candidates`` set, the others are first
+    narrowed to that many most likely tokens with a partial selection
+    (:func:`mx.argpartition`) instead of sorting the whole vocabulary; only
+    the candidates are sorted, then cut to each row's ``top_k``, to the
+    smallest set reaching probability ``top_p`` and to the tokens with at
+    least ``min_p`` times the probability of the most likely one. The token
+    is drawn from what is left with the Gumbel-max trick.
+
+    Args:
+        logits: The ``(batch, vocab)`` logits.
+        temp: Temperature per row, shape ``(batch,)``.
+        top_p: Nucleus threshold per row, ``1`` disables it.
+        top_k: Number of candidate tokens per row, ``0`` disables it.
+        min_p: Probability floor relative to the most likely token, ``0``
+          disables it.
+        noise: Gumbel noise of shape ``(batch, min(num_candidates, vocab))``,
+          or ``(batch, vocab)`` without candidates.
+        num_candidates: Number of candidates, at least the largest ``top_k``.
+          Probabilities are still normalized over the full vocabulary (over
+          the ``top_k`` tokens for rows using it), so ``top_p`` is exact as
+          long as the nucleus fits in the candidates. ``None`` skips all
+          filtering.
+    Returns:
+        The ``(batch, 1)`` sampled tokens.
+    """
+    greedy = (temp <= 0)[:, None]
+    scaled = logits / mx.where(temp <= 0, 1, temp)[:, None]
+    if num_candidates is None:
+        sampled = mx.argmax(scaled + noise, axis=-1, keepdims=True)
+        return mx.where(greedy, mx.argmax(logits, axis=-1, keepdims=True), sampled)
+
+    vocab_size = logits.shape[-1]
+    K = min(num_candidates, vocab_size)
+    if K < vocab_size:
+        candidates = mx.argpartition(-scaled, kth=K - 1, axis=-1)[:, :K]
+        candidate_logits = mx.take_along_axis(scaled, candidates, axis=-1)
+    else:
+        candidates, candidate_logits = None, scaled
+    order = mx.argsort(-candidate_logits, axis=-1)
+    candidate_logits = mx.take_along_axis(candidate_logits, order, axis=-1)
+    candidates = order if candidates is None else mx.take_along_axis(candidates, order, axis=-1)
+
+    positions = mx.arange(K)[None]
+    candidate_logits = mx.where(
+        (top_k[:, None] <= 0) | (positions < top_k[:, None]), candidate_logits, -float("inf")
+    )
+    log_norm = mx.where(
+        top_k > 0,
+        mx.logsumexp(candidate_logits, axis=-1),
+        mx.logsumexp(scaled, axis=-1),
+    )
+    probs = mx.exp(candidate_logits - log_norm[:, None])
+    mass_before = mx.cumsum(probs, axis=-1) - probs
+    keep = (mass_before < top_p[:, None]) & (probs >= min_p[:, None] * probs[:, :1])
+    candidate_logits = mx.where(keep, candidate_logits, -float("inf"))
+
+    choice = mx.argmax(candidate_logits + noise, axis=-1, keepdims=True)
+    sampled = mx.take_along_axis(candidates, choice, axis=-1)
+    return mx.where(greedy, mx.argmax(logits, axis=-1, keepdims=True), sampled)
+
+
+def _per_row(value, batch_size: int) -> List:
+    if isinstance(value, (list, tuple)):
+        if len(value) != batch_size:
+            raise ValueError(f"Got {len(value)} sampling values for {batch_size} rows")
+        return list(value)
+    return [value] * batch_size
+
+
+def make_sampler(
+    temp: Union[float, Sequence[float]] = 0.0,
+    top_p: Union[float, Sequence[float]] = 1.0,
+    top_k: Union[int, Sequence[int]] = 0,
+    seed: Optional[Union[int, Sequence[Optional[int]]]] = None,
+    min_p: Union[float, Sequence[float]] = 0.0,
+    max_candidates: int = MAX_CANDIDATES,
+    logprobs: bool = False,
+) -> Callable[[mx.array], Tuple[mx.array, Optional[mx.array]]]:
+    """
+    Build the sampling function used by the batched decode loops.
+
+    ``temp``, ``top_p``, ``top_k``, ``min_p`` and ``seed`` are either shared
+    by every row or given per row, in which case the sampler only accepts
+    batches of that many rows. All rows are sampled together with
+    :func:`sample_rows`. Biases and other changes to the logits are up to
+    the caller, see :mod:`logits_processors`.
+
+    Args:
+        temp: The temperature for sampling, if 0 the argmax is used.
+        top_p: Nucleus sampling threshold, only used when ``0 < top_p < 1``.
+        top_k: Only sample from the ``top_k`` most likely tokens, ``0``
+          disables it.
+        seed: Seed of the random stream of the batch, or of each row (rows
+          with ``None`` use the global generator), so that a row's samples
+          do not depend on the rest of the batch.
+        min_p: Only sample tokens with at least ``min_p`` times the
+          probability of the most likely token, ``0`` disables it.
+        max_candidates: Once any row uses ``top_p``, ``top_k`` or ``min_p``,
+          sampled rows only consider this many most likely tokens (or the
+          largest ``top_k``, if larger). Default: ``1024``.
+        logprobs: If ``True``, also return the log-probability of every
+          sampled token under the given logits. Otherwise no softmax over
+          the vocabulary is computed and ``None`` is returned in its place.
+    Returns:
+        A function mapping ``(batch, vocab)`` logits to ``(batch, 1)`` tokens
+        and their ``(batch, 1)`` log-probabilities or ``None``.
+    """
+    batch_size = next(
+        (len(v) for v in (temp, top_p, top_k, min_p, seed) if isinstance(v, (list, tuple))),
+        None,
+    )
+    n = batch_size or 1
+    temps, top_ps, top_ks, min_ps = (
+        _per_row(v, n) for v in (temp, top_p, top_k, min_p)
+    )
+    sampled_rows = [i for i in range(n) if temps[i] > 0]
+    filtered = any(
+        top_ps[i] < 1.0 or top_ks[i] > 0 or min_ps[i] > 0 for i in sampled_rows
+    )
+    num_candidates = max([max_candidates] + top_ks) if filtered else None
+    params = (
+        mx.array(temps, dtype=mx.float32),
+        mx.array(top_ps, dtype=mx.float32),
+        mx.array(top_ks, dtype=mx.int32),
+        mx.array(min_ps, dtype=mx.float32),
+    )
+    if batch_size is None:
+        # one random stream shared by the whole batch
+        keys = [None if seed is None else mx.random.key(seed)]
+    else:
+        keys = [None if s is None else mx.random.key(s) for s in _per_row(seed, n)]
+
+    def _noise(B: int, K: int) -> mx.array:
+        if batch_size is None:
+            if keys[0] is None:
+                return mx.random.gumbel((B, K))
+            keys[0], key = mx.random.split(keys[0])
+            return mx.random.gumbel((B, K), key=key)
+        noise = mx.random.gumbel((B, K))
+        seeded = [i for i, k in enumerate(keys) if k is not None]
+        if seeded:
+            rows = []
+            for i in seeded:
+                keys[i], key = mx.random.split(keys[i])
+                rows.append(mx.random.gumbel((K,), key=key))
+            noise[mx.array(seeded)] = mx.stack(rows)
+        return noise
+
+    def sample(logits: mx.array) -> Tuple[mx.array, Optional[mx.array]]:
+        if not sampled_rows:
+            tokens = mx.argmax(logits, axis=-1, keepdims=True)
+        else:
+            B, V = logits.shape
+            K = V if num_candidates is None else min(num_candidates, V)
+            row_params = [mx.broadcast_to(p, (B,)) for p in params]
+            tokens = sample_rows(logits, *row_params, _noise(B, K), num_candidates)
+
+        if not logprobs:
+            return tokens, None
+        token_logprobs = mx.take_along_axis(logits, tokens, axis=-1) - mx.logsumexp(
+            logits, axis=-1, keepdims=True
+        )
+        return tokens, token_logprobs
+
+    return sample
+
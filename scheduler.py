@@ -0,0 +1,204 @@
+"""
+Iteration-level (continuous) batching for batched generation.
+
+The scheduler keeps a running batch of sequences that share one set of
+``BatchedKVCache`` objects. Between decode steps it retires rows that emitted
+a stop token or reached their own token limit, and admits queued prompts into
+the freed slots: new prompts are prefilled in a separate cache positioned so
+that their last token lands on the running batch's RoPE offset, then merged
+into the running cache with ``BatchedKVCache.extend``.
+"""
+
+from collections import deque
+from dataclasses import dataclass, field
+from typing import Callable, Deque, Generator, Iterable, List, Optional, Tuple
+
+import mlx.core as mx
+import mlx.nn as nn
+
+from models.base import BatchedKVCache, make_block_pools, make_cache
+
+
+@dataclass
+class Sequence:
+    uid: int
+    prompt: List[int]
+    max_tokens: int
+    tokens: List[int] = field(default_factory=list)
+    finish_reason: Optional[str] = None
+
+
+class BatchScheduler:
+    """
+    Continuous batching over a fixed number of decode slots.
+
+    Args:
+        model (nn.Module): The model to use for generation.
+        sampler (Callable): Maps ``(batch, vocab)`` logits to ``(batch, 1)``
+          tokens and optional log-probabilities, see
+          :func:`sample_utils.make_sampler`.
+        stop_token_ids (Iterable[int]): Tokens that finish a sequence.
+        pad_token_id (int): Token used to left-pad prompts admitted together.
+        max_batch_size (int): Number of sequences decoded concurrently.
+          Default: ``32``.
+        kv_blocks (int, optional): If set, rows share a paged KV cache of this
+          many blocks per layer, and a prompt is only admitted once the free
+          blocks can hold its prompt and ``max_tokens`` on top of what the
+          running rows may still need.
+        kv_block_size (int): Tokens per paged KV block. Default: ``64``.
+        kv_bits (int, optional): If set (``8`` or ``4``), store the KV cache
+          quantized to this many bits. Cannot be combined with ``kv_blocks``.
+        kv_group_size (int, optional): Group size for KV cache quantization,
+          see :func:`models.base.make_cache`.
+    """
+
+    def __init__(
+        self,
+        model: nn.Module,
+        sampler: Callable[[mx.array], Tuple[mx.array, mx.array]],
+        stop_token_ids: Iterable[int],
+        pad_token_id: int,
+        max_batch_size: int = 32,
+        kv_blocks: Optional[int] = None,
+        kv_block_size: int = 64,
+        kv_bits: Optional[int] = None,
+        kv_group_size: Optional[int] = None,
+    ):
+        self.model = model
+        self.sampler = sampler
+        self.stop_token_ids = set(stop_token_ids)
+        self.pad_token_id = pad_token_id
+        self.max_batch_size = max_batch_size
+        self.block_pools = (
+            make_block_pools(model, kv_blocks, kv_block_size) if kv_blocks else None
+        )
+        self.kv_bits = kv_bits
+        self.kv_group_size = kv_group_size
+
+        self.queue: Deque[Sequence] = deque()
+        self.active: List[Sequence] = []
+        self.cache: Optional[List[BatchedKVCache]] = None
+        # next input token of every active row, shape (batch,)
+        self.next_tokens: Optional[mx.array] = None
+        self._uid = 0
+
+    def add(self, prompt: List[int], max_tokens: int) -> int:
+        """Queue a tokenized prompt and return its sequence id."""
+        uid = self._uid
+        self._uid += 1
+        self.queue.append(Sequence(uid, list(prompt), max_tokens))
+        return uid
+
+    def has_work(self) -> bool:
+        return bool(self.queue or self.active)
+
+    def _blocks_needed(self, seq: Sequence) -> int:
+        block_size = self.block_pools[0].block_size
+        return (len(seq.prompt) + seq.max_tokens + block_size - 1) // block_size
+
+    def _can_admit(self, seq: Sequence, admitted: List[Sequence]) -> bool:
+        if self.block_pools is None:
+            return True
+        capacity = self.block_pools[0].num_blocks - 1
+        needed = self._blocks_needed(seq)
+        if needed > capacity:
+            raise ValueError(
+                f"Sequence {seq.uid} needs {needed} KV blocks but the pool only has {capacity}"
+            )
+        # every running row keeps its worst-case number of blocks reserved
+        reserved = sum(self._blocks_needed(s) for s in self.active + admitted)
+        return needed <= capacity - reserved
+
+    def _admit(self) -> List[Sequence]:
+        seqs = []
+        while (
+            self.queue
+            and len(self.active) + len(seqs) < self.max_batch_size
+            and self._can_admit(self.queue[0], seqs)
+        ):
+            seqs.append(self.queue.popleft())
+        if not seqs:
+            return []
+        n = len(seqs)
+
+        # left-pad the new prompts and prefill them so that their last token
+        # sits at the running batch's current position
+        length = max(len(s.prompt) for s in seqs)
+        left_padding = [length - len(s.prompt) for s in seqs]
+        prompts = mx.array(
+            [[self.pad_token_id] * p + s.prompt for p, s in zip(left_padding, seqs)]
+        )
+        offset = self.cache[0].offset - length if self.cache is not None else 0
+        cache = make_cache(
+            self.model, n, offset, left_padding, self.block_pools, self.kv_bits,
+            self.kv_group_size,
+        )
+
+        logits = self.model(prompts, cache=cache)[:, -1, :]
+        tokens, _ = self.sampler(logits)
+        tokens = tokens.reshape(-1)
+        for seq, token in zip(seqs, tokens.tolist()):
+            seq.tokens.append(token)
+
+        if self.cache is None:
+            self.cache = cache
+            self.next_tokens = tokens
+        else:
+            for c, new in zip(self.cache, cache):
+                c.extend(new)
+            self.next_tokens = mx.concatenate([self.next_tokens, tokens])
+        self.active.extend(seqs)
+        return seqs
+
+    def _retire(self) -> List[Sequence]:
+        finished, keep = [], []
+        for i, seq in enumerate(self.active):
+            if seq.tokens[-1] in self.stop_token_ids:
+                seq.finish_reason = "stop"
+            elif len(seq.tokens) >= seq.max_tokens:
+                seq.finish_reason = "length"
+            if seq.finish_reason is None:
+                keep.append(i)
+            else:
+                finished.append(seq)
+
+        if not finished:
+            return finished
+        for c in self.cache:
+            c.filter(keep)
+        if not keep:
+            self.active, self.cache, self.next_tokens = [], None, None
+            return finished
+
+        self.active = [self.active[i] for i in keep]
+        self.next_tokens = self.next_tokens[mx.array(keep)]
+        return finished
+
+    def _decode(self, logits: mx.array):
+        tokens, _ = self.sampler(logits)
+        self.next_tokens = tokens.reshape(-1)
+        for seq, token in zip(self.active, self.next_tokens.tolist()):
+            seq.tokens.append(token)
+
+    def step(self) -> List[Sequence]:
+        """
+        Run one scheduling iteration: admit queued prompts into free slots,
+        decode one token for every running row and retire finished rows.
+
+        Returns:
+            The sequences that finished during this iteration.
+        """
+        finished = []
+        if self._admit():
+            finished.extend(self._retire())
+
+        if self.active:
+            logits = self.model(self.next_tokens[:, None], cache=self.cache)
+            self._decode(logits[:, -1, :])
+            finished.extend(self._retire())
+        return finished
+
+    def run(self) -> Generator[Sequence, None, None]:
+        """Step until every queued sequence has finished, yielding them as they do."""
+        while self.has_work():
+            yield from self.step()
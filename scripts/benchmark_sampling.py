@@ -0,0 +1,71 @@
+#!/usr/bin/env python3
+"""
+Benchmark of the top-p samplers in sample_utils.
+
+Compares the full-vocabulary sort of ``top_p_sampling`` with the candidate
+path of ``sample_rows`` (``mx.argpartition`` down to ``MAX_CANDIDATES``
+tokens, top-p / top-k / min-p inside the candidates) on random logits.
+"""
+
+import argparse
+import sys
+import time
+from pathlib import Path
+
+import mlx.core as mx
+
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+from sample_utils import MAX_CANDIDATES, sample_rows, top_p_sampling
+
+
+def _time(fn, iters: int) -> float:
+    for _ in range(3):
+        mx.eval(fn())
+    tic = time.perf_counter()
+    for _ in range(iters):
+        mx.eval(fn())
+    return (time.perf_counter() - tic) / iters * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark top-p sampling")
+    parser.add_argument("--vocab-size", type=int, default=128256)
+    parser.add_argument("--batch-sizes", type=int, nargs="+", default=[1, 8, 32, 64, 256])
+    parser.add_argument("--top-p", type=float, default=0.9)
+    parser.add_argument("--temp", type=float, default=0.8)
+    parser.add_argument("--iters", type=int, default=20)
+    args = parser.parse_args()
+
+    print(f"vocab={args.vocab_size} top_p={args.top_p} temp={args.temp} candidates={MAX_CANDIDATES}")
+    print(f"{'batch':>6} {'sort (ms)':>10} {'candidates (ms)':>16} {'speedup':>8}")
+    for batch_size in args.batch_sizes:
+        # peaked logits, like a language model's
+        logits = mx.random.normal((batch_size, args.vocab_size)) * 4
+        temp = mx.full((batch_size,), args.temp)
+        top_p = mx.full((batch_size,), args.top_p)
+        top_k = mx.zeros((batch_size,), dtype=mx.int32)
+        min_p = mx.zeros((batch_size,))
+        mx.eval(logits, temp, top_p, top_k, min_p)
+
+        sort_ms = _time(lambda: top_p_sampling(logits, args.top_p, args.temp), args.iters)
+        candidates_ms = _time(
+            lambda: sample_rows(
+                logits,
+                temp,
+                top_p,
+                top_k,
+                min_p,
+                mx.random.gumbel((batch_size, MAX_CANDIDATES)),
+                MAX_CANDIDATES,
+            ),
+            args.iters,
+        )
+        print(
+            f"{batch_size:>6} {sort_ms:>10.2f} {candidates_ms:>16.2f} "
+            f"{sort_ms / candidates_ms:>7.1f}x"
+        )
+
+
+if __name__ == "__main__":
+    main()
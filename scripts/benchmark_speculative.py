@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+"""
+Benchmark of speculative decoding for a target / draft model pair, or for
+prompt lookup without a draft model.
+
+Decodes the same prompts greedily without speculation and with every given
+number of draft tokens, and reports the acceptance rate, the tokens emitted
+per target forward and the effective tokens per second, to pick
+``num_draft_tokens`` for the pair.
+"""
+
+import argparse
+import sys
+import time
+from pathlib import Path
+
+import mlx.core as mx
+
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+from speculative import SpeculativeStats, speculative_generate_step
+from utils import _set_left_padding, generate_step, load
+
+PROMPTS = [
+    "Write a Python function that checks whether a number is prime.",
+    "Explain the difference between a process and a thread.",
+    "List five facts about the Moon.",
+    "Summarize the plot of Romeo and Juliet in three sentences.",
+    "Repeat this sentence with every word capitalized: the quick brown fox jumps "
+    "over the lazy dog while the cat watches from the old wooden fence.",
+]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark speculative decoding")
+    parser.add_argument("--model", default="mlx-community/Meta-Llama-3-8B-Instruct-4bit")
+    parser.add_argument("--draft-model", help="Draft model, default: prompt lookup")
+    parser.add_argument("--prompt-lookup-ngram", type=int, default=3)
+    parser.add_argument("--num-draft-tokens", type=int, nargs="+", default=[2, 3, 4, 6, 8])
+    parser.add_argument("--batch-sizes", type=int, nargs="+", default=[1, 4])
+    parser.add_argument("--max-tokens", type=int, default=128)
+    args = parser.parse_args()
+
+    model, tokenizer = load(args.model)
+    draft_model = load(args.draft_model)[0] if args.draft_model else None
+    _set_left_padding(tokenizer)
+
+    draft = args.draft_model or f"prompt lookup ({args.prompt_lookup_ngram}-grams)"
+    print(f"target={args.model} draft={draft} max_tokens={args.max_tokens}")
+    print(f"{'batch':>6} {'k':>3} {'accepted':>9} {'tok/step':>9} {'tok/s':>9} {'speedup':>8}")
+    for batch_size in args.batch_sizes:
+        prompts = [PROMPTS[i % len(PROMPTS)] for i in range(batch_size)]
+        encoded = tokenizer._tokenizer(prompts, padding=True)
+        inputs = mx.array(encoded["input_ids"])
+        left_padding = [len(m) - sum(m) for m in encoded["attention_mask"]]
+
+        tic = time.perf_counter()
+        for (tokens, _), _ in zip(
+            generate_step(inputs, model, left_padding=left_padding), range(args.max_tokens)
+        ):
+            pass
+        baseline = args.max_tokens / (time.perf_counter() - tic)
+        print(f"{batch_size:>6} {'-':>3} {'-':>9} {1.0:>9.2f} {baseline:>9.1f} {1.0:>7.2f}x")
+
+        for k in args.num_draft_tokens:
+            stats = SpeculativeStats(k)
+            for _ in speculative_generate_step(
+                inputs,
+                model,
+                draft_model,
+                num_draft_tokens=k,
+                prompt_lookup_ngram=args.prompt_lookup_ngram,
+                max_tokens=[args.max_tokens] * batch_size,
+                left_padding=left_padding,
+                stats=stats,
+            ):
+                pass
+            print(
+                f"{batch_size:>6} {k:>3} {stats.acceptance_rate:>8.1%} "
+                f"{stats.tokens_per_step:>9.2f} {stats.tokens_per_sec:>9.1f} "
+                f"{stats.tokens_per_sec / baseline:>7.2f}x"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,337 @@
+"""
+Speculative decoding for batched generation.
+
+Up to ``num_draft_tokens`` tokens per row are proposed cheaply and the target
+model scores all of them in a single forward over its ``BatchedKVCache``.
+Draft tokens are accepted with the usual speculative sampling rule (exact
+match under greedy decoding), so the output follows the target model's
+distribution. Caches are rewound past the rejected positions with
+:meth:`models.base.BatchedKVCache.rewind`.
+
+Drafts come from one of:
+
+- :class:`ModelDrafter`: a small draft model, one cheap forward per token.
+- :class:`PromptLookupDrafter`: no model at all. The last generated tokens
+  are looked up in the prompt and the tokens that followed them there are
+  proposed, which pays off when the output copies spans of the prompt
+  (extraction, rewriting).
+
+The rows of a batch share one cache length, so they all advance by the
+fewest draft tokens any running row accepted, plus one token from the
+target. Speculation therefore pays off most for single streams and small
+batches, where decoding is bound by memory bandwidth.
+
+A draft model must use the target model's tokenizer.
+"""
+
+import time
+from dataclasses import dataclass, field
+from typing import Dict, Generator, List, Optional, Tuple
+
+import mlx.core as mx
+import mlx.nn as nn
+
+from models.base import make_cache
+
+
+@dataclass
+class SpeculativeStats:
+    """Counters of a speculative decoding run, to choose ``num_draft_tokens``"""
+
+    num_draft_tokens: int
+    # target forwards verifying draft tokens
+    steps: int = 0
+    # draft tokens proposed and accepted, over running rows
+    drafted: int = 0
+    accepted: int = 0
+    # tokens emitted per row, including the first one after the prompt
+    tokens: int = 0
+    start: float = field(default_factory=time.perf_counter)
+
+    @property
+    def acceptance_rate(self) -> float:
+        return self.accepted / self.drafted if self.drafted else 0.0
+
+    @property
+    def tokens_per_step(self) -> float:
+        """Tokens per row per target forward, ``1`` without speculation"""
+        return (self.tokens - 1) / self.steps if self.steps else 0.0
+
+    @property
+    def tokens_per_sec(self) -> float:
+        """Tokens per row per second since the stats were created"""
+        return self.tokens / (time.perf_counter() - self.start)
+
+
+class ModelDrafter:
+    """
+    Proposes draft tokens by sampling a smaller model.
+
+    Args:
+        draft_model (nn.Module): The draft model.
+        prompts (mx.array): The left-padded prompts, shape ``(batch, ntoks)``.
+        left_padding (List[int], optional): Number of padding tokens at the
+          start of each prompt row.
+    """
+
+    def __init__(
+        self, draft_model: nn.Module, prompts: mx.array, left_padding: Optional[List[int]] = None
+    ):
+        self.model = draft_model
+        self.cache = make_cache(draft_model, prompts.shape[0], left_padding=left_padding)
+        draft_model(prompts, cache=self.cache)
+        # tokens the draft model has not seen yet, ending with the last one
+        self.pending = None
+
+    def propose(self, k: int, sample) -> Tuple[mx.array, Optional[mx.array]]:
+        """The ``(batch, k)`` draft tokens and their ``(batch, k, vocab)`` logits"""
+        tokens, logits = [], []
+        inputs = self.pending
+        for _ in range(k):
+            lq = self.model(inputs, cache=self.cache)[:, -1, :]
+            inputs = sample(lq)[:, None]
+            tokens.append(inputs)
+            logits.append(lq)
+        return mx.concatenate(tokens, axis=1), mx.stack(logits, axis=1)
+
+    def accept(self, tokens: mx.array, m: int, k: int):
+        """
+        Account for the emitted ``tokens``: the first ``m`` of ``k`` draft
+        tokens and one more.
+        """
+        if self.pending is None or m < k:
+            # the cache holds the pending tokens and all but the last draft
+            # token; keep it up to draft token m
+            for c in self.cache:
+                c.rewind(max(k - 1 - m, 0))
+            self.pending = tokens[:, -1:]
+        else:
+            self.pending = tokens[:, -2:]
+
+
+class PromptLookupDrafter:
+    """
+    Proposes the tokens that followed the latest earlier occurrence of each
+    row's last ``ngram_size`` tokens (falling back to shorter n-grams) in its
+    prompt and output so far.
+
+    Every row keeps, per n-gram length, a dict from n-gram to the position
+    where it last ended, updated as tokens are emitted, so a lookup costs
+    ``ngram_size`` dict lookups per row.
+
+    Args:
+        prompts (List[List[int]]): The unpadded prompt tokens of every row.
+        ngram_size (int): Longest n-gram matched. Default: ``3``.
+    """
+
+    def __init__(self, prompts: List[List[int]], ngram_size: int = 3):
+        if ngram_size < 1:
+            raise ValueError(f"ngram_size must be at least 1, got {ngram_size}")
+        self.ngram_size = ngram_size
+        self.history: List[List[int]] = []
+        self.index: List[List[Dict[Tuple[int, ...], int]]] = []
+        for prompt in prompts:
+            self.history.append([])
+            self.index.append([{} for _ in range(ngram_size)])
+            self._extend(len(self.history) - 1, prompt)
+
+    def _extend(self, row: int, tokens: List[int]):
+        history, index = self.history[row], self.index[row]
+        for token in tokens:
+            # index the n-grams ending at the previous token, which now have
+            # a continuation
+            end = len(history) - 1
+            for n in range(1, min(self.ngram_size, end + 1) + 1):
+                index[n - 1][tuple(history[end - n + 1 : end + 1])] = end
+            history.append(token)
+
+    def _lookup(self, row: int, k: int) -> List[int]:
+        history, index = self.history[row], self.index[row]
+        for n in range(min(self.ngram_size, len(history)), 0, -1):
+            end = index[n - 1].get(tuple(history[-n:]))
+            if end is not None:
+                return history[end + 1 : end + 1 + k]
+        return []
+
+    def propose(self, k: int, sample) -> Tuple[mx.array, Optional[mx.array]]:
+        """
+        The ``(batch, k')`` draft tokens, ``k' <= k``, and ``None`` since the
+        drafts are deterministic. Rows with shorter matches are filled up
+        with their last token.
+        """
+        drafts = [self._lookup(row, k) for row in range(len(self.history))]
+        width = max(len(d) for d in drafts)
+        rows = [d + [h[-1]] * (width - len(d)) for d, h in zip(drafts, self.history)]
+        return mx.array(rows, dtype=mx.int32).reshape(len(rows), width), None
+
+    def accept(self, tokens: mx.array, m: int, k: int):
+        for row, emitted in enumerate(tokens.tolist()):
+            self._extend(row, emitted)
+
+
+def speculative_generate_step(
+    prompts: mx.array,
+    model: nn.Module,
+    draft_model: Optional[nn.Module] = None,
+    num_draft_tokens: int = 4,
+    prompt_lookup_ngram: Optional[int] = None,
+    temp: float = 0.0,
+    seed: Optional[int] = None,
+    max_tokens: Optional[List[int]] = None,
+    stop_token_ids: Optional[List[int]] = None,
+    pad_token_id: Optional[int] = None,
+    left_padding: Optional[List[int]] = None,
+    stats: Optional[SpeculativeStats] = None,
+) -> Generator[mx.array, None, None]:
+    """
+    A generator producing token ids with speculative decoding.
+
+    Args:
+        prompts (mx.array): The left-padded prompts, shape ``(batch, ntoks)``.
+        model (nn.Module): The target model.
+        draft_model (nn.Module, optional): The model proposing draft tokens,
+          see :class:`ModelDrafter`.
+        num_draft_tokens (int): Most draft tokens proposed per step.
+          Default: ``4``.
+        prompt_lookup_ngram (int, optional): Without a ``draft_model``, the
+          longest n-gram of generated tokens looked up in the prompt, see
+          :class:`PromptLookupDrafter`. Default: ``3``.
+        temp (float): The temperature for sampling, if 0 the argmax is used.
+          Default: ``0``.
+        seed (int, optional): Seed for sampling and acceptance.
+        max_tokens (List[int], optional): Token limit of each row.
+        stop_token_ids (List[int], optional): Tokens that finish a row. Later
+          tokens of a finished row are ``pad_token_id``, and the generator
+          returns once every row is finished.
+        pad_token_id (int, optional): Token emitted for finished rows.
+          Default: the first of ``stop_token_ids``.
+        left_padding (List[int], optional): Number of padding tokens at the
+          start of each prompt row.
+        stats (SpeculativeStats, optional): Updated with the number of
+          drafted, accepted and emitted tokens.
+
+    Yields:
+        Generator[mx.array]: ``(batch, n)`` arrays of tokens, where ``n``
+        varies between steps.
+    """
+    k = num_draft_tokens
+    if k < 1:
+        raise ValueError(f"num_draft_tokens must be at least 1, got {k}")
+    B = prompts.shape[0]
+    key = mx.random.key(seed) if seed is not None else None
+
+    def _key():
+        nonlocal key
+        if key is None:
+            return None
+        key, sub = mx.random.split(key)
+        return sub
+
+    def _sample(logits):
+        if temp == 0:
+            return mx.argmax(logits, axis=-1)
+        return mx.random.categorical(logits * (1 / temp), key=_key())
+
+    stop_tokens = mx.array(stop_token_ids) if stop_token_ids else None
+    limits = mx.array(max_tokens)[:, None] if max_tokens else None
+    pad_token = pad_token_id
+    if pad_token is None:
+        pad_token = stop_token_ids[0] if stop_token_ids else 0
+    done = mx.zeros((B, 1), dtype=mx.bool_)
+    n_tokens = 0
+
+    def _finish(tokens):
+        """Pad every token after a row finished and update ``done``"""
+        nonlocal done, n_tokens
+        n = tokens.shape[1]
+        finished = mx.broadcast_to(done, tokens.shape)
+        if stop_tokens is not None:
+            is_stop = mx.any(tokens[..., None] == stop_tokens, axis=-1)
+            # positions after the first stop token of the chunk
+            finished = finished | ((mx.cumsum(is_stop, axis=1) - is_stop) > 0)
+        if limits is not None:
+            finished = finished | (limits <= n_tokens + mx.arange(n)[None])
+        tokens = mx.where(finished, pad_token, tokens)
+        n_tokens += n
+        if stop_tokens is not None:
+            done = done | mx.any(is_stop, axis=1, keepdims=True)
+        if limits is not None:
+            done = done | (limits <= n_tokens)
+        return tokens
+
+    cache = make_cache(model, B, left_padding=left_padding)
+    logits = model(prompts, cache=cache)[:, -1, :]
+    if draft_model is not None:
+        drafter = ModelDrafter(draft_model, prompts, left_padding)
+    else:
+        padding = left_padding or [0] * B
+        drafter = PromptLookupDrafter(
+            [row[p:] for row, p in zip(prompts.tolist(), padding)], prompt_lookup_ngram or 3
+        )
+    y = _finish(_sample(logits)[:, None])
+    drafter.accept(y, 0, 0)
+    if stats is not None:
+        stats.tokens += 1
+    yield y
+
+    while not done.all().item():
+        # draft tokens, with their logits for the acceptance test unless
+        # they are deterministic
+        draft_tokens, draft_logits = drafter.propose(k, _sample)
+        n_draft = draft_tokens.shape[1]
+
+        # score y and all draft tokens in one target forward
+        lp = model(mx.concatenate([y, draft_tokens], axis=1), cache=cache)
+        if temp == 0:
+            target = mx.argmax(lp, axis=-1)
+            accept = target[:, :n_draft] == draft_tokens
+        else:
+            if draft_logits is not None:
+                # the models may pad their vocabularies differently
+                vocab = min(lp.shape[-1], draft_logits.shape[-1])
+                p = mx.softmax(lp[..., :vocab] * (1 / temp), axis=-1)
+                q = mx.softmax(draft_logits[..., :vocab] * (1 / temp), axis=-1)
+                q_draft = mx.take_along_axis(q, draft_tokens[..., None], axis=-1)[..., 0]
+            else:
+                p = mx.softmax(lp * (1 / temp), axis=-1)
+                q_draft = 1.0
+            p_draft = mx.take_along_axis(p[:, :n_draft], draft_tokens[..., None], axis=-1)[..., 0]
+            accept = mx.random.uniform(shape=p_draft.shape, key=_key()) * q_draft < p_draft
+        # leading accepted draft tokens per row; finished rows do not hold back the rest
+        n_accepted = mx.cumprod(accept.astype(mx.int32), axis=1).sum(axis=1)
+        n_accepted = mx.where(done[:, 0], n_draft, n_accepted)
+        m = n_accepted.min().item()
+
+        # every row emits the first m draft tokens and one more: the accepted
+        # draft token m + 1, or a sample from the target for the rows that
+        # rejected it (from the residual distribution when sampling)
+        if temp == 0:
+            last = target[:, m]
+        elif m == n_draft:
+            last = mx.random.categorical(mx.log(p[:, m]), key=_key())
+        else:
+            if draft_logits is not None:
+                residual = mx.maximum(p[:, m] - q[:, m], 0)
+            else:
+                residual = mx.put_along_axis(
+                    p[:, m], draft_tokens[:, m : m + 1], mx.array(0.0, p.dtype), axis=-1
+                )
+            last = mx.where(
+                n_accepted > m,
+                draft_tokens[:, m],
+                mx.random.categorical(mx.log(residual), key=_key()),
+            )
+        if stats is not None:
+            live = ~done[:, 0]
+            stats.steps += 1
+            stats.drafted += n_draft * live.sum().item()
+            stats.accepted += mx.where(live, n_accepted, 0).sum().item()
+            stats.tokens += m + 1
+        tokens = _finish(mx.concatenate([draft_tokens[:, :m], last[:, None]], axis=1))
+
+        # the target cache holds y and all draft tokens; keep it up to draft token m
+        for c in cache:
+            c.rewind(n_draft - m)
+        drafter.accept(tokens, m, n_draft)
+        y = tokens[:, -1:]
+        yield tokens
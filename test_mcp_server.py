@@ -7,6 +7,7 @@ import asyncio
 import json
 import subprocess
 import sys
+import time
 
 async def test_fastmcp_mlx_server():
     """Test the FastMCP MLX server"""
@@ -166,11 +167,39 @@ async def test_fastmcp_mlx_server():
                 if result.get('isError'):
                     print(f"❌ Batch generation returned error: {result['content'][0]['text']}")
                 else:
-                    print(f"✅ Batch generation success: {result['content'][0]['text'][:300]}...")
+                    print(f"✅ Batch generation queued: {result['content'][0]['text'][:300]}...")
+                    job_id = json.loads(result['content'][0]['text'])['job_id']
         else:
             print("❌ No response to batch generation")
             return False
         
+        # Poll the job until the worker thread finished it
+        print("⏳ Waiting for the batch generation job (this may take time for batch processing)...")
+        for request_id in range(6, 606):
+            status_request = {
+                "jsonrpc": "2.0",
+                "id": request_id,
+                "method": "tools/call",
+                "params": {
+                    "name": "get_job_status",
+                    "arguments": {"job_id": job_id}
+                }
+            }
+            process.stdin.write(json.dumps(status_request) + "\n")
+            process.stdin.flush()
+            response_line = process.stdout.readline()
+            if not response_line:
+                print("❌ No response to job status")
+                return False
+            job = json.loads(json.loads(response_line.strip())['result']['content'][0]['text'])
+            if job['status'] in ("completed", "failed", "cancelled"):
+                break
+            time.sleep(0.5)
+        if job['status'] != "completed":
+            print(f"❌ Batch generation job {job['status']}: {job.get('error')}")
+            return False
+        print(f"✅ Batch generation success: {json.dumps(job['result'])[:300]}...")
+        
         print("\n🎉 MLX MCP server works correctly!")
         return True
         
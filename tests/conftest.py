@@ -0,0 +1,96 @@
+"""
+Shared fixtures: a temporary results database and a tiny random-weight
+model, so the tests run on CPU without downloading anything
+"""
+
+import json
+import sys
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+import database  # noqa: E402
+
+CORPUS = [
+    "the quick brown fox jumps over the lazy dog",
+    '{"name": "Ada", "age": 36, "tags": ["math", "code"], "ok": true}',
+    "def add(a, b):\n    return a + b",
+    "0123456789 abc xyz ABC XYZ .,;:!? -_+=*/ () [] {} <> \" '",
+]
+
+
+def _make_model(path: Path, **config_overrides):
+    import mlx.core as mx
+    from mlx.utils import tree_flatten
+    from tokenizers import Tokenizer, decoders, models, pre_tokenizers, trainers
+    from transformers import PreTrainedTokenizerFast
+
+    from utils import _get_classes
+
+    tokenizer = Tokenizer(models.BPE())
+    tokenizer.pre_tokenizer = pre_tokenizers.ByteLevel(add_prefix_space=False)
+    tokenizer.decoder = decoders.ByteLevel()
+    trainer = trainers.BpeTrainer(
+        vocab_size=400,
+        special_tokens=["<eos>", "<pad>"],
+        initial_alphabet=pre_tokenizers.ByteLevel.alphabet(),
+    )
+    tokenizer.train_from_iterator(CORPUS * 10, trainer)
+    fast = PreTrainedTokenizerFast(tokenizer_object=tokenizer, eos_token="<eos>")
+    fast.chat_template = (
+        "{% for m in messages %}<|{{ m['role'] }}|>{{ m['content'] }}{% endfor %}"
+        "{% if add_generation_prompt %}<|assistant|>{% endif %}"
+    )
+    fast.save_pretrained(path)
+
+    config = dict(
+        model_type="llama", hidden_size=64, num_hidden_layers=2, intermediate_size=128,
+        num_attention_heads=4, num_key_value_heads=2, rms_norm_eps=1e-5,
+        vocab_size=len(fast), tie_word_embeddings=True, head_dim=16,
+    )
+    config.update(config_overrides)
+    (path / "config.json").write_text(json.dumps(config))
+    model_class, args_class = _get_classes(config)
+    model = model_class(args_class.from_dict(config))
+    mx.random.seed(0)
+    weights = {
+        k: v if "norm" in k else mx.random.normal(v.shape) * 0.5
+        for k, v in tree_flatten(model.parameters())
+    }
+    mx.save_safetensors(str(path / "model.safetensors"), weights)
+
+
+@pytest.fixture(scope="session")
+def tiny_model_path(tmp_path_factory) -> str:
+    path = tmp_path_factory.mktemp("tiny-llama")
+    _make_model(path)
+    return str(path)
+
+
+@pytest.fixture(scope="session")
+def tiny_model(tiny_model_path):
+    from utils import load
+
+    return load(tiny_model_path)
+
+
+@pytest.fixture(scope="session")
+def phi3_head_model(tmp_path_factory):
+    """Tiny model with Phi-3's head dimension of 96, not a multiple of 64"""
+    from utils import load
+
+    path = tmp_path_factory.mktemp("tiny-llama-96")
+    _make_model(path, hidden_size=192, num_attention_heads=2, head_dim=96)
+    return load(str(path))
+
+
+@pytest.fixture
+def db(tmp_path, monkeypatch):
+    """A fresh, initialized results database in tmp_path"""
+    monkeypatch.setattr(database, "DB_PATH", str(tmp_path / "results.db"))
+    monkeypatch.setattr(database, "EXPORT_DIR", str(tmp_path / "exports"))
+    database.init_database()
+    yield database.DB_PATH
+    database.result_writer.flush()
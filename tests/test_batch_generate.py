@@ -0,0 +1,134 @@
+"""Batched greedy generation matches generating every prompt on its own"""
+
+import mlx.core as mx
+import pytest
+
+from utils import batch_generate, continuous_batch_generate, generate_step, plan_batches
+
+CORPUS_LINE = "the quick brown fox jumps over the lazy dog " * 3
+
+PROMPTS = [
+    "the quick brown fox",
+    "a b",
+    "def add(a, b):\n    return",
+    "0123456789 abc xyz ABC",
+]
+
+
+def one_by_one(model, tokenizer, prompts, max_tokens):
+    limits = max_tokens if isinstance(max_tokens, list) else [max_tokens] * len(prompts)
+    return [
+        batch_generate(model, tokenizer, [prompt], max_tokens=limit, format_prompts=False)[0]
+        for prompt, limit in zip(prompts, limits)
+    ]
+
+
+@pytest.mark.parametrize("max_tokens", [8, [3, 10, 1, 6]])
+@pytest.mark.parametrize("max_batch_size", [1, 2, 4])
+def test_continuous_batching_matches_single_prompts(tiny_model, max_tokens, max_batch_size):
+    model, tokenizer = tiny_model
+    responses = continuous_batch_generate(
+        model, tokenizer, PROMPTS, max_tokens=max_tokens, max_batch_size=max_batch_size,
+        format_prompts=False,
+    )
+
+    assert responses == one_by_one(model, tokenizer, PROMPTS, max_tokens)
+
+
+def test_continuous_batching_reports_progress_per_prompt(tiny_model):
+    model, tokenizer = tiny_model
+    calls = []
+
+    def progress(lengths, finished):
+        calls.append((list(lengths), list(finished)))
+
+    continuous_batch_generate(
+        model, tokenizer, PROMPTS, max_tokens=[2, 5, 3, 4], max_batch_size=2,
+        format_prompts=False, progress=progress,
+    )
+
+    # the first two prompts run first, the others take their slots
+    assert calls[0][0][2:] == [0, 0]
+    assert calls[-1] == ([2, 5, 3, 4], [True] * 4)
+
+
+class ForceEos:
+    """Make row ``i`` produce ``eos`` at decode step ``steps[i]``"""
+
+    def __init__(self, eos, steps):
+        self.eos = eos
+        self.steps = mx.array(steps)[:, None]
+        self.n = 0
+
+    def __call__(self, logits):
+        vocab = mx.arange(logits.shape[-1])
+        return mx.where((self.steps == self.n) & (vocab == self.eos), 1e9, logits)
+
+    def update(self, tokens):
+        self.n += 1
+
+
+def test_decoding_stops_once_every_row_produced_eos(tiny_model):
+    model, tokenizer = tiny_model
+    eos, pad = tokenizer.eos_token_id, 1
+    prompts = mx.array([[5, 6, 7], [8, 9, 10]])
+    steps = list(
+        generate_step(
+            prompts, model, stop_token_ids=[eos], pad_token_id=pad,
+            logits_processors=[ForceEos(eos, [1, 3])],
+        )
+    )
+    tokens = mx.concatenate([t for t, _ in steps], axis=1).tolist()
+
+    assert len(steps) == 4
+    assert tokens[0][1:] == [eos, pad, pad]
+    assert tokens[1][3] == eos and eos not in tokens[1][:3]
+
+
+def test_batch_generate_returns_at_eos_instead_of_max_tokens(tiny_model):
+    model, tokenizer = tiny_model
+    calls = []
+    responses = batch_generate(
+        model, tokenizer, PROMPTS[:2], max_tokens=50, format_prompts=False,
+        logits_processors=[ForceEos(tokenizer.eos_token_id, [2, 4])],
+        progress=lambda lengths, finished: calls.append(list(lengths)),
+    )
+    greedy = one_by_one(model, tokenizer, PROMPTS[:2], [2, 4])
+
+    assert len(calls) == 5
+    assert calls[-1] == [2, 4]
+    assert responses == greedy
+
+
+def test_left_padded_rows_match_single_prompts(tiny_model):
+    model, tokenizer = tiny_model
+    # one long prompt pads every other row with many tokens
+    prompts = ["a", CORPUS_LINE, "a b", "def add(a, b):"]
+    responses = batch_generate(
+        model, tokenizer, prompts, max_tokens=8, format_prompts=False, min_shared_prefix=None
+    )
+
+    assert responses == one_by_one(model, tokenizer, prompts, 8)
+
+
+def test_plan_batches_groups_similar_lengths_under_the_budget():
+    lengths = [5, 1, 9, 2, 5, 30]
+    batches = plan_batches(lengths, max_batch_tokens=12)
+
+    assert sorted(i for batch in batches for i in batch) == list(range(len(lengths)))
+    assert batches == [[1, 3], [0, 4], [2], [5]]
+    for batch in batches:
+        assert len(batch) == 1 or len(batch) * max(lengths[i] for i in batch) <= 12
+
+
+@pytest.mark.parametrize("max_batch_tokens", [1, 12, 1000])
+def test_bucketed_batches_keep_prompt_order(tiny_model, max_batch_tokens):
+    model, tokenizer = tiny_model
+    prompts = PROMPTS + [CORPUS_LINE]
+    responses, logprobs = batch_generate(
+        model, tokenizer, prompts, max_tokens=[4, 6, 2, 5, 3], format_prompts=False,
+        max_batch_tokens=max_batch_tokens, logprobs=True,
+    )
+
+    assert responses == one_by_one(model, tokenizer, prompts, [4, 6, 2, 5, 3])
+    assert [len(lp) for lp in logprobs] == [4, 6, 2, 5, 3]
@@ -0,0 +1,245 @@
+"""Regular-expression and JSON-schema constrained decoding"""
+
+import json
+import re
+
+import mlx.core as mx
+import pytest
+
+from constrained import _WS, TokenAutomaton, compile_regex, json_schema_regex
+from utils import batch_generate
+
+
+class BoostEos:
+    """Stateful processor that makes EOS the most likely token"""
+
+    def __init__(self, eos_token_id):
+        self.eos_token_id = eos_token_id
+
+    @property
+    def state(self):
+        return []
+
+    def apply(self, logits):
+        is_eos = mx.arange(logits.shape[-1]) == self.eos_token_id
+        return mx.where(is_eos, 100.0, logits).astype(logits.dtype)
+
+    def update(self, tokens):
+        pass
+
+
+def test_grammar_is_applied_after_other_processors(tiny_model):
+    model, tokenizer = tiny_model
+    responses = batch_generate(
+        model, tokenizer, ["a b", "c d e"], max_tokens=12, format_prompts=False,
+        json_schema={"type": "boolean"},
+        logits_processors=[BoostEos(tokenizer.eos_token_id)],
+    )
+
+    assert [type(json.loads(r)) for r in responses] == [bool, bool]
+
+
+def test_grammar_is_applied_after_plain_callables(tiny_model):
+    model, tokenizer = tiny_model
+    eos = tokenizer.eos_token_id
+
+    def boost_eos(logits):
+        return mx.where(mx.arange(logits.shape[-1]) == eos, 100.0, logits).astype(logits.dtype)
+
+    responses = batch_generate(
+        model, tokenizer, ["a b", "c d e"], max_tokens=12, format_prompts=False,
+        json_schema={"type": "boolean"}, logits_processors=[boost_eos],
+    )
+
+    assert [type(json.loads(r)) for r in responses] == [bool, bool]
+
+
+def test_stop_sequences_are_rejected_with_a_grammar(tiny_model):
+    model, tokenizer = tiny_model
+    # '"' ends a row long before the object is complete
+    schema = {"type": "object", "properties": {"name": {"type": "string"}}}
+    with pytest.raises(ValueError):
+        batch_generate(
+            model, tokenizer, ["a b"], max_tokens=12, format_prompts=False,
+            json_schema=schema, stop_sequences=['"'],
+        )
+    with pytest.raises(ValueError):
+        batch_generate(
+            model, tokenizer, ["a b", "c"], max_tokens=12, format_prompts=False,
+            regex=[None, "[a-z]+"], stop_sequences=["z"],
+        )
+
+
+def matches(pattern, text):
+    """Whether the DFA of pattern accepts all of text (str or bytes)"""
+    delta, accepting = compile_regex(pattern)
+    state = 0
+    for b in text.encode("utf-8") if isinstance(text, str) else text:
+        state = delta[state][b]
+        if state < 0:
+            return False
+    return accepting[state]
+
+
+@pytest.mark.parametrize("pattern, accepted, rejected", [
+    ("abc", ["abc"], ["", "ab", "abcd", "abd"]),
+    ("a|bc|", ["a", "bc", ""], ["b", "abc"]),
+    ("a(b|c)d", ["abd", "acd"], ["ad", "abcd"]),
+    ("(?:ab)+", ["ab", "abab"], ["", "aba"]),
+    ("a*", ["", "a", "aaaa"], ["b", "ab"]),
+    ("a+b?", ["a", "aab"], ["", "b", "abb"]),
+    ("a{3}", ["aaa"], ["aa", "aaaa"]),
+    ("a{2,}", ["aa", "aaaaa"], ["a"]),
+    ("a{1,3}", ["a", "aaa"], ["", "aaaa"]),
+    ("(ab){0,2}c", ["c", "abc", "ababc"], ["abababc"]),
+    ("[a-c]x", ["ax", "cx"], ["dx", "x"]),
+    ("[^a-c]", ["d", "-", "é"], ["a", "c", ""]),
+    ("[-a]", ["-", "a"], ["b"]),
+    ("[\\d_]+", ["0_9"], ["a"]),
+    ("\\d+", ["0", "123"], ["", "1a"]),
+    ("\\w\\s\\w", ["a b", "_\t9"], ["ab", "a-b"]),
+    ("\\D\\W\\S", ["a-b", "x!é"], ["1-b", "aab", "a- "]),
+    ("a.c", ["abc", "a c", "aéc", "a😀c"], ["a\nc", "ac"]),
+    ("\\.\\*\\n", [".*\n"], ["a*\n"]),
+    ("\\x41\\u00e9", ["Aé"], ["A"]),
+    ("^ab$", ["ab"], ["abab"]),
+])
+def test_regex_features(pattern, accepted, rejected):
+    # same answers as Python's re
+    for text in accepted:
+        assert matches(pattern, text) and re.fullmatch(pattern, text), text
+    for text in rejected:
+        assert not matches(pattern, text) and not re.fullmatch(pattern, text), text
+
+
+@pytest.mark.parametrize("pattern", ["(ab", "a)", "*a", "a|*", "\\xZZ", "[é]", "[a-\\d]", "[^\\s\\S]"])
+def test_invalid_regexes_are_rejected(pattern):
+    with pytest.raises(ValueError):
+        compile_regex(pattern)
+
+
+@pytest.mark.parametrize("data", [
+    b"\xff",  # never valid in UTF-8
+    b"\x80",  # continuation byte without a lead byte
+    b"\xc3",  # truncated sequence
+    b"\xc0\x80",  # overlong encoding of NUL
+    b"\xe0\x80\x80",  # overlong 3-byte sequence
+    b"\xed\xa0\x80",  # UTF-16 surrogate
+    b"\xf4\x90\x80\x80",  # above U+10FFFF
+])
+def test_wildcards_only_match_well_formed_utf8(data):
+    for pattern in (".", "[^a]", "\\S", json_schema_regex({"type": "string"})):
+        text = b'"' + data + b'"' if pattern.startswith(_WS) else data
+        assert not matches(pattern, text), (pattern, data)
+
+
+def test_wildcards_match_every_utf8_length():
+    for char in ["a", "é", "€", "😀", "\U0010ffff"]:
+        assert matches(".", char)
+        assert matches(json_schema_regex({"type": "string"}), json.dumps(char, ensure_ascii=False))
+
+
+DEFS = {"$defs": {"point": {"type": "object", "properties": {"x": {"type": "integer"}}}}}
+
+
+@pytest.mark.parametrize("schema, valid, invalid", [
+    ({"type": "string"}, ["", "a b", 'quote " and \\ backslash', "\n", "é€😀"], [1, None]),
+    ({"type": "string", "minLength": 1, "maxLength": 3}, ["a", "abc"], ["", "abcd"]),
+    ({"type": "string", "pattern": "^[a-z]+$"}, ["abc"], ["", "aB"]),
+    ({"type": "integer"}, [0, -7, 123], [1.5, "1", True]),
+    ({"type": "number"}, [0, -1.5, 2e10, 3.25e-3], ["1", None]),
+    ({"type": "boolean"}, [True, False], [0, "true"]),
+    ({"type": "null"}, [None], [0, ""]),
+    ({"enum": ["a", 1, None]}, ["a", 1, None], ["b", 2]),
+    ({"const": "fixed"}, ["fixed"], ["other", None]),
+    ({"type": "array", "items": {"type": "integer"}}, [[], [1], [1, 2, 3]], [[1.5], ["a"]]),
+    ({"type": "array", "items": {"type": "boolean"}, "minItems": 1, "maxItems": 2},
+     [[True], [True, False]], [[], [True, True, True]]),
+    ({"type": "array", "items": {"type": "null"}, "maxItems": 0}, [[]], [[None]]),
+    ({"type": "object", "properties": {}}, [{}], [{"a": 1}]),
+    ({"type": "object", "properties": {"a": {"type": "integer"}, "b": {"type": "string"}}},
+     [{"a": 1, "b": "x"}], [{"a": 1}, {"b": "x", "a": 1}, {"a": 1, "b": "x", "c": 2}]),
+    ({"type": "object", "properties": {"a": {"type": "integer"}, "b": {"type": "integer"},
+                                       "c": {"type": "integer"}}, "required": ["b"]},
+     [{"b": 1}, {"a": 0, "b": 1}, {"b": 1, "c": 2}, {"a": 0, "b": 1, "c": 2}], [{"a": 0}, {}]),
+    ({"anyOf": [{"type": "integer"}, {"type": "null"}]}, [1, None], ["1"]),
+    ({"oneOf": [{"type": "boolean"}, {"const": "x"}]}, [True, "x"], ["y"]),
+    ({"type": ["string", "integer"]}, ["a", 1], [None]),
+    ({**DEFS, "$ref": "#/$defs/point"}, [{"x": 1}], [{"y": 1}]),
+    ({"definitions": DEFS["$defs"], "type": "array", "items": {"$ref": "#/definitions/point"}},
+     [[{"x": 1}]], [[{"x": "1"}]]),
+])
+def test_json_schema_regex(schema, valid, invalid):
+    pattern = json_schema_regex(schema)
+    for value in valid:
+        for text in (json.dumps(value, ensure_ascii=False), json.dumps(value, separators=(",", ":"))):
+            assert matches(pattern, text), text
+    assert matches(pattern, " " + json.dumps(valid[0]) + " ")
+    for value in invalid:
+        assert not matches(pattern, json.dumps(value)), value
+
+
+@pytest.mark.parametrize("schema", [
+    {},
+    {"type": "array"},
+    {"type": "object", "properties": {"a": {"type": "integer"}}, "required": []},
+    {"$defs": {"a": {"$ref": "#/$defs/a"}}, "$ref": "#/$defs/a"},
+    {"$ref": "#/$defs/missing"},
+    {"type": "date"},
+])
+def test_unsupported_json_schemas_are_rejected(schema):
+    with pytest.raises(ValueError):
+        json_schema_regex(schema)
+
+
+def test_token_automaton_follows_the_regex(tiny_model):
+    _, tokenizer = tiny_model
+    hf_tokenizer = tokenizer._tokenizer
+    automaton = TokenAutomaton.from_regex("(ab|c)+", hf_tokenizer, tokenizer.eos_token_id)
+
+    tokens, targets = automaton.transitions[0]
+    assert tokenizer.eos_token_id not in tokens
+    assert {hf_tokenizer.decode([t]) for t in tokens} >= {"a", "c"}
+    # every allowed token keeps the output a prefix of a match
+    assert all(re.fullmatch("(ab|c)*a?", hf_tokenizer.decode([t])) for t in tokens)
+    # "c" matches, so EOS is allowed after it
+    c = tokens[[hf_tokenizer.decode([t]) for t in tokens].index("c")]
+    assert tokenizer.eos_token_id in automaton.transitions[targets[tokens.index(c)]][0]
+
+
+BOUNDED_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "name": {"type": "string", "maxLength": 6},
+        "kind": {"enum": ["person", "place"]},
+        "tags": {"type": "array", "items": {"enum": ["a", "b"]}, "maxItems": 3},
+        "ok": {"type": "boolean"},
+        "note": {"type": ["null", "string"], "maxLength": 4},
+    },
+    "required": ["name", "kind", "ok"],
+}
+
+
+@pytest.mark.parametrize("temp", [0.0, 1.0])
+def test_constrained_output_parses_and_validates(tiny_model, temp):
+    jsonschema = pytest.importorskip("jsonschema")
+    model, tokenizer = tiny_model
+    prompts = ["a b", "the quick brown fox", "{", "é"]
+    responses = batch_generate(
+        model, tokenizer, prompts, max_tokens=200, format_prompts=False,
+        json_schema=BOUNDED_SCHEMA, temp=temp, seed=[1, 2, 3, 4],
+    )
+
+    for response in responses:
+        jsonschema.validate(json.loads(response), BOUNDED_SCHEMA)
+
+
+def test_regex_output_matches(tiny_model):
+    model, tokenizer = tiny_model
+    pattern = "[a-c]{2,5}-\\d{1,3}"
+    responses = batch_generate(
+        model, tokenizer, ["a b", "c d e"], max_tokens=50, format_prompts=False,
+        regex=pattern, temp=1.0, seed=0,
+    )
+
+    assert all(re.fullmatch(pattern, r) for r in responses), responses
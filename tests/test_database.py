@@ -0,0 +1,259 @@
+"""Schema migrations, storage and keyset pagination of the results database"""
+
+import sqlite3
+import threading
+
+import pytest
+
+import database
+from database import (
+    get_batch_results,
+    get_connection,
+    get_results_by_model,
+    init_database,
+    save_generation_results,
+)
+
+
+def result(i, model_name="org/model", batch_id="b1", **overrides):
+    return {
+        "model_name": model_name, "prompt": f"prompt {i}", "response": f"response {i}",
+        "max_tokens": 8, "temperature": 0.0, "prompt_index": i, "batch_id": batch_id,
+        "is_batch": True, **overrides,
+    }
+
+
+def migrate_to(version, monkeypatch):
+    """Apply the first version migrations to the fixture database"""
+    with monkeypatch.context() as m:
+        m.setattr(database, "MIGRATIONS", database.MIGRATIONS[:version])
+        init_database()
+
+
+def insert_flat(rows):
+    """Insert results into the generation_results table of migration 1"""
+    conn = get_connection()
+    with conn:
+        conn.executemany(f"""
+            INSERT INTO generation_results ({", ".join(database.RESULT_COLUMNS)})
+            VALUES ({", ".join("?" * len(database.RESULT_COLUMNS))})
+        """, [tuple(r[c] for c in database.RESULT_COLUMNS) for r in rows])
+
+
+@pytest.fixture
+def empty_db(tmp_path, monkeypatch):
+    """Path of a database no migration ran on yet"""
+    monkeypatch.setattr(database, "DB_PATH", str(tmp_path / "results.db"))
+    yield database.DB_PATH
+    database.result_writer.flush()
+
+
+def models(results):
+    return [(r["prompt_index"], r["model_name"]) for r in results]
+
+
+def test_mixed_model_batch_keeps_the_model_of_every_result(db):
+    save_generation_results([result(0, "org/a"), result(1, "org/b")])
+    # the same batch saved in a second call
+    save_generation_results([result(2, "org/a", max_tokens=4), result(3, "org/b")])
+
+    assert models(get_batch_results("b1")) == [(0, "org/a"), (1, "org/b"), (2, "org/a"), (3, "org/b")]
+    assert get_batch_results("b1")[2]["max_tokens"] == 4
+    assert models(get_results_by_model("org/b")) == [(3, "org/b"), (1, "org/b")]
+
+
+@pytest.mark.parametrize("batch_models", [
+    ["org/a"] * 4,
+    ["org/a", "org/b", "org/a", "org/c"],
+])
+def test_normalization_keeps_single_and_mixed_model_batches(empty_db, monkeypatch, batch_models):
+    migrate_to(1, monkeypatch)
+    old = [result(i, model, temperature=0.1 * i) for i, model in enumerate(batch_models)]
+    old += [result(0, "org/a", batch_id=None, is_batch=False)]
+    insert_flat(old)
+
+    init_database()
+
+    batch = get_batch_results("b1")
+    assert models(batch) == list(enumerate(batch_models))
+    assert [(r["prompt"], r["response"], r["temperature"]) for r in batch] == [
+        (r["prompt"], r["response"], r["temperature"]) for r in old[:-1]
+    ]
+    total = get_connection().execute("SELECT COUNT(*) FROM results").fetchone()[0]
+    assert total == len(old)
+    tables = {name for (name,) in get_connection().execute("SELECT name FROM sqlite_master")}
+    assert "generation_results" not in tables
+
+
+def test_writer_retries_a_failed_write(db, monkeypatch):
+    save = database.save_generation_results
+    calls = []
+
+    def flaky_save(results):
+        calls.append(len(results))
+        if len(calls) < 3:
+            raise sqlite3.OperationalError("database is locked")
+        save(results)
+
+    monkeypatch.setattr(database, "save_generation_results", flaky_save)
+    writer = database.ResultWriter(retries=3, backoff=0.001)
+
+    writer.submit([result(0)]).result(10)
+
+    assert calls == [1, 1, 1]
+    assert models(get_batch_results("b1")) == [(0, "org/model")]
+
+
+def test_writer_fails_only_the_submission_that_cannot_be_stored(db, monkeypatch):
+    save = database.save_generation_results
+    release = threading.Event()
+
+    def slow_save(results):
+        release.wait(10)
+        save(results)
+
+    monkeypatch.setattr(database, "save_generation_results", slow_save)
+    writer = database.ResultWriter(retries=1, backoff=0.001)
+    first = writer.submit([result(0)])
+    # queued while the first write runs, so both go into the next transaction
+    bad = writer.submit([{**result(1, batch_id="b2"), "response": None}])
+    good = writer.submit([result(0, batch_id="b3")])
+    release.set()
+
+    first.result(10)
+    good.result(10)
+    with pytest.raises(Exception):
+        bad.result(10)
+    assert writer.failed == 1
+    assert len(get_batch_results("b3")) == 1
+    assert get_batch_results("b2") == []
+
+
+# generation_results as created by init_database before schema migrations
+BASELINE_SCHEMA = """
+    CREATE TABLE IF NOT EXISTS generation_results (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        timestamp DATETIME DEFAULT CURRENT_TIMESTAMP,
+        model_name TEXT NOT NULL,
+        prompt TEXT NOT NULL,
+        response TEXT NOT NULL,
+        max_tokens INTEGER,
+        temperature REAL,
+        prompt_index INTEGER,
+        batch_id TEXT,
+        is_batch BOOLEAN DEFAULT FALSE
+    )
+"""
+
+
+def columns(r):
+    return (r["timestamp"], r["model_name"], r["prompt"], r["response"], r["max_tokens"],
+            r["temperature"], r["prompt_index"], r["batch_id"])
+
+
+def test_baseline_database_is_migrated(empty_db):
+    conn = sqlite3.connect(empty_db)
+    conn.execute(BASELINE_SCHEMA)
+    rows = [
+        ("2024-01-01 10:00:00", "org/a", "shared prompt", "x" * 2000, 100, 0.7, 0, "b1", True),
+        ("2024-01-01 10:00:00", "org/a", "shared prompt", "short", 50, 0.7, 1, "b1", True),
+        ("2024-01-01 10:00:00", "org/b", "other prompt", "é€😀", 100, 0.0, 2, "b1", True),
+        ("2024-01-02 09:00:00", "org/b", "single", "answer", 10, 1.0, None, None, False),
+        ("2024-01-03 08:00:00", "org/a", "p", "r", 10, 0.5, 0, "b2", True),
+    ]
+    conn.executemany("""
+        INSERT INTO generation_results
+        (timestamp, model_name, prompt, response, max_tokens, temperature, prompt_index,
+         batch_id, is_batch)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+    """, rows)
+    conn.commit()
+    conn.close()
+
+    init_database()
+
+    conn = get_connection()
+    assert conn.execute("PRAGMA user_version").fetchone()[0] == len(database.MIGRATIONS)
+    migrated = database.get_recent_results(100)
+    assert sorted(map(columns, migrated), key=str) == sorted((r[:8] for r in rows), key=str)
+    # the shared prompt is stored once, the long response compressed
+    assert conn.execute("SELECT COUNT(*) FROM prompts").fetchone()[0] == 4
+    assert conn.execute("SELECT COUNT(*) FROM results WHERE encoding IS NOT NULL").fetchone()[0] == 1
+    assert models(get_batch_results("b1")) == [(0, "org/a"), (1, "org/a"), (2, "org/b")]
+
+
+def test_init_database_is_idempotent(db):
+    save_generation_results([result(i) for i in range(3)])
+    conn = get_connection()
+    schema = conn.execute("SELECT type, name, sql FROM sqlite_master ORDER BY name").fetchall()
+    before = get_batch_results("b1")
+
+    init_database()
+    init_database()
+
+    assert conn.execute("PRAGMA user_version").fetchone()[0] == len(database.MIGRATIONS)
+    assert conn.execute("SELECT type, name, sql FROM sqlite_master ORDER BY name").fetchall() == schema
+    assert get_batch_results("b1") == before
+
+
+@pytest.fixture
+def many_results(db):
+    for b in range(12):
+        save_generation_results([
+            result(i, "org/a" if (b + i) % 3 else "org/b", batch_id=f"b{b}",
+                   temperature=0.1 * (i % 2))
+            for i in range(b % 5 + 1)
+        ])
+    # a batch saved in two calls, with a repeated prompt_index
+    save_generation_results([result(i, batch_id="b3") for i in range(3)])
+    save_generation_results([result(0, "org/b", batch_id=None, is_batch=False)] * 2)
+
+
+QUERIES = [
+    ("batch", lambda limit, after_id: get_batch_results("b3", limit, after_id)),
+    ("model", lambda limit, after_id: get_results_by_model("org/a", limit, after_id)),
+    ("recent", lambda limit, after_id: database.get_recent_results(limit, after_id)),
+]
+
+
+@pytest.mark.parametrize("name, query", QUERIES)
+@pytest.mark.parametrize("limit", [1, 2, 5])
+def test_keyset_pages_cover_the_full_listing(many_results, name, query, limit):
+    full = query(10**6, None)
+    assert len({r["id"] for r in full}) == len(full) > limit
+
+    pages, after_id = [], None
+    while True:
+        page = query(limit, after_id)
+        pages.extend(page)
+        if len(page) < limit:
+            break
+        after_id = page[-1]["id"]
+
+    assert pages == full
+    # a page may start after any row
+    for i, row in enumerate(full):
+        assert query(limit, row["id"]) == full[i + 1:i + 1 + limit]
+
+
+@pytest.mark.parametrize("batch_id, model_name, query", [
+    ("b3", None, QUERIES[0][1]),
+    (None, "org/a", QUERIES[1][1]),
+    (None, None, QUERIES[2][1]),
+])
+def test_iter_results_streams_the_full_listing(many_results, batch_id, model_name, query):
+    chunks = list(database.iter_results(batch_id, model_name, chunk_size=4))
+
+    assert all(0 < len(chunk) <= 4 for chunk in chunks)
+    assert [r for chunk in chunks for r in chunk] == query(10**6, None)
+
+
+def test_migrations_only_create_the_indexes_of_the_final_schema(db):
+    indexes = {
+        name
+        for (name,) in get_connection().execute(
+            "SELECT name FROM sqlite_master WHERE type = 'index' AND name LIKE 'idx_%'"
+        )
+    }
+
+    assert indexes == {"idx_batches_model", "idx_results_batch", "idx_results_cache_key"}
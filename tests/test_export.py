@@ -0,0 +1,111 @@
+"""Streaming result exports and their confinement to the export directory"""
+
+import json
+import os
+
+import pytest
+
+import database
+from database import export_results, get_batch_results, get_recent_results, save_generation_results
+
+
+@pytest.fixture
+def results(db):
+    save_generation_results([
+        dict(model_name="org/model", prompt=f"p{i}", response="x" * 600 + str(i),
+             max_tokens=8, temperature=0.0, prompt_index=i, batch_id="b1", is_batch=True)
+        for i in range(25)
+    ])
+    save_generation_results([
+        dict(model_name="org/other", prompt="q", response="r", max_tokens=8,
+             temperature=0.5, prompt_index=0, batch_id="b2", is_batch=True)
+    ])
+
+
+def read_jsonl(path):
+    with open(path, encoding="utf-8") as f:
+        return [json.loads(line) for line in f]
+
+
+def test_export_streams_rows_in_query_order(results):
+    path, rows = export_results(batch_id="b1", chunk_size=7)
+
+    assert rows == 25
+    assert os.path.dirname(path) == os.path.realpath(database.EXPORT_DIR)
+    assert read_jsonl(path) == get_batch_results("b1")
+
+    path, rows = export_results("all/results.jsonl", chunk_size=4)
+    assert rows == 26
+    assert read_jsonl(path) == get_recent_results(100)
+    assert not [name for name in os.listdir(os.path.dirname(path)) if name.endswith(".partial")]
+
+
+@pytest.mark.parametrize("path", [
+    "/tmp/evil.jsonl",
+    "~/evil.jsonl",
+    "../evil.jsonl",
+    "sub/../../evil.jsonl",
+])
+def test_export_rejects_paths_outside_the_export_dir(results, path):
+    with pytest.raises(ValueError):
+        export_results(path, batch_id="b1")
+
+
+def test_export_rejects_symlinks_out_of_the_export_dir(results, tmp_path):
+    os.makedirs(database.EXPORT_DIR)
+    os.symlink(tmp_path, os.path.join(database.EXPORT_DIR, "link"))
+
+    with pytest.raises(ValueError):
+        export_results("link/evil.jsonl", batch_id="b1")
+
+
+def test_default_file_name_is_sanitized(results):
+    save_generation_results([
+        dict(model_name="org/model", prompt="p", response="r", max_tokens=8,
+             temperature=0.0, prompt_index=0, batch_id="../../evil", is_batch=True)
+    ])
+
+    path, rows = export_results(batch_id="../../evil")
+
+    assert rows == 1
+    assert os.path.dirname(path) == os.path.realpath(database.EXPORT_DIR)
+    assert os.path.basename(path).startswith("_.._evil_")
+
+
+def test_export_does_not_overwrite_unless_asked(results):
+    path, _ = export_results("b1.jsonl", batch_id="b1")
+
+    with pytest.raises(FileExistsError):
+        export_results("b1.jsonl", batch_id="b2")
+    assert len(read_jsonl(path)) == 25
+
+    export_results("b1.jsonl", batch_id="b2", overwrite=True)
+    assert len(read_jsonl(path)) == 1
+
+
+def test_export_works_without_hard_links(results, monkeypatch):
+    def no_link(*args, **kwargs):
+        raise OSError("hard links are not supported")
+
+    monkeypatch.setattr(os, "link", no_link)
+    path, rows = export_results("b1.jsonl", batch_id="b1")
+
+    assert rows == 25 and len(read_jsonl(path)) == 25
+
+
+@pytest.mark.parametrize("overwrite", [False, True])
+def test_failed_export_leaves_no_file_behind(results, monkeypatch, overwrite):
+    def failing(*args, **kwargs):
+        yield get_batch_results("b1")[:2]
+        raise OSError("disk full")
+
+    monkeypatch.setattr(database, "iter_results", failing)
+    with pytest.raises(OSError, match="disk full"):
+        export_results("b1.jsonl", batch_id="b1", overwrite=overwrite)
+
+    assert os.listdir(database.EXPORT_DIR) == []
+
+
+def test_unknown_format(results):
+    with pytest.raises(ValueError):
+        export_results(format="csv")
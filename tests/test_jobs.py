@@ -0,0 +1,80 @@
+"""Generation jobs and the inference worker"""
+
+import time
+from concurrent.futures import Future
+
+import pytest
+
+from jobs import COMPLETED, FAILED, RUNNING, JobManager
+
+
+def wait(manager, job_id, statuses=(COMPLETED, FAILED)):
+    deadline = time.time() + 10
+    while time.time() < deadline:
+        job = manager.get(job_id)
+        if job.status in statuses:
+            return job
+        time.sleep(0.01)
+    raise TimeoutError(job_id)
+
+
+@pytest.mark.parametrize("error, status", [(None, COMPLETED), (OSError("disk full"), FAILED)])
+def test_job_completes_once_its_results_are_stored(error, status):
+    stored = Future()
+
+    def run(jobs, progress):
+        progress([3], [True])
+        jobs[0].stored = stored
+        return [{"batch_id": "b1"}]
+
+    manager = JobManager()
+    job = manager.submit("batch_generation", "model", {}, 1, run)
+
+    assert wait(manager, job.id, (RUNNING,)).status == RUNNING
+    time.sleep(0.05)
+    assert manager.get(job.id).status == RUNNING
+    if error is None:
+        stored.set_result(None)
+    else:
+        stored.set_exception(error)
+
+    job = wait(manager, job.id)
+    assert job.status == status
+    assert job.result == {"batch_id": "b1"}
+    assert (job.error is None) == (error is None)
+
+
+def test_job_completes_at_once_without_a_write():
+    manager = JobManager()
+    job = manager.submit("batch_generation", "model", {}, 1, lambda jobs, progress: [{"ok": 1}])
+
+    assert wait(manager, job.id).status == COMPLETED
+
+
+def test_jobs_with_the_same_key_are_coalesced_within_the_window():
+    batches = []
+
+    def run(jobs, progress):
+        batches.append([job.request["name"] for job in jobs])
+        rows = sum(job.total_rows for job in jobs)
+        # the second row of the batch is still running
+        progress([1] * rows, [i != 1 for i in range(rows)])
+        return [{"name": job.request["name"]} for job in jobs]
+
+    manager = JobManager(coalesce_window=0.2, max_coalesced_rows=5)
+    jobs = [
+        manager.submit("batch_generation", "model", {"name": name}, rows, run, coalesce_key=key)
+        for name, rows, key in [
+            ("a", 2, "k"), ("b", 1, "other"), ("c", 3, "k"), ("d", 1, "k"),
+        ]
+    ]
+    for job in jobs:
+        wait(manager, job.id)
+
+    # d would exceed max_coalesced_rows and waits for the next batch
+    assert batches == [["a", "c"], ["b"], ["d"]]
+    assert [manager.get(job.id).result["name"] for job in jobs] == ["a", "b", "c", "d"]
+    assert manager.get(jobs[0].id).coalesced_jobs == 2
+    assert manager.get(jobs[0].id).rows_finished == 1
+    assert manager.get(jobs[2].id).rows_finished == 3
+    assert manager.stats()["batches"] == 3 and manager.stats()["coalesced_jobs"] == 1
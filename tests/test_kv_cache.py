@@ -0,0 +1,168 @@
+"""Paged, quantized and shared-prefix KV caches through batch_generate"""
+
+import mlx.core as mx
+import pytest
+
+import utils
+from models.base import BlockPool, make_block_pools, make_cache
+from prompt_cache import PromptCache
+from utils import batch_generate, continuous_batch_generate
+
+
+PROMPTS = ["the quick brown fox", "a b", "def add(a, b):\n    return"]
+
+
+def generate(model, tokenizer, **kwargs):
+    return batch_generate(
+        model, tokenizer, PROMPTS, max_tokens=8, format_prompts=False, **kwargs
+    )
+
+
+def one_by_one(model, tokenizer, prompts=PROMPTS):
+    return [
+        batch_generate(model, tokenizer, [prompt], max_tokens=8, format_prompts=False)[0]
+        for prompt in prompts
+    ]
+
+
+@pytest.mark.parametrize("kv_block_size", [1, 4, 64])
+def test_paged_cache_matches_single_prompts(tiny_model, kv_block_size):
+    model, tokenizer = tiny_model
+    responses = generate(model, tokenizer, kv_blocks=64, kv_block_size=kv_block_size)
+
+    assert responses == one_by_one(model, tokenizer)
+
+
+def test_paged_continuous_batching_matches_single_prompts(tiny_model):
+    model, tokenizer = tiny_model
+    responses = continuous_batch_generate(
+        model, tokenizer, PROMPTS, max_tokens=8, max_batch_size=2, format_prompts=False,
+        kv_blocks=16, kv_block_size=4,
+    )
+
+    assert responses == one_by_one(model, tokenizer)
+
+
+def test_paged_cache_returns_blocks_of_filtered_rows(tiny_model):
+    model, _ = tiny_model
+    pools = make_block_pools(model, 16, block_size=4)
+    cache = make_cache(model, 2, left_padding=[3, 0], block_pools=pools)
+    model(mx.array([[0, 0, 0, 5, 6], [5, 6, 7, 8, 9]]), cache=cache)
+
+    # row 0 holds 2 tokens in one block, row 1 holds 5 in two
+    assert pools[0].num_used == 3
+    for c in cache:
+        c.filter([1])
+    assert pools[0].num_used == 2
+    assert cache[0].left_padding == [0]
+
+
+def test_exhausted_block_pool_raises():
+    pool = BlockPool(3, block_size=4)
+    pool.allocate(), pool.allocate()
+    with pytest.raises(RuntimeError, match="exhausted"):
+        pool.allocate()
+
+
+@pytest.mark.parametrize("kv_bits", [8, 4])
+def test_quantized_cache_generates_every_row(phi3_head_model, kv_bits):
+    model, tokenizer = phi3_head_model
+    responses = generate(model, tokenizer, kv_bits=kv_bits)
+
+    assert len(responses) == len(PROMPTS)
+    assert all(isinstance(r, str) for r in responses)
+
+
+def test_8_bit_cache_stays_close_to_the_float_cache(phi3_head_model):
+    model, tokenizer = phi3_head_model
+    greedy = generate(model, tokenizer)
+    quantized = generate(model, tokenizer, kv_bits=8)
+
+    # random weights make long continuations sensitive to rounding, so only
+    # the first tokens are compared
+    assert [r[:2] for r in quantized] == [r[:2] for r in greedy]
+
+
+def test_head_dim_96_picks_a_dividing_group_size(phi3_head_model):
+    model, tokenizer = phi3_head_model
+    assert model.head_dim == 96
+
+    assert all(c.group_size == 32 for c in make_cache(model, kv_bits=8))
+    assert all(c.group_size == 32 for c in make_cache(model, kv_bits=4, kv_group_size=32))
+
+
+@pytest.mark.parametrize("group_size", [64, 48])
+def test_group_size_not_dividing_head_dim_is_rejected(phi3_head_model, group_size):
+    model, _ = phi3_head_model
+    with pytest.raises(ValueError, match="group size"):
+        make_cache(model, kv_bits=8, kv_group_size=group_size)
+
+
+SYSTEM = "the quick brown fox jumps over the lazy dog " * 2
+SHARED = [SYSTEM + prompt for prompt in PROMPTS]
+
+
+def test_shared_prefix_is_prefilled_once_and_matches_single_prompts(tiny_model, monkeypatch):
+    model, tokenizer = tiny_model
+    prefills = []
+    prefill = utils._prefill_shared_prefix
+
+    def spy(model, token_lists, prefix_length, *args, **kwargs):
+        prefills.append(prefix_length)
+        return prefill(model, token_lists, prefix_length, *args, **kwargs)
+
+    monkeypatch.setattr(utils, "_prefill_shared_prefix", spy)
+    responses = batch_generate(
+        model, tokenizer, SHARED, max_tokens=8, format_prompts=False, min_shared_prefix=8
+    )
+
+    assert len(prefills) == 1 and prefills[0] >= len(tokenizer.encode(SYSTEM)) - 1
+    assert responses == one_by_one(model, tokenizer, SHARED)
+
+
+def test_prompt_cache_reuses_prefixes_across_calls(tiny_model):
+    model, tokenizer = tiny_model
+    cache = PromptCache(max_bytes=1 << 30, cache_dir=None)
+
+    def run(prompts):
+        return batch_generate(
+            model, tokenizer, prompts, max_tokens=8, format_prompts=False,
+            min_shared_prefix=8, prompt_cache=cache, prompt_cache_key="tiny",
+        )
+
+    first = run(SHARED[:2])
+    second = run(SHARED[1:])
+
+    assert cache.stats()["hits"] == 1 and cache.stats()["misses"] == 1
+    assert cache.tokens_reused >= len(tokenizer.encode(SYSTEM)) - 1
+    assert first + second[1:] == one_by_one(model, tokenizer, SHARED)
+
+
+def test_prompt_cache_entries_survive_spilling_to_disk(tiny_model, tmp_path):
+    model, tokenizer = tiny_model
+    cache = PromptCache(max_bytes=0, cache_dir=str(tmp_path))
+    for prompts in (SHARED[:2], SHARED[1:]):
+        responses = batch_generate(
+            model, tokenizer, prompts, max_tokens=8, format_prompts=False,
+            min_shared_prefix=8, prompt_cache=cache, prompt_cache_key="tiny",
+        )
+
+    assert cache.stats()["disk_hits"] == 1
+    assert responses == one_by_one(model, tokenizer, SHARED[1:])
+
+
+def test_paged_cache_rebuilds_block_tables_only_on_allocation(tiny_model):
+    model, _ = tiny_model
+    pools = make_block_pools(model, 16, block_size=4)
+    cache = make_cache(model, 2, left_padding=[1, 0], block_pools=pools)
+    model(mx.array([[0, 5, 6], [5, 6, 7]]), cache=cache)
+    tables = cache[0]._tables
+
+    # the fourth token still fits the rows' first block
+    model(mx.array([[8], [8]]), cache=cache)
+    assert cache[0]._tables is tables
+    assert cache[0]._cached_slots.shape == (2, 4)
+
+    model(mx.array([[9], [9]]), cache=cache)
+    assert cache[0]._tables is not tables
+    assert cache[0]._cached_slots.tolist() == cache[0]._slots(0, 5).tolist()
@@ -0,0 +1,91 @@
+"""The fused logits pipeline against running its processors one by one"""
+
+import mlx.core as mx
+
+from logits_processors import (
+    BannedTokens,
+    LogitBias,
+    LogitsPipeline,
+    StopSequenceLookahead,
+    TokenPenalties,
+)
+from utils import batch_generate, continuous_batch_generate
+
+VOCAB = 12
+
+
+def processors():
+    return [
+        LogitBias({3: 2.0, 5: -1.0}),
+        TokenPenalties([[1, 2, 2], [4]], repetition_penalty=1.3, frequency_penalty=0.2),
+        BannedTokens([7]),
+        StopSequenceLookahead([[2, 6], [9]], eos_token_id=0, batch_size=2),
+        lambda logits: logits * 0.5,
+    ]
+
+
+def one_by_one(chain, logits):
+    for p in chain:
+        if hasattr(p, "bias"):
+            logits = logits + p.bias(VOCAB)
+        elif hasattr(p, "apply"):
+            logits = p.apply(logits, *p.state)
+        else:
+            logits = p(logits)
+    return logits
+
+
+def test_pipeline_matches_processors_applied_in_turn():
+    pipeline = LogitsPipeline(processors())
+    chain = processors()
+    for p in chain:
+        if hasattr(p, "setup"):
+            p.setup(VOCAB)
+
+    for step in range(5):
+        logits = mx.random.normal((2, VOCAB), key=mx.random.key(step))
+        assert mx.allclose(pipeline(logits), one_by_one(chain, logits), atol=1e-5)
+        tokens = mx.array([[2], [(step * 5) % VOCAB]])
+        pipeline.update(tokens)
+        for p in chain:
+            if hasattr(p, "update"):
+                p.update(tokens)
+
+
+def test_static_processors_fold_into_one_bias():
+    pipeline = LogitsPipeline([LogitBias({1: 1.0}), BannedTokens([2]), LogitBias({1: 0.5})])
+    out = pipeline(mx.zeros((1, 4)))
+
+    assert out.tolist() == [[0.0, 1.5, -float("inf"), 0.0]]
+    assert pipeline.static and not pipeline.stateful and not pipeline.callables
+
+
+class Mask:
+    """Final processor forbidding token 0"""
+
+    final = True
+
+    def __call__(self, logits):
+        return mx.where(mx.arange(logits.shape[-1]) == 0, -float("inf"), logits)
+
+
+def test_final_processors_run_after_every_other_one():
+    pipeline = LogitsPipeline([Mask(), LogitBias({0: 5.0}), lambda logits: logits * 0 + 1])
+    out = pipeline(mx.zeros((2, 3)))
+
+    assert out.tolist() == [[-float("inf"), 1.0, 1.0]] * 2
+
+
+def test_logit_bias_applies_to_batched_and_continuous_generation(tiny_model):
+    model, tokenizer = tiny_model
+    token = tokenizer.encode("fox")[0]
+    expected = [tokenizer.decode([token] * 3)] * 2
+    prompts = ["a b", "the quick brown"]
+
+    assert batch_generate(
+        model, tokenizer, prompts, max_tokens=3, format_prompts=False, logit_bias={token: 1e4}
+    ) == expected
+    assert continuous_batch_generate(
+        model, tokenizer, prompts, max_tokens=3, max_batch_size=1, format_prompts=False,
+        logit_bias={token: 1e4},
+    ) == expected
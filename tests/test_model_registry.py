@@ -0,0 +1,86 @@
+"""Residency, revisions and locking of the model registry"""
+
+import threading
+from pathlib import Path
+
+import pytest
+
+from model_registry import ModelRegistry, model_revision
+
+
+def test_stats_report_requested_and_resolved_revision(tiny_model_path):
+    registry = ModelRegistry()
+    registry.get(tiny_model_path)
+
+    (entry,) = registry.stats()["resident_models"]
+    assert entry["requested_revision"] is None
+    assert entry["resolved_revision"] == model_revision(Path(tiny_model_path))
+    assert entry["resolved_revision"] is not None
+
+
+class BlockingLoader:
+    """Loader that blocks until released and counts its calls"""
+
+    def __init__(self, model):
+        self.model = model
+        self.calls = 0
+        self.started = threading.Event()
+        self.release = threading.Event()
+
+    def __call__(self, path, **kwargs):
+        self.calls += 1
+        self.started.set()
+        assert self.release.wait(10)
+        return self.model
+
+
+def test_stats_do_not_wait_for_a_load(tiny_model, tiny_model_path):
+    loader = BlockingLoader(tiny_model)
+    registry = ModelRegistry(loader=loader)
+    thread = threading.Thread(target=registry.get, args=(tiny_model_path,))
+    thread.start()
+    assert loader.started.wait(10)
+
+    # the registry lock is free while the model loads
+    stats = registry.stats()
+    assert stats["misses"] == 1 and stats["resident_models"] == []
+
+    loader.release.set()
+    thread.join(10)
+    assert len(registry.stats()["resident_models"]) == 1
+
+
+def test_concurrent_gets_load_a_model_once(tiny_model, tiny_model_path):
+    loader = BlockingLoader(tiny_model)
+    registry = ModelRegistry(loader=loader)
+    results = []
+    threads = [
+        threading.Thread(target=lambda: results.append(registry.get(tiny_model_path)))
+        for _ in range(4)
+    ]
+    for thread in threads:
+        thread.start()
+    assert loader.started.wait(10)
+    loader.release.set()
+    for thread in threads:
+        thread.join(10)
+
+    assert loader.calls == 1
+    assert len(results) == 4 and all(r == tiny_model for r in results)
+    assert registry.stats()["misses"] == 1 and registry.stats()["hits"] == 3
+
+
+def test_failed_load_is_retried(tiny_model, tiny_model_path):
+    calls = []
+
+    def loader(path, **kwargs):
+        calls.append(path)
+        if len(calls) == 1:
+            raise RuntimeError("out of memory")
+        return tiny_model
+
+    registry = ModelRegistry(loader=loader)
+    with pytest.raises(RuntimeError):
+        registry.get(tiny_model_path)
+    assert registry.get(tiny_model_path) == tiny_model
+    assert len(calls) == 2
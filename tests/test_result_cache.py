@@ -0,0 +1,69 @@
+"""Result cache of batch_generate_text, run through the tool and its job"""
+
+import json
+import time
+
+import pytest
+
+import mcp_server
+from database import get_batch_results
+from result_cache import result_cache
+
+
+@pytest.fixture(autouse=True)
+def empty_cache(db):
+    result_cache.clear()
+    yield
+    result_cache.clear()
+
+
+def run(**kwargs) -> dict:
+    """Submit a batch_generate_text job and wait for it to finish"""
+    job_id = json.loads(mcp_server.batch_generate_text(format_prompts=False, **kwargs))["job_id"]
+    deadline = time.time() + 120
+    while time.time() < deadline:
+        status = json.loads(mcp_server.get_job_status(job_id))
+        if status["status"] in ("completed", "failed", "cancelled"):
+            return status
+        time.sleep(0.02)
+    raise TimeoutError(job_id)
+
+
+def responses(status: dict) -> list:
+    return [r["response"] for r in get_batch_results(status["result"]["batch_id"])]
+
+
+def test_repeated_greedy_prompts_are_served_from_the_cache(tiny_model_path):
+    first = run(model_name=tiny_model_path, prompts=["a b", "c d"], max_tokens=8, temperature=0.0)
+    second = run(model_name=tiny_model_path, prompts=["c d", "e", "a b"], max_tokens=8, temperature=0.0)
+
+    assert first["result"]["cached"] == 0
+    assert second["result"]["cached"] == 2
+    assert responses(second)[0] == responses(first)[1]
+    assert responses(second)[2] == responses(first)[0]
+
+
+def test_cache_depends_on_max_tokens(tiny_model_path):
+    run(model_name=tiny_model_path, prompts=["a b"], max_tokens=8, temperature=0.0)
+    other = run(model_name=tiny_model_path, prompts=["a b"], max_tokens=7, temperature=0.0)
+
+    assert other["result"]["cached"] == 0
+
+
+def test_repeated_mixed_greedy_and_sampled_request(tiny_model_path):
+    # The greedy rows are cache hits the second time; the per-row settings of
+    # the sampled row, its seed included, must be narrowed to it
+    request = dict(
+        model_name=tiny_model_path,
+        prompts=["a b", "c d", "e f"],
+        max_tokens=8,
+        temperature=[0.0, 0.7, 0.0],
+        seed=[1, 2, 3],
+    )
+    first = run(**request)
+    second = run(**request)
+
+    assert first["status"] == "completed", first["error"]
+    assert second["status"] == "completed", second["error"]
+    assert second["result"]["cached"] == 2
+    assert responses(second) == responses(first)
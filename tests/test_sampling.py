@@ -0,0 +1,167 @@
+"""Per-row sampling, candidate filtering, log-probabilities and penalties"""
+
+import mlx.core as mx
+import pytest
+
+from logits_processors import TokenPenalties
+from sample_utils import make_sampler
+from utils import batch_generate
+
+PROMPTS = ["the quick brown fox", "a b", "def add(a, b):\n    return"]
+
+
+def logits(batch=3, vocab=50, seed=0):
+    return mx.random.normal((batch, vocab), key=mx.random.key(seed)) * 3
+
+
+def draws(sampler, x, n=20):
+    return [sampler(x)[0][:, 0].tolist() for _ in range(n)]
+
+
+def test_greedy_rows_take_the_argmax_next_to_sampled_rows():
+    x = logits()
+    rows = list(zip(*draws(make_sampler(temp=[0.0, 1.0, 0.0], seed=0), x)))
+
+    argmax = mx.argmax(x, axis=-1).tolist()
+    assert set(rows[0]) == {argmax[0]} and set(rows[2]) == {argmax[2]}
+    assert len(set(rows[1])) > 1
+
+
+def test_row_seeds_make_samples_independent_of_the_batch():
+    x = logits()
+    alone = draws(make_sampler(temp=[1.0], seed=[7]), x[1:2])
+    batched = draws(make_sampler(temp=[1.0, 1.0, 1.0], seed=[3, 7, None]), x)
+
+    assert [row[1] for row in batched] == [row[0] for row in alone]
+
+
+def test_shared_seed_is_reproducible():
+    x = logits()
+    assert draws(make_sampler(temp=1.0, seed=5), x) == draws(make_sampler(temp=1.0, seed=5), x)
+
+
+def test_per_row_lists_must_match_the_batch():
+    with pytest.raises(ValueError, match="sampling values"):
+        make_sampler(temp=[1.0, 1.0], top_p=[0.5, 0.5, 0.5])
+
+
+def test_batch_generate_samples_rows_with_their_own_settings(tiny_model):
+    model, tokenizer = tiny_model
+
+    def run(prompts, temp, seed):
+        return batch_generate(
+            model, tokenizer, prompts, max_tokens=8, format_prompts=False,
+            temp=temp, seed=seed,
+        )
+
+    greedy = run(PROMPTS, 0.0, None)
+    mixed = run(PROMPTS, [0.0, 1.0, 0.0], [None, 11, None])
+
+    assert [mixed[0], mixed[2]] == [greedy[0], greedy[2]]
+    assert run(PROMPTS[1:2], [1.0], [11]) == [mixed[1]]
+
+
+def test_top_k_only_samples_the_k_most_likely_tokens():
+    x = logits()
+    top = mx.argsort(-x, axis=-1)[:, :3].tolist()
+    for row_draws in draws(make_sampler(temp=1.0, top_k=[3, 1, 3], seed=1), x, 50):
+        for token, allowed in zip(row_draws, top):
+            assert token in allowed
+    assert {row[1] for row in draws(make_sampler(temp=1.0, top_k=[3, 1, 3]), x)} == {top[1][0]}
+
+
+@pytest.mark.parametrize("max_candidates", [1024, 16])
+@pytest.mark.parametrize("top_p", [0.3, 0.9])
+def test_top_p_samples_from_the_smallest_nucleus(top_p, max_candidates):
+    x = logits(vocab=200)
+    probs = mx.softmax(x, axis=-1)
+    order = mx.argsort(-probs, axis=-1).tolist()
+    nuclei = []
+    for row, ranked in zip(probs.tolist(), order):
+        nucleus, mass = [], 0.0
+        for token in ranked:
+            if mass >= top_p:
+                break
+            nucleus.append(token)
+            mass += row[token]
+        nuclei.append(set(nucleus))
+
+    seen = [set() for _ in nuclei]
+    for row_draws in draws(
+        make_sampler(temp=1.0, top_p=top_p, seed=2, max_candidates=max_candidates), x, 200
+    ):
+        for s, token in zip(seen, row_draws):
+            s.add(token)
+    assert all(s <= nucleus for s, nucleus in zip(seen, nuclei))
+    assert any(len(s) > 1 for s in seen)
+
+
+def test_min_p_drops_unlikely_tokens():
+    x = logits()
+    probs = mx.softmax(x, axis=-1)
+    allowed = (probs >= 0.2 * probs.max(axis=-1, keepdims=True)).tolist()
+    for row_draws in draws(make_sampler(temp=1.0, min_p=0.2, seed=3), x, 50):
+        assert all(allowed[i][token] for i, token in enumerate(row_draws))
+
+
+
+def test_logprobs_are_only_computed_on_request():
+    x = logits()
+    tokens, token_logprobs = make_sampler(temp=[0.0, 1.0, 1.0], seed=0, logprobs=True)(x)
+    expected = mx.take_along_axis(x - mx.logsumexp(x, axis=-1, keepdims=True), tokens, axis=-1)
+
+    assert mx.allclose(token_logprobs, expected, atol=1e-5)
+    assert make_sampler(temp=1.0)(x)[1] is None
+
+
+def test_batch_logprobs_match_a_full_forward_pass(tiny_model):
+    model, tokenizer = tiny_model
+    _, token_logprobs = batch_generate(
+        model, tokenizer, PROMPTS, max_tokens=4, format_prompts=False, logprobs=True
+    )
+
+    for prompt, lps in zip(PROMPTS, token_logprobs):
+        tokens = tokenizer.encode(prompt)
+        expected = []
+        for _ in range(4):
+            last = model(mx.array(tokens)[None])[0, -1]
+            token = mx.argmax(last).item()
+            expected.append((last[token] - mx.logsumexp(last)).item())
+            tokens.append(token)
+        assert lps == pytest.approx(expected, abs=1e-3)
+
+
+def naive_penalties(logits, history, repetition, frequency, presence):
+    out = list(logits)
+    for token in set(history):
+        count = history.count(token)
+        if repetition is not None:
+            out[token] = out[token] * repetition if out[token] < 0 else out[token] / repetition
+        out[token] -= frequency * count + presence
+    return out
+
+
+@pytest.mark.parametrize("context_size", [None, 4])
+def test_penalties_match_a_per_row_loop(context_size):
+    contexts = [[1, 2, 2, 3], [], [4, 4, 4, 4, 4, 5]]
+    repetition, frequency, presence = [1.5, None, 1.2], [0.5, 0.0, 1.0], 0.25
+    penalties = TokenPenalties(
+        contexts, repetition_penalty=repetition, frequency_penalty=frequency,
+        presence_penalty=presence, context_size=context_size,
+    )
+    penalties.setup(10)
+    histories = [list(c) for c in contexts]
+
+    for step in range(6):
+        x = logits(vocab=10, seed=step)
+        got = penalties(x).tolist()
+        for i, history in enumerate(histories):
+            window = history[-context_size:] if context_size else history
+            expected = naive_penalties(
+                x[i].tolist(), window, repetition[i], frequency[i], presence
+            )
+            assert got[i] == pytest.approx(expected, abs=1e-5)
+        tokens = mx.array([[step % 3], [2], [(step * 7) % 10]])
+        penalties.update(tokens)
+        for history, token in zip(histories, tokens[:, 0].tolist()):
+            history.append(token)
@@ -0,0 +1,74 @@
+"""Speculative decoding through batch_generate"""
+
+import pytest
+
+from utils import batch_generate, generate
+
+
+def test_speculative_matches_greedy_decoding(tiny_model):
+    model, tokenizer = tiny_model
+    prompts = ["a b c a b", "the quick brown fox the quick"]
+    greedy = batch_generate(model, tokenizer, prompts, max_tokens=10, format_prompts=False)
+    speculative = batch_generate(
+        model, tokenizer, prompts, max_tokens=10, format_prompts=False, prompt_lookup_ngram=2
+    )
+
+    assert speculative == greedy
+
+
+@pytest.mark.parametrize("option", [
+    {"top_p": 0.9},
+    {"top_k": 5},
+    {"min_p": 0.1},
+    {"top_p": [1.0, 0.5]},
+    {"repetition_penalty": 1.2},
+    {"frequency_penalty": 0.5},
+    {"presence_penalty": [0.0, 0.5]},
+    {"logit_bias": {1: 2.0}},
+    {"kv_bits": 8},
+    {"kv_blocks": 16},
+    {"temp": [0.0, 0.5]},
+    {"seed": [1, 2]},
+])
+@pytest.mark.parametrize("speculation", [
+    {"prompt_lookup_ngram": 2},
+    {"draft_model": "tiny_model"},
+])
+def test_unsupported_options_are_rejected(tiny_model, option, speculation):
+    model, tokenizer = tiny_model
+    if "draft_model" in speculation:
+        speculation = {"draft_model": model}
+    with pytest.raises(ValueError, match="speculative"):
+        batch_generate(
+            model, tokenizer, ["a b", "c d"], max_tokens=4, format_prompts=False,
+            **speculation, **option,
+        )
+
+
+def test_default_options_are_accepted(tiny_model):
+    model, tokenizer = tiny_model
+    batch_generate(
+        model, tokenizer, ["a b"], max_tokens=4, format_prompts=False, prompt_lookup_ngram=2,
+        temp=0.0, top_p=1.0, top_k=0, min_p=0.0, frequency_penalty=0.0, seed=1,
+    )
+
+
+@pytest.mark.parametrize("option", [
+    {"top_p": 0.9},
+    {"min_p": 0.1},
+    {"repetition_penalty": 1.2},
+    {"logits_processors": [lambda logits: logits]},
+])
+def test_generate_rejects_unsupported_options(tiny_model, option):
+    model, tokenizer = tiny_model
+    with pytest.raises(ValueError, match="speculative"):
+        generate(model, tokenizer, "a b", max_tokens=4, prompt_lookup_ngram=2, **option)
+
+
+def test_generate_speculatively_matches_greedy_decoding(tiny_model):
+    model, tokenizer = tiny_model
+    prompt = "the quick brown fox the quick"
+    greedy = generate(model, tokenizer, prompt, max_tokens=10)
+
+    assert generate(model, tokenizer, prompt, max_tokens=10, prompt_lookup_ngram=2) == greedy
+    assert generate(model, tokenizer, prompt, max_tokens=10, draft_model=model, temp=0.0) == greedy
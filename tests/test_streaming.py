@@ -0,0 +1,55 @@
+"""Streaming batched generation"""
+
+import pytest
+
+from utils import batch_generate, stream_batch_generate
+
+PROMPTS = [
+    "the quick brown fox",
+    "a b",
+    "def add(a, b):\n    return",
+    # its response starts with a space, which streaming must keep
+    "0123456789 abc xyz ABC",
+]
+
+
+def collect(events, n):
+    texts, finished = [""] * n, [0] * n
+    for row, delta, done in events:
+        assert not finished[row], "event after the row finished"
+        texts[row] += delta
+        finished[row] += done
+    assert finished == [1] * n
+    return texts
+
+
+@pytest.mark.parametrize("stream_interval", [1, 3])
+@pytest.mark.parametrize("max_tokens", [12, [1, 12, 4, 7]])
+def test_streamed_text_matches_batch_output(tiny_model, max_tokens, stream_interval):
+    model, tokenizer = tiny_model
+    texts = collect(
+        stream_batch_generate(
+            model, tokenizer, PROMPTS, max_tokens=max_tokens, format_prompts=False,
+            stream_interval=stream_interval,
+        ),
+        len(PROMPTS),
+    )
+
+    assert texts == batch_generate(
+        model, tokenizer, PROMPTS, max_tokens=max_tokens, format_prompts=False
+    )
+    assert texts[3].startswith(" ")
+
+
+def test_finished_rows_are_reported_while_others_keep_streaming(tiny_model):
+    model, tokenizer = tiny_model
+    events = list(
+        stream_batch_generate(
+            model, tokenizer, PROMPTS[:2], max_tokens=[2, 10], format_prompts=False
+        )
+    )
+    collect(events, 2)
+
+    first_done = events.index(next(e for e in events if e[0] == 0 and e[2]))
+    assert any(row == 1 and not done for row, _, done in events[first_done:])
+    assert events[-1][0] == 1 and events[-1][2]
@@ -24,13 +24,27 @@ from mlx.utils import tree_flatten
 from transformers import PreTrainedTokenizer
 
 # mlx_lm
-from mlx_lm.tokenizer_utils import TokenizerWrapper, load_tokenizer
+from mlx_lm.tokenizer_utils import (
+    BPEStreamingDetokenizer,
+    TokenizerWrapper,
+    load_tokenizer,
+)
 from mlx_lm.tuner.utils import linear_to_lora_layers as apply_lora_layers
 from mlx_lm.tuner.utils import dequantize as dequantize_model
 
 # Local imports
-from sample_utils import top_p_sampling
-from models.base import BatchedKVCache
+from constrained import GrammarConstraint, TokenAutomaton
+from logits_processors import (
+    LogitBias,
+    LogitsPipeline,
+    StopSequenceLookahead,
+    TokenPenalties,
+)
+from sample_utils import make_sampler
+from models.base import BatchedKVCache, make_block_pools, make_cache
+from prompt_cache import PromptCache
+from scheduler import BatchScheduler
+from speculative import SpeculativeStats, speculative_generate_step
 
 # Constants
 MODEL_REMAPPING = {
@@ -110,39 +124,36 @@ def get_model_path(path_or_hf_repo: str, revision: Optional[str] = None) -> Path
     return model_path
 
 
-def apply_repetition_penalty(logits: mx.array, generated_tokens: Any, penalty: float):
-    """
-    Apply repetition penalty to specific logits based on the given context.
-
-    Paper: https://arxiv.org/abs/1909.05858
-
-    Args:
-        logits (mx.array): The logits produced by the language model.
-        generated_tokens (any): A list of N previous tokens.
-        penalty (float): The repetition penalty factor to be applied.
-
-    Returns:
-        logits (mx.array): Logits with repetition penalty applied to generated tokens.
-    """
-
-    if len(generated_tokens) > 0:
-        indices = mx.array([token for token in generated_tokens])
-        selected_logits = logits[:, indices]
-        selected_logits = mx.where(
-            selected_logits < 0, selected_logits * penalty, selected_logits / penalty
-        )
-        logits[:, indices] = selected_logits
-    return logits
+def _per_row_values(value: Any) -> List:
+    """The values of an option given either shared or as a per-row list."""
+    return list(value) if isinstance(value, (list, tuple)) else [value]
 
 
 def generate_step(
     prompts: mx.array,
     model: nn.Module,
-    temp: float = 0.0,
-    repetition_penalty: Optional[float] = None,
+    temp: Union[float, List[float]] = 0.0,
+    repetition_penalty: Optional[Union[float, List[float]]] = None,
     repetition_context_size: Optional[int] = 20,
-    top_p: float = 1.0,
+    top_p: Union[float, List[float]] = 1.0,
     logit_bias: Optional[Dict[int, float]] = None,
+    top_k: Union[int, List[int]] = 0,
+    min_p: Union[float, List[float]] = 0.0,
+    seed: Optional[Union[int, List[Optional[int]]]] = None,
+    max_tokens: Optional[List[int]] = None,
+    logprobs: bool = False,
+    frequency_penalty: Union[float, List[float]] = 0.0,
+    presence_penalty: Union[float, List[float]] = 0.0,
+    penalty_context: Optional[List[List[int]]] = None,
+    logits_processors: Optional[List[Callable]] = None,
+    stop_token_ids: Optional[List[int]] = None,
+    pad_token_id: Optional[int] = None,
+    left_padding: Optional[List[int]] = None,
+    kv_blocks: Optional[int] = None,
+    kv_block_size: int = 64,
+    kv_bits: Optional[int] = None,
+    kv_group_size: Optional[int] = None,
+    cache: Optional[List[BatchedKVCache]] = None,
 ) -> Generator[Tuple[mx.array, mx.array], None, None]:
     """
     A generator producing token ids based on the given prompt from the model.
@@ -154,42 +165,70 @@ def generate_step(
           Default: ``0``.
         repetition_penalty (float, optional): The penalty factor for repeating
           tokens.
-        repetition_context_size (int, optional): The number of tokens to
-          consider for repetition penalty. Default: ``20``.
+        repetition_context_size (int, optional): The number of most recent
+          tokens of each row counted for the penalties, ``None`` counts all
+          of them. Default: ``20``.
         top_p (float, optional): Nulceus sampling, higher means model considers
           more less likely words.
+        top_k (int, optional): Only sample from the ``top_k`` most likely
+          tokens, ``0`` disables it. Default: ``0``.
+        min_p (float, optional): Only sample tokens with at least ``min_p``
+          times the probability of the most likely one. Default: ``0``.
+        seed (int, optional): Seed for sampling, see
+          :func:`sample_utils.make_sampler`.
+          ``temp``, ``top_p``, ``top_k``, ``min_p`` and ``seed`` may also be
+          lists with one value per row, which are applied in a single
+          vectorized step.
+        max_tokens (List[int], optional): Token limit of each row. A row that
+          reached its limit is finished like one that produced a stop token.
+        logprobs (bool): If ``True``, also compute the log-probability of
+          every sampled token. Default: ``False``.
+        frequency_penalty (float): Subtracted from a token's logit once per
+          occurrence in the context. Default: ``0``.
+        presence_penalty (float): Subtracted from the logit of every token in
+          the context. Default: ``0``.
+          The three penalties may also be given per row, see
+          :class:`sample_utils.TokenPenalties`.
+        penalty_context (List[List[int]], optional): The prompt tokens of
+          each row counted for the penalties. Default: the unpadded rows of
+          ``prompts``, which must be given when ``prompts`` only holds the
+          tokens following a prefilled ``cache``.
+        logits_processors (List[Callable], optional): More processors to run
+          on the logits of every step after ``logit_bias`` and the penalties,
+          see :mod:`logits_processors`.
+        stop_token_ids (List[int], optional): Tokens that finish a row. Once a
+          row has produced one, it is fed ``pad_token_id`` and the generator
+          returns as soon as every row is finished.
+        pad_token_id (int, optional): Token fed to finished rows. Default: the
+          first of ``stop_token_ids``.
+        left_padding (List[int], optional): Number of padding tokens at the
+          start of each prompt row. They are masked out of attention.
+        kv_blocks (int, optional): If set, use a paged KV cache with a pool of
+          this many blocks per layer instead of one contiguous buffer.
+        kv_block_size (int): Tokens per paged KV block. Default: ``64``.
+        kv_bits (int, optional): If set (``8`` or ``4``), store the KV cache
+          quantized to this many bits, see :class:`models.base.QuantizedKVCache`.
+        kv_group_size (int, optional): Group size for KV cache quantization,
+          see :func:`models.base.make_cache`. Default: ``64``, or ``32`` for
+          head dimensions that are not a multiple of 64.
+        cache (List[BatchedKVCache], optional): An already prefilled cache to
+          continue from, in which case ``prompts`` only holds the tokens that
+          follow the cached ones. ``left_padding`` and the KV cache options
+          are then ignored.
 
     Yields:
-        Generator[Tuple[mx.array, mx.array]]: A generator producing
-        one token and probability per call.
+        Generator[Tuple[mx.array, Optional[mx.array]]]: A generator producing
+        one ``(batch, 1)`` array of tokens per call, with their
+        log-probabilities if ``logprobs`` is set and ``None`` otherwise.
     """
 
-    def sample(logits: mx.array) -> Tuple[mx.array, float]:
-        if logit_bias:
-            indices = mx.array(list(logit_bias.keys()))
-            values = mx.array(list(logit_bias.values()))
-            logits[:, indices] += values
-        softmax_logits = mx.softmax(logits, axis=-1)
-
-        if temp == 0:
-            tokens = mx.argmax(logits, axis=-1, keepdims=True)
-        else:
-            if top_p > 0 and top_p < 1.0:
-                tokens = top_p_sampling(logits, top_p, temp)
-            else:
-                scaled_logits = logits * (1 / temp)
-                tokens = mx.random.categorical(logits * (1 / temp), axis=-1)
-                if scaled_logits.ndim > 1:
-                    tokens = mx.expand_dims(tokens, axis=-1)
-
-        probs = softmax_logits[0, tokens]
-        return tokens, probs
-
-    if repetition_penalty:
-        raise NotImplementedError("repetition_penalty not supported.")
+    sample = make_sampler(
+        temp, top_p, top_k=top_k, seed=seed, min_p=min_p, logprobs=logprobs
+    )
 
-    if repetition_penalty and (
-        repetition_penalty < 0 or not isinstance(repetition_penalty, float)
+    if any(
+        p is not None and (p < 0 or not isinstance(p, float))
+        for p in _per_row_values(repetition_penalty)
     ):
         raise ValueError(
             f"repetition_penalty must be a non-negative float, got {repetition_penalty}"
@@ -197,46 +236,86 @@ def generate_step(
 
     # (bs, ntoks)
     y = prompts
-    kv_heads = (
-        [model.n_kv_heads] * len(model.layers)
-        if isinstance(model.n_kv_heads, int)
-        else model.n_kv_heads
-    )
-
-    cache = [BatchedKVCache(model.head_dim, n, y.shape[0]) for n in kv_heads]
-
-    repetition_context = prompts
+    if cache is None:
+        block_pools = (
+            make_block_pools(model, kv_blocks, kv_block_size) if kv_blocks else None
+        )
+        cache = make_cache(
+            model,
+            y.shape[0],
+            left_padding=left_padding,
+            block_pools=block_pools,
+            kv_bits=kv_bits,
+            kv_group_size=kv_group_size,
+        )
 
-    if repetition_context_size and repetition_penalty:
-        repetition_context = repetition_context[:,-repetition_context_size:]
+    use_penalties = (
+        repetition_penalty is not None
+        or any(_per_row_values(frequency_penalty))
+        or any(_per_row_values(presence_penalty))
+    )
+    processors = []
+    if logit_bias:
+        processors.append(LogitBias(logit_bias))
+    if use_penalties:
+        if penalty_context is None:
+            padding = left_padding or [0] * y.shape[0]
+            penalty_context = [row[p:] for row, p in zip(y.tolist(), padding)]
+        processors.append(
+            TokenPenalties(
+                penalty_context,
+                repetition_penalty=repetition_penalty,
+                frequency_penalty=frequency_penalty,
+                presence_penalty=presence_penalty,
+                context_size=repetition_context_size,
+            )
+        )
+    processors.extend(logits_processors or [])
+    pipeline = LogitsPipeline(processors) if processors else None
+
+    if stop_token_ids or max_tokens:
+        stop_tokens = mx.array(stop_token_ids) if stop_token_ids else None
+        limits = mx.array(max_tokens)[:, None] if max_tokens else None
+        pad_token = pad_token_id
+        if pad_token is None:
+            pad_token = stop_token_ids[0] if stop_token_ids else 0
+        # per-row "finished" flags, kept on device
+        done = mx.zeros((y.shape[0], 1), dtype=mx.bool_)
+    else:
+        done = None
+    n_tokens = 0
 
     def _step(y):
-        nonlocal repetition_context
+        nonlocal done, n_tokens
         logits = model(y, cache=cache)
         logits = logits[:, -1, :]
 
-        if repetition_penalty:
-            logits = apply_repetition_penalty(
-                logits, repetition_context, repetition_penalty
-            )
-            y, probs = sample(logits)
-            repetition_context = mx.concatenate([repetition_context, y])
+        if pipeline is not None:
+            logits = pipeline(logits)
+            y, token_logprobs = sample(logits)
+            pipeline.update(y)
         else:
-            y, probs = sample(logits)
-
-        if repetition_context_size:
-            if repetition_context.shape[1] > repetition_context_size:
-                repetition_context = repetition_context[:,-repetition_context_size:]
-        return y, probs
-
-    y, p = _step(y)
+            y, token_logprobs = sample(logits)
+
+        n_tokens += 1
+        if done is not None:
+            y = mx.where(done, pad_token, y)
+            if stop_tokens is not None:
+                done = done | mx.any(y == stop_tokens, axis=-1, keepdims=True)
+            if limits is not None:
+                done = done | (limits <= n_tokens)
+        return y, token_logprobs, done
+
+    y, p, d = _step(y)
     mx.async_eval(y)
     while True:
-        next_y, next_p = _step(y)
+        next_y, next_p, next_d = _step(y)
         mx.async_eval(next_y)
         mx.eval(y)
         yield y, p
-        y, p = next_y, next_p
+        if d is not None and d.all().item():
+            return
+        y, p, d = next_y, next_p, next_d
 
 def stream_generate(
     model: nn.Module,
@@ -279,16 +358,308 @@ def stream_generate(
     detokenizer.finalize()
     yield detokenizer.last_segment
 
+def _format_prompts(tokenizer: TokenizerWrapper, prompts: List[str]) -> List[str]:
+    """Wrap each prompt as a single user turn of the model's chat template."""
+    prompts_fm = [[{"role": "user", "content": prompt}] for prompt in prompts]
+    return [tokenizer.apply_chat_template(prompt, add_generation_prompt=True, tokenize=False) for prompt in prompts_fm]
+
+
+def _set_left_padding(tokenizer: TokenizerWrapper):
+    """Configure left-padding for batched generation, padding with EOS if needed."""
+    tokenizer._tokenizer.padding_side = 'left'
+    if tokenizer.pad_token is None:
+        tokenizer._tokenizer.pad_token = tokenizer.eos_token
+        tokenizer._tokenizer.pad_token_id = tokenizer.eos_token_id
+
+
+def _truncate(tokens: List[int], stop_token_ids: List[int]) -> List[int]:
+    """Cut a row of generated tokens at its first stop token."""
+    for i, token in enumerate(tokens):
+        if token in stop_token_ids:
+            return tokens[:i]
+    return tokens
+
+
+def _grammar_constraint(
+    tokenizer: TokenizerWrapper, batch_size: int, json_schema: Any, regex: Any
+) -> GrammarConstraint:
+    automata = []
+    for i in range(batch_size):
+        schema = json_schema[i] if isinstance(json_schema, list) else json_schema
+        pattern = regex[i] if isinstance(regex, list) else regex
+        # automata are cached per HF tokenizer, which outlives the wrapper
+        if schema is not None:
+            automata.append(
+                TokenAutomaton.from_json_schema(
+                    schema, tokenizer._tokenizer, tokenizer.eos_token_id
+                )
+            )
+        elif pattern is not None:
+            automata.append(
+                TokenAutomaton.from_regex(pattern, tokenizer._tokenizer, tokenizer.eos_token_id)
+            )
+        else:
+            automata.append(None)
+    return GrammarConstraint(automata)
+
+
+def _cut_at_stop(text: str, stop_sequences: List[str]) -> str:
+    cut = min((i for i in (text.find(s) for s in stop_sequences) if i >= 0), default=-1)
+    return text if cut < 0 else text[:cut]
+
+
+def _shared_prefix_length(token_lists: List[List[int]]) -> int:
+    """Number of leading tokens common to every row."""
+    n = 0
+    for column in zip(*token_lists):
+        if any(token != column[0] for token in column):
+            break
+        n += 1
+    return n
+
+
+def _can_share_prefix(model: nn.Module) -> bool:
+    """Prefix sharing rotates cached keys, which needs a plain ``nn.RoPE``."""
+    return all(
+        isinstance(getattr(layer.self_attn, "rope", None), nn.RoPE)
+        for layer in model.layers
+    )
+
+
+def _prefill_shared_prefix(
+    model: nn.Module,
+    token_lists: List[List[int]],
+    prefix_length: int,
+    pad_token_id: int,
+    prompt_cache: Optional[PromptCache] = None,
+    prompt_cache_key: Optional[str] = None,
+) -> List[BatchedKVCache]:
+    """
+    Prefill a batch whose prompts start with the same ``prefix_length`` tokens.
+
+    The prefix is run once for a single row and its cache is copied to every
+    row. The remaining tokens of each prompt, except the last one, are then
+    prefilled right-padded, and the padding is moved to the left so that the
+    cache looks exactly like a left-padded prefill of the full prompts. The
+    last prompt tokens are left for :func:`generate_step`.
+
+    With a ``prompt_cache`` the longest previously prefilled part of the
+    prefix is restored from it instead, and the full prefix is stored back.
+    """
+    prefix = token_lists[0][:prefix_length]
+    cache = make_cache(model, 1)
+    cached = 0
+    if prompt_cache is not None:
+        state, cached = prompt_cache.fetch(prompt_cache_key, prefix)
+        if state is not None:
+            for c, layer_state in zip(cache, state):
+                c.state = layer_state
+    if cached < prefix_length:
+        model(mx.array(prefix[cached:])[None], cache=cache)
+        if prompt_cache is not None:
+            prompt_cache.store(prompt_cache_key, prefix, [c.state for c in cache])
+    for c in cache:
+        c.repeat(len(token_lists))
+
+    suffixes = [tokens[prefix_length:-1] for tokens in token_lists]
+    width = max(len(suffix) for suffix in suffixes)
+    if width > 0:
+        right_padding = [width - len(suffix) for suffix in suffixes]
+        model(
+            mx.array([s + [pad_token_id] * p for s, p in zip(suffixes, right_padding)]),
+            cache=cache,
+        )
+        for c, layer in zip(cache, model.layers):
+            c.move_padding_left(right_padding, layer.self_attn.rope)
+    return cache
+
+
+# generate_step options speculative decoding ignores, with their defaults
+SPECULATIVE_UNSUPPORTED = {
+    "top_p": 1.0,
+    "top_k": 0,
+    "min_p": 0.0,
+    "logit_bias": None,
+    "repetition_penalty": None,
+    "frequency_penalty": 0.0,
+    "presence_penalty": 0.0,
+    "kv_blocks": None,
+    "kv_bits": None,
+}
+
+
+def _check_speculative(options: Dict[str, Any], logprobs: bool = False):
+    """
+    Raise a ``ValueError`` if the :func:`generate_step` ``options`` use
+    anything :func:`speculative.speculative_generate_step` does not support,
+    which only takes one ``temp`` and ``seed`` for the whole batch.
+    """
+    if logprobs or options.get("logits_processors"):
+        raise ValueError(
+            "logprobs and logits processors are not supported with speculative decoding"
+        )
+    unsupported = [
+        name
+        for name, default in SPECULATIVE_UNSUPPORTED.items()
+        if any(
+            v is not None and v != default and v != {}
+            for v in _per_row_values(options.get(name))
+        )
+    ]
+    unsupported += [
+        f"per-row {name}"
+        for name in ("temp", "seed")
+        if isinstance(options.get(name), (list, tuple))
+    ]
+    if unsupported:
+        raise ValueError(f"{', '.join(unsupported)} not supported with speculative decoding")
+
+
+# generate_step options that may hold one value per row
+ROW_OPTIONS = (
+    "temp",
+    "top_p",
+    "top_k",
+    "min_p",
+    "seed",
+    "repetition_penalty",
+    "frequency_penalty",
+    "presence_penalty",
+)
+
+
+def _prepare_inputs(
+    model: nn.Module,
+    tokenizer: TokenizerWrapper,
+    prompts_fm: List[str],
+    token_lists: List[List[int]],
+    min_shared_prefix: Optional[int],
+    prompt_cache: Optional[PromptCache],
+    prompt_cache_key: Optional[str],
+    kwargs: Dict[str, Any],
+) -> Tuple[mx.array, Optional[List[int]]]:
+    """
+    The prompt tokens to feed :func:`generate_step` and their left padding.
+
+    If the prompts share a long enough prefix, it is prefilled once and the
+    resulting cache is put into ``kwargs``, and only the last token of every
+    prompt is returned.
+    """
+    prefix_length = min(
+        _shared_prefix_length(token_lists), min(len(t) for t in token_lists) - 1
+    )
+    if (
+        min_shared_prefix is not None
+        and len(token_lists) > 1
+        and prefix_length >= min_shared_prefix
+        and not kwargs.get("kv_blocks")
+        and not kwargs.get("kv_bits")
+        and _can_share_prefix(model)
+    ):
+        kwargs["cache"] = _prefill_shared_prefix(
+            model,
+            token_lists,
+            prefix_length,
+            tokenizer.pad_token_id,
+            prompt_cache=prompt_cache,
+            prompt_cache_key=prompt_cache_key or f"{type(model).__module__}@{id(model):x}",
+        )
+        return mx.array([tokens[-1:] for tokens in token_lists]), None
+
+    encoded = tokenizer._tokenizer(prompts_fm, padding=True)
+    left_padding = [len(mask) - sum(mask) for mask in encoded['attention_mask']]
+    return mx.array(encoded['input_ids']), left_padding
+
+
+def _select_rows(value: Any, rows: List[int]) -> Any:
+    """Pick the values of ``rows`` from a per-row list, pass anything else through."""
+    if isinstance(value, (list, tuple)):
+        return [value[i] for i in rows]
+    return value
+
+
+def plan_batches(lengths: List[int], max_batch_tokens: int) -> List[List[int]]:
+    """
+    Group prompts into length-sorted batches under a padded-token budget.
+
+    Prompts are sorted by token length and packed greedily, so each batch
+    holds prompts of similar length and ``len(batch) * max(lengths in batch)``
+    stays within ``max_batch_tokens``. A prompt longer than the budget gets a
+    batch of its own.
+
+    Args:
+        lengths (List[int]): Token length of every prompt.
+        max_batch_tokens (int): Budget of padded prompt tokens per batch.
+
+    Returns:
+        List[List[int]]: Prompt indices of each batch, shortest prompts first.
+    """
+    batches, batch = [], []
+    for i in sorted(range(len(lengths)), key=lambda i: lengths[i]):
+        # sorted ascending, so prompt i is the longest of the extended batch
+        if batch and (len(batch) + 1) * lengths[i] > max_batch_tokens:
+            batches.append(batch)
+            batch = []
+        batch.append(i)
+    if batch:
+        batches.append(batch)
+    return batches
+
+
+class _ProgressCounter:
+    """
+    Turn the ``(batch, n)`` tokens of every decode step into the number of
+    tokens generated and the finished flag of every row, and pass them to
+    ``callback``.
+    """
+
+    def __init__(
+        self,
+        callback: Callable[[List[int], List[bool]], None],
+        limits: List[int],
+        stop_token_ids: List[int],
+    ):
+        self.callback = callback
+        self.limits = limits
+        self.stop_token_ids = set(stop_token_ids)
+        self.lengths = [0] * len(limits)
+        self.finished = [False] * len(limits)
+
+    def __call__(self, tokens: mx.array):
+        for row, row_tokens in enumerate(tokens.tolist()):
+            for token in row_tokens:
+                if self.finished[row]:
+                    break
+                if token in self.stop_token_ids:
+                    self.finished[row] = True
+                    break
+                self.lengths[row] += 1
+                self.finished[row] = self.lengths[row] >= self.limits[row]
+        self.callback(self.lengths, self.finished)
+
+
 def batch_generate(
     model: nn.Module,
     tokenizer: Union[PreTrainedTokenizer, TokenizerWrapper],
     prompts: List[str],
-    max_tokens: int = 100,
+    max_tokens: Union[int, List[int]] = 100,
     verbose: bool = False,
     format_prompts: bool = True,
     formatter: Optional[Callable] = None,
+    max_batch_tokens: Optional[int] = None,
+    min_shared_prefix: Optional[int] = 32,
+    prompt_cache: Optional[PromptCache] = None,
+    prompt_cache_key: Optional[str] = None,
+    logprobs: bool = False,
+    stop_sequences: Optional[List[str]] = None,
+    json_schema: Optional[Union[Dict[str, Any], str, List]] = None,
+    regex: Optional[Union[str, List[Optional[str]]]] = None,
+    draft_model: Optional[nn.Module] = None,
+    num_draft_tokens: int = 4,
+    prompt_lookup_ngram: Optional[int] = None,
+    progress: Optional[Callable[[List[int], List[bool]], None]] = None,
     **kwargs,
-) -> Union[str, Generator[str, None, None]]:
+) -> Union[List[str], Tuple[List[str], List[List[float]]]]:
     """
     Generate a complete response from the model.
 
@@ -296,59 +667,516 @@ def batch_generate(
        model (nn.Module): The language model.
        tokenizer (PreTrainedTokenizer): The tokenizer.
        prompt (str): The string prompt.
-       max_tokens (int): The maximum number of tokens. Default: ``100``.
+       max_tokens (int or List[int]): The maximum number of tokens, either
+           shared or one limit per prompt. Default: ``100``.
        verbose (bool): If ``True``, print tokens and timing information.
            Default: ``False``.
        formatter (Optional[Callable]): A function which takes a token and a
            probability and displays it.
+       max_batch_tokens (int, optional): If set, prompts are sorted by length
+           and split into batches of at most this many padded prompt tokens
+           (rows x longest prompt), see :func:`plan_batches`. Responses keep
+           the order of ``prompts``.
+       min_shared_prefix (int, optional): If all prompts of a batch start
+           with at least this many identical tokens (e.g. a common system
+           prompt), the shared prefix is prefilled once and its KV cache is
+           copied to every row. ``None`` disables prefix sharing. It is also
+           skipped with a paged or quantized KV cache. Default: ``32``.
+       prompt_cache (PromptCache, optional): Keeps shared prefixes across
+           calls, so a batch starting with an already seen prefix skips its
+           prefill. Only used when prefix sharing applies.
+       prompt_cache_key (str, optional): Identifies the model in
+           ``prompt_cache``, e.g. its path. Default: the identity of
+           ``model``, which is only meaningful within this process.
+       logprobs (bool): If ``True``, return ``(responses, token_logprobs)``
+           where ``token_logprobs[i]`` holds the log-probability of every
+           token of response ``i``. Default: ``False``.
+       stop_sequences (List[str], optional): Strings that end a response.
+           A row finishes instead of sampling the last token of a stop
+           sequence, see :class:`logits_processors.StopSequenceLookahead`,
+           and responses are cut before the first stop string they contain.
+           Not supported together with ``json_schema`` or ``regex``: ending
+           or cutting a row at a stop string can break its grammar.
+       json_schema (dict or str, optional): Constrain the responses to JSON
+           documents matching this schema, either shared or one per prompt
+           (``None`` for unconstrained rows). See :mod:`constrained` for the
+           supported subset of JSON Schema.
+       regex (str, optional): Constrain the responses to match this regular
+           expression, either shared or one per prompt. Ignored for rows with
+           a ``json_schema``.
+       draft_model (nn.Module, optional): If set, decode speculatively with
+           this smaller model sharing the tokenizer, see :mod:`speculative`.
+           Only the token limits and a shared ``temp`` and ``seed`` are
+           supported then; per-row ``temp`` or ``seed`` values, other sampling
+           options, penalties, logit bias and KV cache options raise a
+           ``ValueError``. With ``verbose`` the acceptance rate is printed.
+       num_draft_tokens (int): Most draft tokens proposed per step when
+           decoding speculatively. Default: ``4``.
+       prompt_lookup_ngram (int, optional): If set (and no ``draft_model``
+           is given), decode speculatively without a draft model by looking
+           up the last up to this many tokens in the prompt and proposing
+           what followed them, see :class:`speculative.PromptLookupDrafter`.
+       progress (Callable[[List[int], List[bool]], None], optional): Called
+           after every decode step with the number of tokens generated so far
+           and whether it finished, for every prompt in the order of
+           ``prompts``. Exceptions it raises abort the generation, e.g. to
+           cancel it.
        kwargs: The remaining options get passed to :func:`generate_step`.
-          See :func:`generate_step` for more details.
+          See :func:`generate_step` for more details. The per-row sampling
+          options (``temp``, ``top_p``, ``top_k``, ``min_p``, ``seed``) and
+          penalties (``repetition_penalty``, ``frequency_penalty``,
+          ``presence_penalty``) may be lists with one value per prompt.
     """
     if not isinstance(tokenizer, TokenizerWrapper):
         tokenizer = TokenizerWrapper(tokenizer)
 
+    prompts_fm = _format_prompts(tokenizer, prompts) if format_prompts else prompts
+    _set_left_padding(tokenizer)
+
+    if isinstance(max_tokens, list) and len(max_tokens) != len(prompts):
+        raise ValueError(
+            f"Got {len(max_tokens)} max_tokens values for {len(prompts)} prompts"
+        )
+    if stop_sequences and any(
+        v is not None for v in _per_row_values(json_schema) + _per_row_values(regex)
+    ):
+        raise ValueError("stop_sequences are not supported with json_schema or regex")
+
+    if max_batch_tokens is not None:
+        if kwargs.get("logits_processors"):
+            raise ValueError(
+                "logits_processors keep per-row state and cannot be split over "
+                "batches; use stop_sequences or drop max_batch_tokens"
+            )
+        lengths = [len(toks) for toks in tokenizer._tokenizer(prompts_fm)['input_ids']]
+        responses = [None] * len(prompts)
+        token_logprobs = [None] * len(prompts)
+        if progress is not None:
+            row_lengths, row_finished = [0] * len(prompts), [False] * len(prompts)
+        for bucket in plan_batches(lengths, max_batch_tokens):
+            bucket_progress = None
+            if progress is not None:
+
+                def bucket_progress(bucket_lengths, bucket_finished, bucket=bucket):
+                    for j, i in enumerate(bucket):
+                        row_lengths[i] = bucket_lengths[j]
+                        row_finished[i] = bucket_finished[j]
+                    progress(row_lengths, row_finished)
+
+            bucket_results = batch_generate(
+                model,
+                tokenizer,
+                [prompts_fm[i] for i in bucket],
+                max_tokens=_select_rows(max_tokens, bucket),
+                verbose=verbose,
+                format_prompts=False,
+                formatter=formatter,
+                min_shared_prefix=min_shared_prefix,
+                prompt_cache=prompt_cache,
+                prompt_cache_key=prompt_cache_key,
+                logprobs=logprobs,
+                stop_sequences=stop_sequences,
+                json_schema=_select_rows(json_schema, bucket),
+                regex=_select_rows(regex, bucket),
+                draft_model=draft_model,
+                num_draft_tokens=num_draft_tokens,
+                prompt_lookup_ngram=prompt_lookup_ngram,
+                progress=bucket_progress,
+                **{k: _select_rows(v, bucket) if k in ROW_OPTIONS else v for k, v in kwargs.items()},
+            )
+            bucket_responses, bucket_logprobs = (
+                bucket_results if logprobs else (bucket_results, [None] * len(bucket))
+            )
+            for i, response, lp in zip(bucket, bucket_responses, bucket_logprobs):
+                responses[i] = response
+                token_logprobs[i] = lp
+        return (responses, token_logprobs) if logprobs else responses
+
     if verbose:
         print("=" * 10)
-    
-    if format_prompts:
-        prompts_fm = [[{"role": "user", "content": prompt}] for prompt in prompts]
-        prompts_fm = [tokenizer.apply_chat_template(prompt, add_generation_prompt=True, tokenize=False) for prompt in prompts_fm]
-    else:
-        prompts_fm = prompts
-
-    # left-padding for batched generation
-    tokenizer._tokenizer.padding_side = 'left'
-    if tokenizer.pad_token is None:
-        tokenizer._tokenizer.pad_token = tokenizer.eos_token
-        tokenizer._tokenizer.pad_token_id = tokenizer.eos_token_id
 
-    prompts_toks = mx.array(tokenizer._tokenizer(prompts_fm, padding=True)['input_ids'])
+    token_lists = tokenizer._tokenizer(prompts_fm)['input_ids']
+    num_prompt_tokens = sum(len(tokens) for tokens in token_lists)
     tic = time.perf_counter()
+    speculative = draft_model is not None or prompt_lookup_ngram is not None
+    prompts_toks, left_padding = _prepare_inputs(
+        model,
+        tokenizer,
+        prompts_fm,
+        token_lists,
+        None if speculative else min_shared_prefix,
+        prompt_cache,
+        prompt_cache_key,
+        kwargs,
+    )
 
-    output_toks = []
-    for (tokens, _), n in zip(
-        generate_step(prompts_toks, model, **kwargs),
-        range(max_tokens),
-    ): 
-        if n == 0:
-            prompt_time = time.perf_counter() - tic
-            tic = time.perf_counter()
-        output_toks.append(tokens)
+    # stop early once every row has produced EOS or reached its own limit;
+    # finished rows are fed pad tokens
+    stop_token_ids = [tokenizer.eos_token_id]
+    if isinstance(max_tokens, list):
+        kwargs["max_tokens"] = max_tokens
+    # penalties count the full prompts, also when only their last tokens are fed
+    kwargs["penalty_context"] = token_lists
+    if stop_sequences:
+        stop_tokens = [
+            tokenizer.encode(s, add_special_tokens=False) for s in stop_sequences
+        ]
+        kwargs["logits_processors"] = [
+            StopSequenceLookahead(stop_tokens, tokenizer.eos_token_id, len(token_lists)),
+            *(kwargs.get("logits_processors") or []),
+        ]
+    if json_schema is not None or regex is not None:
+        # the pipeline masks it after every other processor, so none of them
+        # makes a token (or EOS) likely that the grammar forbids
+        kwargs["logits_processors"] = [
+            *(kwargs.get("logits_processors") or []),
+            _grammar_constraint(tokenizer, len(token_lists), json_schema, regex),
+        ]
+    output_toks, output_logprobs = [], []
+    if progress is not None:
+        progress = _ProgressCounter(
+            progress,
+            max_tokens if isinstance(max_tokens, list) else [max_tokens] * len(token_lists),
+            stop_token_ids + [tokenizer.pad_token_id],
+        )
+    if speculative:
+        _check_speculative(kwargs, logprobs)
+        stats = SpeculativeStats(num_draft_tokens)
+        for n, tokens in enumerate(
+            speculative_generate_step(
+                prompts_toks,
+                model,
+                draft_model,
+                num_draft_tokens=num_draft_tokens,
+                prompt_lookup_ngram=prompt_lookup_ngram,
+                temp=kwargs.get("temp", 0.0),
+                seed=kwargs.get("seed"),
+                max_tokens=(
+                    max_tokens if isinstance(max_tokens, list) else [max_tokens] * len(token_lists)
+                ),
+                stop_token_ids=stop_token_ids,
+                pad_token_id=tokenizer.pad_token_id,
+                left_padding=left_padding,
+                stats=stats,
+            )
+        ):
+            if n == 0:
+                prompt_time = time.perf_counter() - tic
+                tic = time.perf_counter()
+            output_toks.append(tokens)
+            if progress is not None:
+                progress(tokens)
+    else:
+        for (tokens, token_logprobs), n in zip(
+            generate_step(
+                prompts_toks,
+                model,
+                stop_token_ids=stop_token_ids,
+                pad_token_id=tokenizer.pad_token_id,
+                left_padding=left_padding,
+                logprobs=logprobs,
+                **kwargs,
+            ),
+            range(max(max_tokens) if isinstance(max_tokens, list) else max_tokens),
+        ):
+            if n == 0:
+                prompt_time = time.perf_counter() - tic
+                tic = time.perf_counter()
+            output_toks.append(tokens)
+            if logprobs:
+                output_logprobs.append(token_logprobs)
+            if progress is not None:
+                progress(tokens)
     output_toks = mx.concatenate(output_toks, axis=1)
 
-    # detokenizing + stripping pad/eos tokens
-    responses = [response.split(tokenizer.eos_token)[0].split(tokenizer.pad_token)[0] for response in tokenizer.batch_decode(output_toks.tolist())]
+    # detokenizing up to the first eos/pad token of each row
+    rows = [
+        _truncate(row, stop_token_ids + [tokenizer.pad_token_id])
+        for row in output_toks.tolist()
+    ]
+    responses = tokenizer.batch_decode(rows)
+    if stop_sequences:
+        responses = [_cut_at_stop(r, stop_sequences) for r in responses]
     if verbose:
         gen_time = time.perf_counter() - tic
-        prompt_tps = prompts_toks.size / prompt_time
+        prompt_tps = num_prompt_tokens / prompt_time
         gen_tps = output_toks.size / gen_time
         print(f"Prompt: {prompt_tps:.3f} tokens-per-sec")
         print(f"Generation: {gen_tps:.3f} tokens-per-sec")
+        if speculative:
+            print(
+                f"Speculative: {stats.acceptance_rate:.1%} of {stats.drafted} draft tokens "
+                f"accepted, {stats.tokens_per_step:.2f} tokens per target step"
+            )
         for prompt, response in zip(prompts, responses):
             print("=" * 10)
             print("Prompt:", prompt)
             print(response)
-            
+
+    if logprobs:
+        output_logprobs = mx.concatenate(output_logprobs, axis=1).tolist()
+        return responses, [lp[: len(row)] for lp, row in zip(output_logprobs, rows)]
+    return responses
+
+
+class _BPEContinuationDetokenizer(BPEStreamingDetokenizer):
+    """
+    BPE streaming detokenizer that keeps the leading space of the text.
+
+    ``BPEStreamingDetokenizer`` drops it, as if the text started a document,
+    while a generated response continues its prompt and is decoded with the
+    space by ``batch_decode``.
+    """
+
+    def _maybe_trim_space(self, current_text):
+        if self.clean_spaces and current_text[1:].startswith(self._space_matches):
+            return super()._maybe_trim_space(current_text)
+        return current_text
+
+
+class BatchDetokenizer:
+    """
+    Incremental detokenization of a batch of rows.
+
+    Every row gets its own streaming detokenizer of the tokenizer's type, see
+    ``mlx_lm.tokenizer_utils``, so each step only decodes the tokens added
+    since the last one instead of the whole output. Every row's text matches
+    decoding its tokens at once, see :class:`_BPEContinuationDetokenizer`.
+
+    Args:
+        tokenizer (TokenizerWrapper): The tokenizer.
+        batch_size (int): Number of rows.
+    """
+
+    def __init__(self, tokenizer: TokenizerWrapper, batch_size: int):
+        detokenizer_class = type(tokenizer.detokenizer)
+        if detokenizer_class is BPEStreamingDetokenizer:
+            detokenizer_class = _BPEContinuationDetokenizer
+        self.detokenizers = [detokenizer_class(tokenizer._tokenizer) for _ in range(batch_size)]
+        self.finished = [False] * batch_size
+
+    def add_token(self, row: int, token: int):
+        self.detokenizers[row].add_token(token)
+
+    def last_segment(self, row: int) -> str:
+        """The text of ``row`` that became final since the last call."""
+        return self.detokenizers[row].last_segment
+
+    def finalize(self, row: int) -> str:
+        """Finish ``row`` and return the rest of its text."""
+        self.finished[row] = True
+        self.detokenizers[row].finalize()
+        return self.detokenizers[row].last_segment
+
+
+def stream_batch_generate(
+    model: nn.Module,
+    tokenizer: Union[PreTrainedTokenizer, TokenizerWrapper],
+    prompts: List[str],
+    max_tokens: Union[int, List[int]] = 100,
+    format_prompts: bool = True,
+    stream_interval: int = 1,
+    min_shared_prefix: Optional[int] = 32,
+    prompt_cache: Optional[PromptCache] = None,
+    prompt_cache_key: Optional[str] = None,
+    **kwargs,
+) -> Generator[Tuple[int, str, bool], None, None]:
+    """
+    Generate responses for a batch of prompts, streaming their text.
+
+    Tokens are detokenized per row as they are generated, see
+    :class:`BatchDetokenizer`, so the first text is available after the first
+    decode step instead of after the whole batch.
+
+    Args:
+       model (nn.Module): The language model.
+       tokenizer (PreTrainedTokenizer): The tokenizer.
+       prompts (List[str]): The string prompts.
+       max_tokens (int or List[int]): The maximum number of tokens, either
+           shared or one limit per prompt. Default: ``100``.
+       format_prompts (bool): If ``True``, apply the chat template to the
+           prompts. Default: ``True``.
+       stream_interval (int): Emit the new text of the running rows every
+           this many decode steps. Finished rows are always reported in the
+           step they finish. Default: ``1``.
+       min_shared_prefix, prompt_cache, prompt_cache_key: Prefix sharing, see
+           :func:`batch_generate`.
+       kwargs: The remaining options get passed to :func:`generate_step`.
+
+    Yields:
+        Tuple[int, str, bool]: ``(row_index, text_delta, finished)`` events.
+        Every row ends with exactly one event with ``finished`` set, whose
+        delta may be empty.
+    """
+    if not isinstance(tokenizer, TokenizerWrapper):
+        tokenizer = TokenizerWrapper(tokenizer)
+
+    prompts_fm = _format_prompts(tokenizer, prompts) if format_prompts else prompts
+    _set_left_padding(tokenizer)
+    if isinstance(max_tokens, list) and len(max_tokens) != len(prompts):
+        raise ValueError(
+            f"Got {len(max_tokens)} max_tokens values for {len(prompts)} prompts"
+        )
+
+    token_lists = tokenizer._tokenizer(prompts_fm)['input_ids']
+    prompts_toks, left_padding = _prepare_inputs(
+        model,
+        tokenizer,
+        prompts_fm,
+        token_lists,
+        min_shared_prefix,
+        prompt_cache,
+        prompt_cache_key,
+        kwargs,
+    )
+    limits = max_tokens if isinstance(max_tokens, list) else [max_tokens] * len(prompts)
+    kwargs["max_tokens"] = limits
+    kwargs["penalty_context"] = token_lists
+    stop_token_ids = {tokenizer.eos_token_id, tokenizer.pad_token_id}
+
+    detokenizer = BatchDetokenizer(tokenizer, len(prompts))
+    for n, (tokens, _) in enumerate(
+        generate_step(
+            prompts_toks,
+            model,
+            stop_token_ids=[tokenizer.eos_token_id],
+            pad_token_id=tokenizer.pad_token_id,
+            left_padding=left_padding,
+            **kwargs,
+        )
+    ):
+        emit = (n + 1) % stream_interval == 0
+        for row, token in enumerate(tokens[:, 0].tolist()):
+            if detokenizer.finished[row]:
+                continue
+            if token in stop_token_ids:
+                yield row, detokenizer.finalize(row), True
+                continue
+            detokenizer.add_token(row, token)
+            if n + 1 >= limits[row]:
+                yield row, detokenizer.finalize(row), True
+            elif emit:
+                segment = detokenizer.last_segment(row)
+                if segment:
+                    yield row, segment, False
+        if all(detokenizer.finished):
+            return
+
+
+def continuous_batch_generate(
+    model: nn.Module,
+    tokenizer: Union[PreTrainedTokenizer, TokenizerWrapper],
+    prompts: List[str],
+    max_tokens: Union[int, List[int]] = 100,
+    max_batch_size: int = 32,
+    verbose: bool = False,
+    format_prompts: bool = True,
+    temp: float = 0.0,
+    top_p: float = 1.0,
+    logit_bias: Optional[Dict[int, float]] = None,
+    top_k: int = 0,
+    min_p: float = 0.0,
+    seed: Optional[int] = None,
+    kv_blocks: Optional[int] = None,
+    kv_block_size: int = 64,
+    kv_bits: Optional[int] = None,
+    kv_group_size: Optional[int] = None,
+    progress: Optional[Callable[[List[int], List[bool]], None]] = None,
+) -> List[str]:
+    """
+    Generate responses for many prompts with continuous batching.
+
+    At most ``max_batch_size`` prompts are decoded at once. A prompt leaves the
+    batch as soon as it emits EOS or reaches its own token limit, and the next
+    queued prompt takes its slot before the following decode step.
+
+    Args:
+       model (nn.Module): The language model.
+       tokenizer (PreTrainedTokenizer): The tokenizer.
+       prompts (List[str]): The string prompts.
+       max_tokens (int or List[int]): The maximum number of tokens, either
+           shared or one limit per prompt. Default: ``100``.
+       max_batch_size (int): Number of prompts decoded concurrently.
+           Default: ``32``.
+       verbose (bool): If ``True``, print timing information.
+           Default: ``False``.
+       format_prompts (bool): If ``True``, apply the chat template to the
+           prompts. Default: ``True``.
+       temp, top_p, logit_bias, top_k, min_p, seed: Sampling options shared by all
+           prompts, see :func:`generate_step`. Rows change between decode
+           steps, so per-row values are only supported by :func:`batch_generate`.
+       kv_blocks (int, optional): If set, use a paged KV cache with this many
+           blocks per layer; prompts are then only admitted while the pool can
+           hold their prompt and ``max_tokens``.
+       kv_block_size (int): Tokens per paged KV block. Default: ``64``.
+       kv_bits, kv_group_size: KV cache quantization, see :func:`generate_step`.
+       progress (Callable[[List[int], List[bool]], None], optional): Called
+           after every scheduler step with the tokens generated so far and
+           the finished flag of every prompt, see :func:`batch_generate`.
+
+    Returns:
+        List[str]: The responses, in the order of ``prompts``.
+    """
+    if not isinstance(tokenizer, TokenizerWrapper):
+        tokenizer = TokenizerWrapper(tokenizer)
+
+    if isinstance(max_tokens, int):
+        max_tokens = [max_tokens] * len(prompts)
+    if len(max_tokens) != len(prompts):
+        raise ValueError(
+            f"Got {len(max_tokens)} max_tokens values for {len(prompts)} prompts"
+        )
+    if any(isinstance(v, (list, tuple)) for v in (temp, top_p, top_k, min_p, seed)):
+        raise ValueError("Per-row sampling options are not supported with continuous batching")
+
+    prompts_fm = _format_prompts(tokenizer, prompts) if format_prompts else prompts
+    _set_left_padding(tokenizer)
+    prompts_toks = tokenizer._tokenizer(prompts_fm)['input_ids']
+
+    sample = sampler = make_sampler(temp, top_p, top_k=top_k, seed=seed, min_p=min_p)
+    if logit_bias:
+        # a static bias keeps no per-row state, so it survives rows changing
+        bias = LogitsPipeline([LogitBias(logit_bias)])
+
+        def sampler(logits):
+            return sample(bias(logits))
+
+    scheduler = BatchScheduler(
+        model,
+        sampler,
+        stop_token_ids=[tokenizer.eos_token_id],
+        pad_token_id=tokenizer.pad_token_id,
+        max_batch_size=max_batch_size,
+        kv_blocks=kv_blocks,
+        kv_block_size=kv_block_size,
+        kv_bits=kv_bits,
+        kv_group_size=kv_group_size,
+    )
+    for toks, limit in zip(prompts_toks, max_tokens):
+        scheduler.add(toks, limit)
+
+    tic = time.perf_counter()
+    responses = [None] * len(prompts)
+    n_generated = 0
+    lengths, finished = [0] * len(prompts), [False] * len(prompts)
+    while scheduler.has_work():
+        for seq in scheduler.step():
+            tokens = seq.tokens[:-1] if seq.finish_reason == "stop" else seq.tokens
+            responses[seq.uid] = tokenizer.decode(tokens)
+            n_generated += len(seq.tokens)
+            lengths[seq.uid] = len(tokens)
+            finished[seq.uid] = True
+        if progress is not None:
+            for seq in scheduler.active:
+                lengths[seq.uid] = len(seq.tokens)
+            progress(lengths, finished)
+
+    if verbose:
+        total_time = time.perf_counter() - tic
+        print("=" * 10)
+        print(f"Prompt tokens: {sum(len(t) for t in prompts_toks)}")
+        print(f"Generated tokens: {n_generated} in {total_time:.3f}s")
+        print(f"Generation: {n_generated / total_time:.3f} tokens-per-sec")
     return responses
 
 
@@ -359,6 +1187,9 @@ def generate(
     max_tokens: int = 100,
     verbose: bool = False,
     formatter: Optional[Callable] = None,
+    draft_model: Optional[nn.Module] = None,
+    num_draft_tokens: int = 4,
+    prompt_lookup_ngram: Optional[int] = None,
     **kwargs,
 ) -> Union[str, Generator[str, None, None]]:
     """
@@ -373,11 +1204,27 @@ def generate(
            Default: ``False``.
        formatter (Optional[Callable]): A function which takes a token and a
            probability and displays it.
+       draft_model (nn.Module, optional): If set, decode speculatively with
+           this smaller model sharing the tokenizer, see
+           :func:`speculative.speculative_generate_step`. Cannot be combined
+           with ``formatter``, and only supports the options listed for
+           :func:`batch_generate`.
+       num_draft_tokens (int): Most draft tokens proposed per step when
+           decoding speculatively. Default: ``4``.
+       prompt_lookup_ngram (int, optional): If set (and no ``draft_model``
+           is given), decode speculatively by looking up the last up to this
+           many tokens in the prompt, see
+           :class:`speculative.PromptLookupDrafter`.
        kwargs: The remaining options get passed to :func:`generate_step`.
           See :func:`generate_step` for more details.
     """
     if not isinstance(tokenizer, TokenizerWrapper):
         tokenizer = TokenizerWrapper(tokenizer)
+    speculative = draft_model is not None or prompt_lookup_ngram is not None
+    if speculative:
+        if formatter is not None:
+            raise ValueError("formatter is not supported with speculative decoding")
+        _check_speculative(kwargs)
 
     if verbose:
         print("=" * 10)
@@ -388,10 +1235,29 @@ def generate(
     tic = time.perf_counter()
     detokenizer.reset()
 
-    for (token, prob), n in zip(
-        generate_step(prompt_tokens, model, **kwargs),
-        range(max_tokens),
-    ):
+    if speculative:
+        stats = SpeculativeStats(num_draft_tokens)
+        steps = (
+            (token, None)
+            for tokens in speculative_generate_step(
+                prompt_tokens,
+                model,
+                draft_model,
+                num_draft_tokens=num_draft_tokens,
+                prompt_lookup_ngram=prompt_lookup_ngram,
+                temp=kwargs.get("temp", 0.0),
+                seed=kwargs.get("seed"),
+                stop_token_ids=[tokenizer.eos_token_id],
+                stats=stats,
+            )
+            for token in tokens[0]
+        )
+    else:
+        steps = generate_step(
+            prompt_tokens, model, logprobs=bool(verbose and formatter), **kwargs
+        )
+
+    for (token, logprob), n in zip(steps, range(max_tokens)):
         if n == 0:
             prompt_time = time.perf_counter() - tic
             tic = time.perf_counter()
@@ -403,7 +1269,7 @@ def generate(
             if formatter:
                 # We have to finalize so that the prob corresponds to the last segment
                 detokenizer.finalize()
-                formatter(detokenizer.last_segment, prob.item())
+                formatter(detokenizer.last_segment, mx.exp(logprob).item())
             else:
                 print(detokenizer.last_segment, end="", flush=True)
 
@@ -421,6 +1287,11 @@ def generate(
         gen_tps = (token_count - 1) / gen_time
         print(f"Prompt: {prompt_tps:.3f} tokens-per-sec")
         print(f"Generation: {gen_tps:.3f} tokens-per-sec")
+        if speculative:
+            print(
+                f"Speculative: {stats.acceptance_rate:.1%} of {stats.drafted} draft tokens "
+                f"accepted, {stats.tokens_per_step:.2f} tokens per target step"
+            )
 
     return detokenizer.text
 
@@ -512,6 +1383,7 @@ def load(
     model_config={},
     adapter_path: Optional[str] = None,
     lazy: bool = False,
+    revision: Optional[str] = None,
 ) -> Tuple[nn.Module, TokenizerWrapper]:
     """
     Load the model and tokenizer from a given path or a huggingface repository.
@@ -527,6 +1399,8 @@ def load(
         lazy (bool): If False eval the model parameters to make sure they are
             loaded in memory before returning, otherwise they will be loaded
             when needed. Default: ``False``
+        revision (str, optional): A revision id which can be a branch name, a tag, or a
+            commit hash. Default: ``None``.
     Returns:
         Tuple[nn.Module, TokenizerWrapper]: A tuple containing the loaded model and tokenizer.
 
@@ -534,7 +1408,7 @@ def load(
         FileNotFoundError: If config file or safetensors are not found.
         ValueError: If model class or args class are not found.
     """
-    model_path = get_model_path(path_or_hf_repo)
+    model_path = get_model_path(path_or_hf_repo, revision=revision)
 
     model = load_model(model_path, lazy, model_config)
     if adapter_path is not None: